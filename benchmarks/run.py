@@ -0,0 +1,269 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+Benchmarks of the scheduler and executor on synthetic snapshot roots.
+
+Builds a snapshot root with several levels of hardlinked snapshots and backdated modification times and measures
+decision latency, rotation, deletion of expired snapshots and a complete backup with a fake rsync. Results are written
+as JSON and can be compared against a previous result to catch regressions:
+
+    $ python benchmarks/run.py --files 100000 --output new.json --compare baseline.json
+"""
+
+from argparse import ArgumentParser
+from collections import OrderedDict
+from contextlib import redirect_stdout
+from os import path
+
+import io
+import json
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+
+from multilevelbackup import DefaultSnapshotManager, perform_backup  # noqa: E402
+from multilevelbackup.ledger import SnapshotLedger  # noqa: E402
+from multilevelbackup.native import NativeBackupExecutor  # noqa: E402
+from multilevelbackup.reaper import Reaper  # noqa: E402
+from multilevelbackup.rotation import RotationEngine, SYNC_FOLDER, TRASH_PREFIX  # noqa: E402
+
+FAKE_RSYNC = path.join(path.dirname(path.dirname(path.abspath(__file__))), 'tests', 'fake-rsync')
+
+INTERVALS = OrderedDict([('daily', 7), ('weekly', 4), ('monthly', 12)])
+LEVEL_DAYS = {'daily': 1, 'weekly': 7, 'monthly': 28}
+DAY = 86400
+
+
+#
+# Synthetic snapshot roots
+#
+
+
+def create_files(folder, files, files_per_folder=100):
+    """Create a tree of small files with some content."""
+    for index in range(files):
+        subfolder = path.join(folder, 'dir{number:05d}'.format(number=index // files_per_folder))
+        if index % files_per_folder == 0:
+            os.makedirs(subfolder, exist_ok=True)
+        with open(path.join(subfolder, 'file{number:07d}'.format(number=index)), 'wb') as data:
+            data.write(os.urandom(index % 4096))
+
+
+def link_tree(source, target):
+    """Copy a folder tree with hardlinks like `cp -al`."""
+    for folder, subfolders, files in os.walk(source):
+        relative = path.relpath(folder, source)
+        os.makedirs(path.join(target, relative), exist_ok=True)
+        for name in files:
+            os.link(path.join(folder, name), path.join(target, relative, name))
+
+
+def build_snapshot_root(root, files, intervals=INTERVALS, now=None):
+    """
+    Build snapshot root with all snapshots of all levels, hardlinked to each other and backdated like after years of
+    daily backups.
+    """
+    now = time.time() if now is None else now
+    os.makedirs(root)
+    template = path.join(root, 'daily.0')
+    create_files(path.join(template, 'localhost'), files)
+
+    age = 0
+    for level, count in intervals.items():
+        for index in range(count):
+            snapshot = path.join(root, '{level}.{index}'.format(level=level, index=index))
+            if snapshot != template:
+                link_tree(template, snapshot)
+            age += LEVEL_DAYS[level]
+            os.utime(snapshot, (now - age * DAY, now - age * DAY))
+
+
+def move_trash(root, graveyard):
+    """Move expired snapshots out of the snapshot root, trash names are only unique per second."""
+    os.makedirs(graveyard, exist_ok=True)
+    for name in os.listdir(root):
+        if name.startswith(TRASH_PREFIX):
+            target = '{number}.{name}'.format(number=len(os.listdir(graveyard)), name=name)
+            os.rename(path.join(root, name), path.join(graveyard, target))
+
+
+def write_config(folder, root, source):
+    config = path.join(folder, 'rsnapshot.conf')
+    lines = ['snapshot_root\t{root}/'.format(root=root), 'cmd_rsync\t{rsync}'.format(rsync=FAKE_RSYNC)]
+    lines.extend('retain\t{level}\t{count}'.format(level=level, count=count) for level, count in INTERVALS.items())
+    lines.append('backup\t{source}/\tlocalhost/'.format(source=source))
+    with open(config, 'w') as config_file:
+        config_file.write('\n'.join(lines) + '\n')
+    return config
+
+
+#
+# Benchmarks
+#
+
+
+def measure(function, repeat, setup=None):
+    """
+    Measure wall time of a function.
+
+    :return Durations in seconds
+    :rtype list[float]
+    """
+    durations = []
+    for _ in range(repeat):
+        argument = setup() if setup is not None else None
+        start = time.perf_counter()
+        function(argument)
+        durations.append(time.perf_counter() - start)
+    return durations
+
+
+def bench_decision(work, files, repeat):
+    root = path.join(work, 'decision')
+    build_snapshot_root(root, files)
+    state = path.join(work, 'decision-state')
+
+    yield 'decision_inventory', measure(lambda _: DefaultSnapshotManager(root, INTERVALS).upcoming_tasks, repeat)
+
+    ledger_file = SnapshotLedger.file_for_root(state, root)
+    DefaultSnapshotManager(root, INTERVALS, ledger=SnapshotLedger(ledger_file)).upcoming_tasks
+    yield 'decision_ledger', measure(
+        lambda _: DefaultSnapshotManager(root, INTERVALS, ledger=SnapshotLedger(ledger_file)).upcoming_tasks, repeat)
+
+
+def bench_rotation(work, files, repeat):
+    root = path.join(work, 'rotation')
+    build_snapshot_root(root, files)
+    graveyard = path.join(work, 'rotation-trash')
+    engine = RotationEngine(root)
+    levels = list(reversed(INTERVALS))
+
+    def setup():
+        move_trash(root, graveyard)
+        os.makedirs(path.join(root, SYNC_FOLDER))
+        return engine.plan(INTERVALS, levels)
+
+    yield 'rotation_all_levels', measure(engine.apply, repeat, setup)
+
+
+def bench_deletion(work, files, repeat):
+    source = path.join(work, 'deletion-source')
+    create_files(source, files)
+    counter = [0]
+
+    def setup():
+        counter[0] += 1
+        target = path.join(work, 'deletion-{number}'.format(number=counter[0]))
+        link_tree(source, target)
+        return target
+
+    yield 'deletion_rmtree', measure(shutil.rmtree, repeat, setup)
+    for workers in (1, 4, 16):
+        reaper = Reaper(work, workers=workers)
+        yield 'deletion_reaper_{workers}'.format(workers=workers), measure(reaper.delete_tree, repeat, setup)
+
+
+def bench_backup(work, files, repeat):
+    root = path.join(work, 'backup')
+    source = path.join(work, 'backup-source')
+    build_snapshot_root(root, files)
+    create_files(source, files)
+    config = write_config(work, root, source)
+
+    def setup():
+        move_trash(root, path.join(work, 'backup-trash'))
+
+    def backup(_):
+        manager = DefaultSnapshotManager(root, INTERVALS)
+        # Make every run a full daily backup
+        os.utime(manager.first_snapshot('daily'), (0, 0))
+        with redirect_stdout(io.StringIO()):
+            perform_backup(manager, NativeBackupExecutor(config))
+
+    yield 'backup_native_fake_rsync', measure(backup, repeat, setup)
+
+
+BENCHMARKS = OrderedDict([('decision', bench_decision), ('rotation', bench_rotation), ('deletion', bench_deletion),
+                          ('backup', bench_backup)])
+
+
+#
+# Results
+#
+
+
+def summarize(name, durations):
+    return OrderedDict([('name', name), ('repeat', len(durations)), ('min', min(durations)),
+                        ('median', statistics.median(durations)), ('mean', statistics.mean(durations))])
+
+
+def compare(results, baseline, threshold):
+    """
+    Print comparison against baseline results.
+
+    :return Names of benchmarks slower than the baseline by more than the threshold
+    :rtype list[str]
+    """
+    previous = dict((result['name'], result) for result in baseline['results'])
+    regressions = []
+    for result in results:
+        if result['name'] not in previous:
+            continue
+        ratio = result['median'] / previous[result['name']]['median']
+        print('{name:<28} {ratio:>6.2f}x'.format(name=result['name'], ratio=ratio), file=sys.stderr)
+        if ratio > 1 + threshold:
+            regressions.append(result['name'])
+    return regressions
+
+
+def main(argv=None):
+    parser = ArgumentParser(description='Benchmark multilevel-backup on synthetic snapshot roots.')
+    parser.add_argument('--files', help='number of files per snapshot', type=int, default=1000)
+    parser.add_argument('--repeat', help='repetitions per benchmark', type=int, default=5)
+    parser.add_argument('--only', help='run only given benchmarks', choices=list(BENCHMARKS), action='append')
+    parser.add_argument('--work-dir', help='folder for the synthetic snapshot roots (should be on the target disk)')
+    parser.add_argument('-o', '--output', help='file to write JSON results to instead of stdout')
+    parser.add_argument('--compare', help='JSON results of a previous run to compare against')
+    parser.add_argument('--threshold', help='allowed slowdown against the previous run', type=float, default=0.2)
+    args = parser.parse_args(argv)
+
+    results = []
+    work = tempfile.mkdtemp(prefix='multilevel-backup-bench-', dir=args.work_dir)
+    try:
+        for name in args.only or BENCHMARKS:
+            for result_name, durations in BENCHMARKS[name](work, args.files, args.repeat):
+                results.append(summarize(result_name, durations))
+                print('{name:<28} {median:>10.6f}s'.format(**results[-1]), file=sys.stderr)
+    finally:
+        shutil.rmtree(work)
+
+    output = OrderedDict([
+        ('meta', OrderedDict([('time', time.time()), ('python', platform.python_version()),
+                              ('platform', platform.platform()), ('files', args.files),
+                              ('repeat', args.repeat)])),
+        ('results', results),
+    ])
+    text = json.dumps(output, indent=2)
+    if args.output is not None:
+        with open(args.output, 'w') as output_file:
+            output_file.write(text + '\n')
+    else:
+        print(text)
+
+    if args.compare is not None:
+        with open(args.compare, 'r') as baseline:
+            regressions = compare(results, json.load(baseline), args.threshold)
+        if regressions:
+            print('Regressions: {names}'.format(names=', '.join(regressions)), file=sys.stderr)
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1 +1,2 @@
-from .backup import DefaultSnapshotManager, DefaultBackupExecutor, perform_backup
+from .backup import DefaultSnapshotManager, DefaultBackupExecutor, AsyncBackupExecutor, StepTimeoutError, \
+    perform_backup, perform_backup_async
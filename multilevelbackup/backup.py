@@ -1,129 +1,444 @@
 from os import path
-from datetime import date, timedelta
+from collections import OrderedDict
 
-import subprocess
+import asyncio
+import functools
+import inspect
 import shlex
+import time
 
-from .helpers import folder_time, level_backup_needed
-from .config import intervals_from_config, backup_root_from_config
+from .config import intervals_from_config, backup_root_from_config, backup_points_from_config, value_from_config
+from .inventory import SnapshotInventory
+from .ledger import SnapshotLedger
+from .levels import LevelChain
+from .process import run_command_async, run_sync
+from .report import RsyncOutputParser, StatsCollector, StepReport, RunReport, is_output
+from .sync import SyncCheckpoint, group_destinations, sync_concurrently_async
 
+DEFAULT_INTERVALS = OrderedDict([('daily', 7), ('weekly', 4), ('monthly', 3)])
 
-class DefaultSnapshotManager(object):
-    """Provide information about current backup state."""
 
-    def __init__(self, backup_root, daily_count=7, weekly_count=4):
-        self.daily_first = path.join(backup_root, 'daily.0')
-        self.daily_last = path.join(backup_root, 'daily.' + str(daily_count-1))
-        self.daily_diff = timedelta(days=1)
+class DefaultSnapshotManager(object):
+    """
+    Provide information about current backup state.
 
-        self.weekly_first = path.join(backup_root, 'weekly.0')
-        self.weekly_last = path.join(backup_root, 'weekly.' + str(weekly_count-1))
-        self.weekly_diff = timedelta(days=7)
+    If a ledger is given, it is consulted first so that a run without any task does not touch the backup device. The
+    snapshot root is only read if the ledger is inconsistent or a backup is due.
+    """
 
-        self.monthly_first = path.join(backup_root, 'monthly.0')
-        self.monthly_diff = timedelta(days=28)
+    def __init__(self, backup_root, intervals=DEFAULT_INTERVALS, min_gaps=None, ledger=None, inventory=None,
+                 clock=None):
+        """
+        :param intervals: Interval names and retaining counts in ascending order
+        :type intervals: collections.OrderedDict[str, int]
+        :param min_gaps: Minimum gaps overriding the default ones
+        :type min_gaps: dict[str, datetime.timedelta]
+        :param inventory: Snapshot source replacing the scan of the snapshot root, e.g. for simulations
+        :param clock: Callable returning the current timestamp, the system time is used if None
+        """
+        self.backup_root = backup_root
+        self.inventory = inventory if inventory is not None else SnapshotInventory(backup_root)
+        self.ledger = ledger
+        self.levels = LevelChain.from_intervals(intervals, min_gaps)
+        self.clock = clock
 
     @staticmethod
-    def create_from_rsnapshot_conf(conf_file):
+    def create_from_rsnapshot_conf(conf_file, state_dir=None, read_only=False, min_gaps=None):
+        """
+        Create manager from rsnapshot config file.
+
+        :param state_dir: Folder to keep the snapshot ledger in, no ledger is used if None
+        :param read_only: Do not update the ledger (e.g. for dry runs)
+        :param min_gaps: Minimum gaps overriding the default ones
+        """
         config = open(conf_file, 'r').read()
 
         backup_root = backup_root_from_config(config)
         intervals = intervals_from_config(config)
 
-        if 'daily' not in intervals or 'weekly' not in intervals:
-            raise ValueError('No \'daily\' or \'weekly\' interval in rsnapshot config found')
+        ledger = None
+        if state_dir is not None:
+            ledger = SnapshotLedger(SnapshotLedger.file_for_root(state_dir, backup_root), read_only=read_only)
 
-        return DefaultSnapshotManager(backup_root=backup_root,
-                                      daily_count=intervals['daily'],
-                                      weekly_count=intervals['weekly'])
+        return DefaultSnapshotManager(backup_root=backup_root, intervals=intervals, min_gaps=min_gaps, ledger=ledger)
 
     @property
-    def is_daily_needed(self):
-        if not path.exists(self.daily_first):
-            return True
+    def intervals(self):
+        """
+        Interval names and retaining counts in ascending order.
 
-        delta = date.today() - folder_time(self.daily_first)
-        return delta >= self.daily_diff
+        :rtype collections.OrderedDict[str, int]
+        """
+        return OrderedDict((level.name, level.count) for level in self.levels)
 
-    @property
-    def is_weekly_needed(self):
-        return level_backup_needed(self.weekly_first, self.daily_last, self.weekly_diff)
+    def snapshot_path(self, interval, index):
+        """Path of a snapshot below the snapshot root."""
+        return path.join(self.backup_root, '{interval}.{index}'.format(interval=interval, index=index))
+
+    def first_snapshot(self, interval):
+        """Path of the newest snapshot of an interval."""
+        return self.snapshot_path(interval, 0)
+
+    def last_snapshot(self, interval):
+        """Path of the oldest snapshot of an interval."""
+        return self.snapshot_path(interval, self.levels[interval].last_index)
+
+    def min_gap(self, interval):
+        """Minimum gap between two snapshots of an interval."""
+        return self.levels[interval].min_gap
+
+    def step_performed(self, step):
+        """Notify manager that executor changed the snapshot root by performing given step."""
+        self.inventory.invalidate()
+
+        if self.ledger is not None:
+            self.ledger.record_step(step)
+            self._reconcile_ledger()
+
+    def _reconcile_ledger(self):
+        self.ledger.reconcile(self.inventory, self.intervals)
+        self.ledger.save()
 
     @property
-    def is_monthly_needed(self):
-        return level_backup_needed(self.monthly_first, self.weekly_last, self.monthly_diff)
+    def snapshots(self):
+        """
+        Current snapshot state: the ledger if it can be trusted, the inventory of the snapshot root otherwise.
+
+        :rtype multilevelbackup.ledger.SnapshotLedger|multilevelbackup.inventory.SnapshotInventory
+        """
+        if self.ledger is not None and self.ledger.is_consistent(self.backup_root, self.intervals):
+            return self.ledger
+        return self.inventory
+
+    def is_level_needed(self, interval):
+        """
+        Check whether a backup of given level is needed regardless of the levels below.
+
+        :rtype bool
+        """
+        return self.levels.is_level_due(interval, self.inventory, self._now())
 
     @property
     def upcoming_tasks(self):
-        """Dictionary which tasks should be performed today (daily=True/False, weekly=True/False, monthly=True/False)"""
+        """
+        Which tasks should be performed now, from lowest to highest level (e.g. daily=True, weekly=False, ...).
 
-        tasks = {'daily': False, 'weekly': False, 'monthly': False}
-        if self.is_daily_needed:
-            tasks['daily'] = True
+        :rtype collections.OrderedDict[str, bool]
+        """
 
-        if tasks['daily'] and self.is_weekly_needed:
-            tasks['weekly'] = True
+        # Answer from ledger without touching the backup device if possible
+        if self.ledger is not None:
+            if self.ledger.is_consistent(self.backup_root, self.intervals) and \
+                    not self.levels.is_lowest_due(self.ledger, self._now()):
+                return OrderedDict((name, False) for name in self.levels.names)
+            self._reconcile_ledger()
 
-        if tasks['weekly'] and self.is_monthly_needed:
-            tasks['monthly'] = True
+        return self.levels.due_levels(self.inventory, self._now())
 
-        return tasks
+    def overdue_levels(self, factor):
+        """
+        Levels due for longer than `factor` times their minimum gap.
 
+        :rtype list[str]
+        """
+        return self.levels.overdue_levels(self.snapshots, factor, self._now())
+
+    def _now(self):
+        return self.clock() if self.clock is not None else None
+
+
+class AsyncBackupExecutor(object):
+    """
+    Perform backup steps with rsnapshot without blocking the event loop.
+
+    With more than one sync worker, the backup points are synced concurrently with one `rsnapshot sync <destination>`
+    per destination, grouped by source host or device. This requires a config without lockfile, since rsnapshot refuses
+    to run twice otherwise. Destinations synced completely are recorded in a
+    :class:`multilevelbackup.sync.SyncCheckpoint`, so an interrupted concurrent sync continues with the remaining ones.
+
+    Every rsnapshot call runs in a process group of its own. Cancelling a step, e.g. by a timeout of
+    :func:`perform_backup_async`, terminates the running calls together with the rsync processes they started.
+
+    A resource governor applies its priorities and cgroup limits to the rsnapshot sync calls. rsync's bandwidth limit
+    cannot be passed through rsnapshot, it has to be part of `rsync_long_args` in the config. The same holds for
+    `--stats` and `--info=progress2`, which the transfer statistics and the progress are parsed from.
+    """
 
-class DefaultBackupExecutor(object):
     _rsnapshot_command_template = 'rsnapshot {dry} -c {file} {{action}}'
 
-    def __init__(self, conf_file, dry_run=False):
+    def __init__(self, conf_file, dry_run=False, sync_workers=1, governor=None, on_progress=None):
+        """
+        :param governor: Resource governor of the syncs or None
+        :type governor: multilevelbackup.governor.ResourceGovernor
+        :param on_progress: Called with the destination (or `sync`) and every
+            :class:`multilevelbackup.report.ProgressEvent` of its rsync calls
+        """
         dry_run_arg = '-t' if dry_run else ''
         self._command_template = self._rsnapshot_command_template.format(dry=dry_run_arg, file=conf_file)
-
-    def perform_sync(self):
+        self.conf_file = conf_file
+        self.dry_run = dry_run
+        self.sync_workers = sync_workers
+        self.governor = governor
+        self.on_progress = on_progress
+        self._rsync_args_checked = False
+
+    def _check_rsync_args(self):
+        """Point out rsync options missing in the config for statistics and progress, once per executor."""
+        if self._rsync_args_checked:
+            return
+        self._rsync_args_checked = True
+        try:
+            with open(self.conf_file, 'r') as config:
+                long_args = value_from_config(config.read(), 'rsync_long_args') or ''
+        except OSError:
+            # Reported by rsnapshot
+            return
+        missing = [option for option in ('--stats', '--info=progress2') if option not in long_args.split()]
+        if missing:
+            print('Note: add {options} to rsync_long_args in {conf} for transfer statistics and progress'.format(
+                options=' '.join(missing), conf=self.conf_file))
+
+    def _sync_groups(self):
+        """
+        Determine destination groups to sync concurrently.
+
+        :return Groups or None if backup points cannot be synced concurrently
+        """
+        if self.sync_workers <= 1:
+            return None
+
+        config = open(self.conf_file, 'r').read()
+        if value_from_config(config, 'lockfile') is not None:
+            print('Note: Syncing backup points one after another since rsnapshot config uses a lockfile')
+            return None
+
+        groups = group_destinations(backup_points_from_config(config))
+        if sum(len(destinations) for destinations in groups.values()) <= 1:
+            return None
+        return groups
+
+    async def _run(self, command, collector, governed=False, label=None):
+        """Run rsnapshot and collect the statistics and progress of the rsync calls in its output."""
+        on_start = None
+        if governed and self.governor is not None:
+            command = self.governor.command_prefix() + command
+            on_start = self.governor.attach
+
+        on_progress = None
+        if label is not None and self.on_progress is not None:
+            on_progress = functools.partial(self.on_progress, label)
+        parser = RsyncOutputParser(on_progress)
+        await run_command_async(command, handlers=[parser], echo=is_output, on_start=on_start)
+        collector.add(parser.stats)
+
+    async def perform_sync(self):
+        """:rtype multilevelbackup.report.StepReport"""
         print('-- Performing sync')
+        start = time.monotonic()
+        collector = StatsCollector()
+
+        self._check_rsync_args()
+        governed = self.governor is not None and not self.dry_run
+        if governed:
+            self.governor.start()
+        try:
+            groups = self._sync_groups()
+            if groups is None:
+                command = self._command_template.format(action='sync')
+                await self._run(shlex.split(command), collector, governed=governed, label='sync')
+            else:
+                await self._sync_groups_resumable(groups, collector)
+        finally:
+            if governed:
+                self.governor.stop()
+
+        return StepReport('sync', time.monotonic() - start, collector.stats)
+
+    async def _sync_groups_resumable(self, groups, collector):
+        checkpoint = None
+        if not self.dry_run:
+            with open(self.conf_file, 'r') as config:
+                checkpoint = SyncCheckpoint(backup_root_from_config(config.read())).load()
+            if checkpoint.resumed:
+                print('-- Resuming interrupted sync, skipping {destinations}'.format(
+                    destinations=', '.join(checkpoint.destinations)))
+                groups = OrderedDict((group, checkpoint.pending(destinations))
+                                     for group, destinations in groups.items())
+            checkpoint.begin()
+
+        await sync_concurrently_async(
+            groups, lambda destination: self._sync_destination(destination, collector, checkpoint), self.sync_workers)
+
+        if checkpoint is not None:
+            # rsnapshot takes the sync folder over by itself
+            checkpoint.remove()
+
+    async def _sync_destination(self, destination, collector, checkpoint=None):
+        print('-- Performing sync of {destination}'.format(destination=destination))
 
         command = self._command_template.format(action='sync')
-        subprocess.check_call(shlex.split(command))
+        await self._run(shlex.split(command) + [destination], collector, governed=not self.dry_run, label=destination)
+        if checkpoint is not None:
+            checkpoint.destination_done(destination)
+
+    async def perform_level(self, level):
+        """:rtype multilevelbackup.report.StepReport"""
+        print('\n-- Performing {level} backup'.format(level=level))
+        start = time.monotonic()
+        collector = StatsCollector()
+
+        command = self._command_template.format(action=level)
+        await self._run(shlex.split(command), collector)
+
+        return StepReport(level, time.monotonic() - start, collector.stats)
+
+    async def perform_levels(self, levels):
+        """
+        Rotate given levels one after another.
+
+        :param levels: Levels in the order they are rotated (highest first)
+        :rtype list[multilevelbackup.report.StepReport]
+        """
+        return [await self.perform_level(level) for level in levels]
+
+
+class DefaultBackupExecutor(object):
+    """
+    Perform backup steps with rsnapshot, blocking until they are done. Thin wrapper of :class:`AsyncBackupExecutor`,
+    :func:`perform_backup_async` uses the wrapped executor directly.
+    """
+
+    def __init__(self, conf_file, dry_run=False, sync_workers=1, governor=None, on_progress=None):
+        """
+        :param governor: Resource governor of the syncs or None
+        :type governor: multilevelbackup.governor.ResourceGovernor
+        :param on_progress: Called with the destination and every progress event of its rsync calls
+        """
+        self.async_executor = AsyncBackupExecutor(conf_file, dry_run=dry_run, sync_workers=sync_workers,
+                                                  governor=governor, on_progress=on_progress)
 
-    def perform_daily(self):
-        print('\n-- Performing daily backup')
+    def perform_sync(self):
+        """:rtype multilevelbackup.report.StepReport"""
+        return run_sync(self.async_executor.perform_sync())
+
+    def perform_level(self, level):
+        """:rtype multilevelbackup.report.StepReport"""
+        return run_sync(self.async_executor.perform_level(level))
+
+    def perform_levels(self, levels):
+        """
+        Rotate given levels one after another.
 
-        command = self._command_template.format(action='daily')
-        subprocess.check_call(shlex.split(command))
+        :param levels: Levels in the order they are rotated (highest first)
+        :rtype list[multilevelbackup.report.StepReport]
+        """
+        return run_sync(self.async_executor.perform_levels(levels))
 
-    def perform_weekly(self):
-        print('\n-- Performing weekly backup')
 
-        command = self._command_template.format(action='weekly')
-        subprocess.check_call(shlex.split(command))
+class StepTimeoutError(Exception):
+    """Raised if a backup step did not finish within its timeout."""
 
-    def perform_monthly(self):
-        print('\n-- Performing monthly backup')
 
-        command = self._command_template.format(action='monthly')
-        subprocess.check_call(shlex.split(command))
+async def _perform_step(report, name, method, args=(), timeout=None):
+    """
+    Perform executor step and add its reports to the run report. Executors may return a step report, a list of step
+    reports or nothing, in which case the wall time is measured here. Steps returning an awaitable are cancelled after
+    `timeout` seconds.
+    """
+    start = time.monotonic()
+    result = method(*args)
+    if inspect.isawaitable(result):
+        try:
+            result = await asyncio.wait_for(result, timeout)
+        except asyncio.TimeoutError:
+            raise StepTimeoutError('Step {name} cancelled after {timeout} seconds'.format(name=name, timeout=timeout))
+
+    if result is None:
+        report.add_step(StepReport(name, time.monotonic() - start))
+    elif isinstance(result, StepReport):
+        report.add_step(result)
+    else:
+        for step in result:
+            report.add_step(step)
+
+
+def perform_backup(manager, executor, metrics=None, post_sync=(), background=(), timeouts=None):
+    """
+    Perform actual backup, blocking until it is done. Thin wrapper of :func:`perform_backup_async`.
+
+    :rtype multilevelbackup.report.RunReport
+    """
+    return run_sync(perform_backup_async(manager, executor, metrics=metrics, post_sync=post_sync,
+                                         background=background, timeouts=timeouts))
 
 
-def perform_backup(manager, executor):
+async def perform_backup_async(manager, executor, metrics=None, post_sync=(), background=(), timeouts=None):
     """
     Perform actual backup. Relies on a backup manager for information retrieving and backup performing.
+
+    Levels are rotated from highest to lowest, so that each level takes over the oldest snapshot of the level below
+    before the lower level itself is rotated.
+
+    Executor steps and stages may be coroutine functions, blocking ones are called directly. Awaitable steps are
+    cancelled after their timeout, which stops the processes they run, and on cancellation of the backup. Background
+    work and the metrics export do not change the snapshots and run in threads: background work starts with the
+    rotation, the metrics are exported while the background work finishes.
+
+    :param metrics: Exporter receiving the manager and report after every run, even failed ones
+    :type metrics: multilevelbackup.metrics.MetricsExporter
+    :param post_sync: Stages performed on the sync folder after the sync and before the rotation. A stage is called
+        with the manager, has a `name` and may return step reports like the executor steps
+    :param background: Functions called with the manager once the rotation starts, e.g. deleting expired snapshots
+    :param timeouts: Seconds after which a step is cancelled, by step (`sync`, `rotation` or the name of a stage)
+    :type timeouts: dict[str, float]
+    :return Wall time and transfer statistics of the performed steps
+    :rtype multilevelbackup.report.RunReport
+    :raise StepTimeoutError: Raised if a step did not finish within its timeout
     """
+    if isinstance(executor, DefaultBackupExecutor):
+        executor = executor.async_executor
 
     tasks = manager.upcoming_tasks
+    report = RunReport(tasks)
+    running = []
+    try:
+        await _perform_tasks(manager, executor, report, post_sync, background, timeouts or {}, running)
+    except (Exception, asyncio.CancelledError) as error:
+        report.error = error
+        raise
+    finally:
+        if metrics is not None:
+            running.append(asyncio.get_running_loop().run_in_executor(None, metrics.export, manager, report))
+        results = await asyncio.gather(*running, return_exceptions=True)
+
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+    return report
+
+
+async def _perform_tasks(manager, executor, report, post_sync, background, timeouts, running):
+    tasks = report.tasks
+    levels = list(tasks)
+    lowest = levels[0]
 
     # Test whether backup is needed in general
-    if not tasks['daily']:
-        print('Abort: Daily backup already performed')
+    if not tasks[lowest]:
+        print('Abort: {level} backup already performed'.format(level=lowest.capitalize()))
         return
 
     # Perform sync (actual backup)
-    executor.perform_sync()
-
-    # Perform monthly if needed
-    if tasks['monthly']:
-        executor.perform_monthly()
-
-    # Perform weekly if needed
-    if tasks['weekly']:
-        executor.perform_weekly()
-
-    # Perform daily
-    executor.perform_daily()
+    await _perform_step(report, 'sync', executor.perform_sync, timeout=timeouts.get('sync'))
+    manager.step_performed('sync')
+    for stage in post_sync:
+        await _perform_step(report, stage.name, stage, (manager,), timeouts.get(stage.name))
+
+    loop = asyncio.get_running_loop()
+    for work in background:
+        running.append(loop.run_in_executor(None, work, manager))
+
+    # Perform all due levels, lowest last
+    due_levels = [level for level in reversed(levels) if tasks[level]]
+    await _perform_step(report, '+'.join(due_levels), executor.perform_levels, (due_levels,), timeouts.get('rotation'))
+    for level in due_levels:
+        manager.step_performed(level)
@@ -0,0 +1,261 @@
+from collections import namedtuple
+from os import path
+
+import hashlib
+import os
+import sqlite3
+import time
+
+from .fingerprint import FINGERPRINT_FILE
+from .inventory import SnapshotInventory
+from .manifest import MANIFEST_FILE, walk_files
+from .rotation import snapshot_name
+
+CatalogVersion = namedtuple('CatalogVersion', ['path', 'inode', 'size', 'mtime_ns', 'snapshots'])
+CatalogUpdate = namedtuple('CatalogUpdate', ['relabeled', 'scanned', 'removed'])
+
+_schema_version = 1
+_schema = [
+    'CREATE TABLE snapshots (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT, identity TEXT UNIQUE, mtime REAL)',
+    'CREATE TABLE paths (id INTEGER PRIMARY KEY, path BLOB UNIQUE)',
+    'CREATE TABLE versions (path INTEGER, first INTEGER, last INTEGER, inode INTEGER, size INTEGER, '
+    'mtime_ns INTEGER)',
+    'CREATE INDEX versions_by_path ON versions (path, first)',
+    'CREATE INDEX versions_by_last ON versions (last)',
+]
+
+# New versions inserted at once while walking a snapshot, and paths looked up by one query (below SQLite's limit of
+# 999 parameters of old versions)
+_batch_size = 10000
+_lookup_size = 500
+
+# Files written into the snapshots by multilevel-backup itself
+_metadata_files = {os.fsencode(MANIFEST_FILE), os.fsencode(FINGERPRINT_FILE)}
+
+
+def snapshot_identity(snapshot):
+    """
+    Identity of a snapshot folder, which is kept by renaming it during a rotation.
+
+    :rtype str
+    """
+    info = os.stat(snapshot)
+    return '{dev}-{ino}-{mtime}'.format(dev=info.st_dev, ino=info.st_ino, mtime=info.st_mtime_ns)
+
+
+class Catalog(object):
+    """
+    SQLite catalog of the files of all snapshots of a snapshot root, stored in the local state folder.
+
+    Files are stored as versions: a path with inode, size and modification time, together with the range of snapshots
+    containing it. Snapshots are numbered in the order they were taken. A file hardlinked from the previous snapshot
+    (same inode, size and modification time) extends the range of its version, so an unchanged file costs one row for
+    all snapshots. Snapshots are known by the device, inode and modification time of their folder, so a rotation only
+    relabels them and only new snapshots are walked. Versions no remaining snapshot contains are dropped.
+    """
+
+    def __init__(self, catalog_file):
+        self.catalog_file = catalog_file
+        os.makedirs(path.dirname(path.abspath(catalog_file)), exist_ok=True)
+        self._db = sqlite3.connect(catalog_file)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        if self._db.execute('PRAGMA user_version').fetchone()[0] != _schema_version:
+            self._create()
+
+    @staticmethod
+    def file_for_root(state_dir, snapshot_root):
+        """
+        Determine catalog file of a snapshot root within the state folder.
+
+        :rtype str
+        """
+        key = hashlib.sha1(path.normpath(snapshot_root).encode('utf-8')).hexdigest()[:16]
+        return path.join(state_dir, 'catalog-{key}.sqlite'.format(key=key))
+
+    def _create(self):
+        with self._db:
+            for table in ('versions', 'paths', 'snapshots'):
+                self._db.execute('DROP TABLE IF EXISTS {table}'.format(table=table))
+            for statement in _schema:
+                self._db.execute(statement)
+            self._db.execute('PRAGMA user_version = {version}'.format(version=_schema_version))
+
+    def close(self):
+        self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @property
+    def snapshots(self):
+        """
+        Names of all cataloged snapshots, oldest first.
+
+        :rtype list[str]
+        """
+        return [name for name, in self._db.execute('SELECT name FROM snapshots ORDER BY id')]
+
+    def update(self, snapshot_root, intervals, on_scan=None):
+        """
+        Bring the catalog up to date with the snapshot root: relabel rotated snapshots, walk new ones and drop expired
+        ones. If a new snapshot is older than a cataloged one, e.g. after restoring snapshots from elsewhere, the order
+        of the snapshots is unknown and the catalog is rebuilt.
+
+        :type intervals: dict[str, int]
+        :param on_scan: Called with the name of every new snapshot before it is walked
+        :rtype CatalogUpdate
+        """
+        inventory = SnapshotInventory(snapshot_root)
+        found = {}
+        for interval in intervals:
+            for index in inventory.indices(interval):
+                name = snapshot_name(interval, index)
+                found[snapshot_identity(path.join(snapshot_root, name))] = (name, inventory.mtime(interval, index))
+
+        known = dict(self._db.execute('SELECT identity, id FROM snapshots'))
+        new = sorted((mtime, identity) for identity, (_, mtime) in found.items() if identity not in known)
+        newest = self._db.execute('SELECT MAX(mtime) FROM snapshots WHERE identity IN ({marks})'.format(
+            marks=', '.join('?' * len(found))), list(found)).fetchone()[0] if found else None
+        if new and newest is not None and new[0][0] < newest:
+            self._create()
+            known = {}
+            new = sorted((mtime, identity) for identity, (_, mtime) in found.items())
+
+        removed = [snapshot_id for identity, snapshot_id in known.items() if identity not in found]
+        relabeled = 0
+        with self._db:
+            self._db.execute('UPDATE snapshots SET name = NULL')
+            for identity, snapshot_id in known.items():
+                if identity in found:
+                    self._db.execute('UPDATE snapshots SET name = ? WHERE id = ?', (found[identity][0], snapshot_id))
+                    relabeled += 1
+            if removed:
+                self._remove(removed)
+
+        for mtime, identity in new:
+            name = found[identity][0]
+            if on_scan is not None:
+                on_scan(name)
+            self._scan(path.join(snapshot_root, name), name, identity, mtime)
+
+        return CatalogUpdate(relabeled=relabeled, scanned=len(new), removed=len(removed))
+
+    def _remove(self, snapshot_ids):
+        self._db.executemany('DELETE FROM snapshots WHERE id = ?', [(snapshot_id,) for snapshot_id in snapshot_ids])
+
+        # Versions are orphaned if no remaining snapshot lies within their range, regardless of the removal order
+        self._db.execute('DELETE FROM versions WHERE NOT EXISTS '
+                         '(SELECT 1 FROM snapshots WHERE snapshots.id BETWEEN versions.first AND versions.last)')
+        self._db.execute('DELETE FROM paths WHERE NOT EXISTS (SELECT 1 FROM versions WHERE versions.path = paths.id)')
+
+    def _scan(self, snapshot, name, identity, mtime):
+        with self._db:
+            previous_id = self._db.execute('SELECT MAX(id) FROM snapshots').fetchone()[0]
+            snapshot_id = self._db.execute('INSERT INTO snapshots (name, identity, mtime) VALUES (?, ?, ?)',
+                                           (name, identity, mtime)).lastrowid
+
+            # Versions of the previous snapshot by path, a file with the same inode is unchanged
+            previous = {}
+            path_ids = {}
+            if previous_id is not None:
+                for relative, path_id, rowid, inode, size, mtime_ns in self._db.execute(
+                        'SELECT paths.path, paths.id, versions.rowid, inode, size, mtime_ns FROM versions '
+                        'JOIN paths ON paths.id = versions.path WHERE last = ?', (previous_id,)):
+                    previous[relative] = (rowid, inode, size, mtime_ns)
+                    path_ids[relative] = path_id
+
+            extended = []
+            changed = []
+            for relative, info in walk_files(snapshot):
+                if relative in _metadata_files:
+                    continue
+                version = previous.get(relative)
+                if version is not None and version[1:] == (info.st_ino, info.st_size, info.st_mtime_ns):
+                    extended.append((snapshot_id, version[0]))
+                    continue
+
+                changed.append((relative, info))
+                if len(changed) >= _batch_size:
+                    self._insert_versions(snapshot_id, changed, path_ids)
+                    changed = []
+            self._insert_versions(snapshot_id, changed, path_ids)
+            self._db.executemany('UPDATE versions SET last = ? WHERE rowid = ?', extended)
+
+    def _insert_versions(self, snapshot_id, files, path_ids):
+        """
+        Insert new versions, creating their paths if needed.
+
+        :param files: Paths and stat results
+        :param path_ids: Known path ids by path, extended by the created and looked up ones
+        """
+        unknown = [relative for relative, _ in files if relative not in path_ids]
+        self._db.executemany('INSERT OR IGNORE INTO paths (path) VALUES (?)', [(relative,) for relative in unknown])
+        for start in range(0, len(unknown), _lookup_size):
+            chunk = unknown[start:start + _lookup_size]
+            path_ids.update(self._db.execute('SELECT path, id FROM paths WHERE path IN ({marks})'.format(
+                marks=', '.join('?' * len(chunk))), chunk))
+
+        self._db.executemany('INSERT INTO versions VALUES (?, ?, ?, ?, ?, ?)', [
+            (path_ids[relative], snapshot_id, snapshot_id, info.st_ino, info.st_size, info.st_mtime_ns)
+            for relative, info in files])
+
+    def _snapshot_names(self, first, last):
+        return [name for name, in self._db.execute(
+            'SELECT name FROM snapshots WHERE id BETWEEN ? AND ? ORDER BY id DESC', (first, last))]
+
+    def find(self, pattern):
+        """
+        Find paths matching a shell pattern, e.g. `*/etc/*.conf`. A pattern cannot use the index of the paths, so
+        every lookup scans all paths of the catalog.
+
+        :return Paths relative to the snapshots and the names of the snapshots containing them, newest first
+        :rtype list[(str, list[str])]
+        """
+        found = []
+        for relative, name in self._db.execute(
+                'SELECT paths.path, snapshots.name FROM paths JOIN versions ON versions.path = paths.id '
+                'JOIN snapshots ON snapshots.id BETWEEN versions.first AND versions.last '
+                'WHERE CAST(paths.path AS TEXT) GLOB ? ORDER BY paths.path, snapshots.id DESC', (pattern,)):
+            relative = os.fsdecode(relative)
+            if not found or found[-1][0] != relative:
+                found.append((relative, []))
+            found[-1][1].append(name)
+        return found
+
+    def versions(self, relative):
+        """
+        All versions of a path, oldest first. Paths not found as given are looked up as suffix, e.g. `/etc/hosts`
+        finds `localhost/etc/hosts`. An exact path is answered from the index, a suffix lookup scans all paths.
+
+        :param relative: Path relative to the snapshots
+        :rtype list[CatalogVersion]
+        """
+        encoded = os.fsencode(relative)
+        rows = self._db.execute('SELECT id, path FROM paths WHERE path = ?', (encoded,)).fetchall()
+        if not rows:
+            rows = self._db.execute('SELECT id, path FROM paths WHERE substr(path, -?1) = ?2',
+                                    (len(encoded.lstrip(b'/')) + 1, b'/' + encoded.lstrip(b'/'))).fetchall()
+
+        versions = []
+        for path_id, found in rows:
+            for first, last, inode, size, mtime_ns in self._db.execute(
+                    'SELECT first, last, inode, size, mtime_ns FROM versions WHERE path = ? ORDER BY first',
+                    (path_id,)):
+                versions.append(CatalogVersion(os.fsdecode(found), inode, size, mtime_ns,
+                                               self._snapshot_names(first, last)))
+        return versions
+
+
+def format_version(version):
+    """
+    Format catalog version as single line.
+
+    :type version: CatalogVersion
+    :rtype str
+    """
+    modified = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(version.mtime_ns / 1e9))
+    return '{modified} {size:>14} {snapshots}'.format(modified=modified, size=version.size,
+                                                      snapshots=' '.join(version.snapshots))
@@ -0,0 +1,580 @@
+from argparse import ArgumentParser
+from collections import OrderedDict
+
+import asyncio
+import os
+import signal
+import sys
+
+from .backup import DEFAULT_INTERVALS, DefaultSnapshotManager, AsyncBackupExecutor, perform_backup_async
+from .catalog import Catalog, format_version
+from .config import backup_root_from_config, intervals_from_config, directives_from_config
+from .daemon import BackupDaemon, DaemonTarget
+from .dedup import Deduplicator, DedupStage
+from .diff import DiffSummary, diff_trees, format_entry
+from .fingerprint import ChangeDetector
+from .governor import GovernorPolicy, ResourceGovernor
+from .helpers import default_state_dir, parse_size
+from .levels import parse_min_gap
+from .lock import RunLock
+from .manifest import MANIFEST_FILE, ManifestStage
+from .metrics import MetricsExporter
+from .native import NativeBackupExecutor
+from .orchestrate import BackupScheduler, configs_from_paths, format_summary
+from .process import run_sync
+from .reaper import Reaper, IO_CLASSES, lower_priority, run_lowered
+from .report import ProgressPrinter
+from .restore import restore_tree
+from .simulate import format_simulation, parse_pattern, parse_retain, simulate_pattern
+from .usage import ScanCache, build_usage_index, format_usage
+from .verify import VerifyCheckpoint, verify_snapshot
+
+
+def snapshot_root_of(conf_file):
+    with open(conf_file, 'r') as config:
+        return backup_root_from_config(config.read())
+
+
+def add_config_argument(parser):
+    parser.add_argument('-c', '--config-file', help='config file for rsnapshot to use, can be given multiple times and '
+                                                    'may be a folder containing *.conf files',
+                        action='append', required=True)
+
+
+def add_reaper_arguments(parser):
+    parser.add_argument('--reap-workers', help='number of threads deleting expired snapshots', type=int, default=4)
+    parser.add_argument('--ionice-class', help='I/O scheduling class while deleting expired snapshots',
+                        choices=sorted(IO_CLASSES))
+    parser.add_argument('--nice', help='niceness increment while deleting expired snapshots', type=int, default=0)
+
+
+#
+# Backup command (default)
+#
+
+
+def build_backup_parser(parser):
+    add_config_argument(parser)
+    parser.add_argument('-d', '--dry-run', help='only show what script would do', action='store_true')
+    parser.add_argument('-s', '--state-dir', help='local folder for the snapshot ledger and locks',
+                        default=default_state_dir())
+    parser.add_argument('--wait', help='if a backup of the same snapshot root is running and another one is queued, '
+                                       'wait for the queued one instead of returning', action='store_true')
+    parser.add_argument('--no-ledger', help='always inspect the snapshot root directly', action='store_true')
+    parser.add_argument('-g', '--min-gap', help='minimum gap of an interval, e.g. weekly=7d or hourly=4h',
+                        action='append', type=parse_min_gap, default=[])
+    parser.add_argument('-n', '--native', help='run rsync directly instead of rsnapshot', action='store_true')
+    parser.add_argument('--sync-workers', help='number of backup point groups synced concurrently', type=int,
+                        default=1)
+    parser.add_argument('--skip-unchanged', help='clone backup points with unchanged local sources from the previous '
+                                                 'snapshot instead of running rsync (only with -n)',
+                        action='store_true')
+    parser.add_argument('--no-ssh-multiplex', help='open a new SSH connection for every rsync call instead of one '
+                                                   'per host (only with -n)', action='store_true')
+    parser.add_argument('-j', '--jobs', help='maximum number of configs backed up in parallel', type=int, default=4)
+    parser.add_argument('--jobs-per-device', help='maximum number of parallel backups per snapshot root device',
+                        type=int, default=1)
+    parser.add_argument('--metrics-dir', help='folder to write metrics of every run to, e.g. the node exporter '
+                                              'textfile folder')
+    parser.add_argument('--metrics-format', help='format of the metrics files', choices=list(MetricsExporter.formats),
+                        default='prometheus')
+    parser.add_argument('--dedup', help='hardlink new files to identical files of the previous snapshot, e.g. after '
+                                        'moving folders', action='store_true')
+    parser.add_argument('--dedup-min-size', help='smallest file size deduplicated, e.g. 1M', type=parse_size,
+                        default=1024 * 1024)
+    parser.add_argument('--dedup-time-limit', help='seconds after which deduplication stops', type=float,
+                        default=600.0)
+    parser.add_argument('--manifest', help='write a manifest with content hashes of every new snapshot',
+                        action='store_true')
+    parser.add_argument('--catalog', help='update the file catalog of all snapshots in the state folder after the '
+                                          'backup (see find and versions)', action='store_true')
+    parser.add_argument('--no-governor', help='ignore the resource limits of the syncs given in the configs',
+                        action='store_true')
+    parser.add_argument('--progress-interval', help='seconds between progress lines of an rsync call',
+                        type=float, default=10.0)
+    parser.add_argument('--sync-timeout', help='seconds after which the sync is stopped and the backup fails '
+                                               '(not with -n)', type=float)
+    parser.add_argument('--rotation-timeout', help='seconds after which the rotation is stopped and the backup fails '
+                                                   '(not with -n)', type=float)
+    parser.add_argument('--reap', help='delete expired snapshots during and after the backup', action='store_true')
+    add_reaper_arguments(parser)
+    parser.epilog = 'further commands: {commands} (see multilevel-backup <command> -h)'.format(
+        commands=', '.join(name for name in commands if name != 'backup'))
+
+
+def create_manager(conf_file, args):
+    state_dir = None if args.no_ledger else args.state_dir
+    return DefaultSnapshotManager.create_from_rsnapshot_conf(conf_file, state_dir=state_dir, read_only=args.dry_run,
+                                                             min_gaps=dict(args.min_gap))
+
+
+def create_governor(conf_file, manager, args):
+    """
+    Create resource governor from the `#mlb governor_*` directives of a config.
+
+    :return Governor or None if the config has no directives
+    :rtype multilevelbackup.governor.ResourceGovernor
+    """
+    if args.no_governor:
+        return None
+
+    with open(conf_file, 'r') as config:
+        policy = GovernorPolicy.from_directives(directives_from_config(config.read()))
+    if policy is None:
+        return None
+
+    def overdue():
+        return bool(manager.overdue_levels(policy.catch_up))
+
+    return ResourceGovernor(policy, manager.backup_root, overdue=overdue if policy.catch_up else None)
+
+
+def create_executor(conf_file, args, governor=None):
+    if not args.native:
+        if args.skip_unchanged:
+            print('Note: --skip-unchanged requires -n, always syncing with rsnapshot')
+        return AsyncBackupExecutor(conf_file=conf_file, dry_run=args.dry_run, sync_workers=args.sync_workers,
+                                   governor=governor, on_progress=ProgressPrinter(args.progress_interval))
+
+    if args.sync_timeout is not None or args.rotation_timeout is not None:
+        print('Note: timeouts require rsnapshot, the steps of -n run to completion')
+
+    change_detector = ChangeDetector() if args.skip_unchanged else None
+    return NativeBackupExecutor(conf_file=conf_file, dry_run=args.dry_run, sync_workers=args.sync_workers,
+                                governor=governor, change_detector=change_detector,
+                                multiplex_ssh=not args.no_ssh_multiplex,
+                                on_progress=ProgressPrinter(args.progress_interval))
+
+
+def perform_configured_backup(manager, executor, args):
+    """
+    Perform backup with the stages, metrics and reaping given on the command line. Concurrent backups of the same
+    snapshot root are serialized, requests arriving while a backup is running and another one is queued are merged
+    into the queued one.
+
+    :return Whether a backup was performed
+    :rtype bool
+    """
+    if args.dry_run:
+        return _perform_configured_backup(manager, executor, args)
+
+    lock = RunLock(args.state_dir, manager.backup_root)
+    if not lock.acquire():
+        print('-- Backup of {root} is running and another one is queued, request merged'.format(
+            root=manager.backup_root))
+        if args.wait:
+            lock.wait()
+        return False
+
+    try:
+        # Another process may just have finished a backup
+        if manager.ledger is not None:
+            manager.ledger.invalidate()
+        manager.inventory.invalidate()
+        return _perform_configured_backup(manager, executor, args)
+    finally:
+        lock.release()
+
+
+def _perform_configured_backup(manager, executor, args):
+    metrics = None
+    if args.metrics_dir is not None and not args.dry_run:
+        metrics = MetricsExporter(args.metrics_dir, args.metrics_format)
+
+    post_sync = []
+    if args.dedup and not args.dry_run:
+        post_sync.append(DedupStage(Deduplicator(min_size=args.dedup_min_size, time_limit=args.dedup_time_limit)))
+    if args.manifest and not args.dry_run:
+        post_sync.append(ManifestStage())
+
+    timeouts = {}
+    if args.sync_timeout is not None:
+        timeouts['sync'] = args.sync_timeout
+    if args.rotation_timeout is not None:
+        timeouts['rotation'] = args.rotation_timeout
+
+    def reap(manager):
+        # On a thread of its own, the executor thread is reused for the metrics export
+        run_lowered(Reaper(manager.backup_root, workers=args.reap_workers).reap, args.ionice_class, args.nice)
+
+    # Reaping runs twice: trash of earlier runs is deleted during the rotation, which moves the snapshots it expires
+    # into new trash folders only while it runs, so those are deleted by a second pass afterwards
+    background = [reap] if args.reap and not args.dry_run else []
+    report = run_sync(perform_backup_async(manager=manager, executor=executor, metrics=metrics, post_sync=post_sync,
+                                           background=background, timeouts=timeouts))
+
+    if report.performed:
+        print('\n-- Report')
+        print(report.format())
+
+    if args.catalog and report.performed and not args.dry_run:
+        with Catalog(Catalog.file_for_root(args.state_dir, manager.backup_root)) as catalog:
+            update = catalog.update(manager.backup_root, manager.intervals, on_scan=print_cataloging)
+        print('-- Catalog: {scanned} snapshot(s) scanned, {relabeled} relabeled, {removed} removed'.format(
+            **update._asdict()))
+
+    if args.reap and report.performed and not args.dry_run:
+        # The process may continue with further backups, which must not inherit the lowered priority
+        reap(manager)
+    return report.performed
+
+
+def backup_config(conf_file, args):
+    """
+    Perform backup of a single config file.
+
+    :return Whether a backup was performed
+    :rtype bool
+    """
+    manager = create_manager(conf_file, args)
+    executor = create_executor(conf_file, args, create_governor(conf_file, manager, args))
+    return perform_configured_backup(manager, executor, args)
+
+
+def run_backup(args):
+    config_files = configs_from_paths(args.config_file)
+
+    if len(config_files) == 1:
+        backup_config(config_files[0], args)
+        return 0
+
+    scheduler = BackupScheduler(max_jobs=args.jobs, jobs_per_device=args.jobs_per_device)
+    results = scheduler.run(config_files, backup_config, args)
+
+    print('\n-- Summary')
+    print(format_summary(results))
+    return 1 if any(result.outcome == result.failed for result in results) else 0
+
+
+#
+# Daemon command
+#
+
+
+def build_daemon_parser(parser):
+    build_backup_parser(parser)
+    parser.description = 'Run backups as soon as a snapshot root becomes available (e.g. a drive is plugged in) and ' \
+                         'a level is due.'
+    parser.epilog = None
+    parser.add_argument('--interval', help='seconds between regular checks besides mount changes', type=float,
+                        default=3600.0)
+
+
+def run_daemon(args):
+    targets = []
+    for conf_file in configs_from_paths(args.config_file):
+        manager = create_manager(conf_file, args)
+        executor = create_executor(conf_file, args, create_governor(conf_file, manager, args))
+        targets.append(DaemonTarget(conf_file, manager, executor))
+    daemon = BackupDaemon(targets, lambda target: perform_configured_backup(target.manager, target.executor, args),
+                          interval=args.interval)
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        for signal_number in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signal_number, daemon.stop)
+        print('-- Watching {count} snapshot root(s)'.format(count=len(targets)))
+        loop.run_until_complete(daemon.serve())
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
+    return 0
+
+
+#
+# Reap command
+#
+
+
+def build_reap_parser(parser):
+    parser.description = 'Delete expired snapshots left in the trash of the snapshot roots.'
+    add_config_argument(parser)
+    add_reaper_arguments(parser)
+
+
+def run_reap(args):
+    lower_priority(args.ionice_class, args.nice)
+
+    for conf_file in configs_from_paths(args.config_file):
+        reaper = Reaper(snapshot_root_of(conf_file), workers=args.reap_workers)
+        snapshots, files = reaper.reap()
+        print('Deleted {snapshots} expired snapshot(s) with {files} file(s) from {root}'.format(
+            snapshots=snapshots, files=files, root=reaper.snapshot_root))
+    return 0
+
+
+#
+# Usage command
+#
+
+
+def build_usage_parser(parser):
+    parser.description = 'Show unique and shared bytes of every snapshot, taking hardlinks into account.'
+    add_config_argument(parser)
+    parser.add_argument('-s', '--state-dir', help='local folder for cached snapshot scans', default=default_state_dir())
+    parser.add_argument('--no-cache', help='walk all snapshots instead of reusing cached scans', action='store_true')
+    parser.add_argument('--scan-workers', help='number of threads walking a snapshot', type=int, default=8)
+
+
+def run_usage(args):
+    for conf_file in configs_from_paths(args.config_file):
+        with open(conf_file, 'r') as config_file:
+            config = config_file.read()
+        snapshot_root = backup_root_from_config(config)
+
+        cache = None
+        if not args.no_cache:
+            cache = ScanCache(ScanCache.folder_for_root(args.state_dir, snapshot_root))
+        index = build_usage_index(snapshot_root, intervals_from_config(config), cache=cache, workers=args.scan_workers)
+
+        print('-- Usage of {root}'.format(root=snapshot_root))
+        print(format_usage(index))
+    return 0
+
+
+#
+# Diff command
+#
+
+
+def build_diff_parser(parser):
+    parser.description = 'Show paths added, removed or modified between two snapshots.'
+    parser.add_argument('-c', '--config-file', help='config file for rsnapshot to resolve snapshot names, without it '
+                                                    'snapshots are paths')
+    parser.add_argument('--summary', help='only show number of changes and their bytes', action='store_true')
+    parser.add_argument('old', help='older snapshot, e.g. daily.1')
+    parser.add_argument('new', help='newer snapshot, e.g. daily.0')
+
+
+def run_diff(args):
+    snapshot_root = snapshot_root_of(args.config_file) if args.config_file is not None else ''
+    changes = diff_trees(os.path.join(snapshot_root, args.old), os.path.join(snapshot_root, args.new))
+
+    if args.summary:
+        print(DiffSummary.of(changes).format())
+    else:
+        for entry in changes:
+            print(format_entry(entry))
+    return 0
+
+
+#
+# Verify command
+#
+
+
+def build_verify_parser(parser):
+    parser.description = 'Re-hash the files of a snapshot and compare them with its manifest.'
+    parser.add_argument('-c', '--config-file', help='config file for rsnapshot to resolve snapshot names, without it '
+                                                    'snapshots are paths')
+    parser.add_argument('-s', '--state-dir', help='local folder for the verification checkpoint',
+                        default=default_state_dir())
+    parser.add_argument('-w', '--workers', help='number of processes hashing files', type=int, default=4)
+    parser.add_argument('--rate', help='maximum bytes read per second, e.g. 50M', type=parse_size)
+    parser.add_argument('--restart', help='ignore the checkpoint of an interrupted verification', action='store_true')
+    parser.add_argument('snapshot', help='snapshot to verify, e.g. monthly.2', nargs='+')
+
+
+def run_verify(args):
+    snapshot_root = snapshot_root_of(args.config_file) if args.config_file is not None else ''
+    failed = False
+
+    for name in args.snapshot:
+        snapshot = os.path.join(snapshot_root, name)
+        manifest_file = os.path.join(snapshot, MANIFEST_FILE)
+        if not os.path.isfile(manifest_file):
+            print('{name}: no manifest found'.format(name=name))
+            failed = True
+            continue
+
+        checkpoint = VerifyCheckpoint(args.state_dir, manifest_file)
+        if not args.restart:
+            checkpoint.load()
+        if checkpoint.position:
+            print('-- Resuming verification of {name} at file {position}'.format(name=name,
+                                                                                 position=checkpoint.position))
+
+        total, failures = verify_snapshot(snapshot, workers=args.workers, rate=args.rate, checkpoint=checkpoint)
+        for failure in failures:
+            print('{reason:<8} {path}'.format(reason=failure.reason, path=failure.path))
+        print('{name}: {total} files verified, {failed} failed'.format(name=name, total=total, failed=len(failures)))
+        failed = failed or bool(failures)
+    return 1 if failed else 0
+
+
+#
+# Restore command
+#
+
+
+def build_restore_parser(parser):
+    parser.description = 'Restore a file or folder of a snapshot with metadata and hardlinks.'
+    parser.add_argument('-c', '--config-file', help='config file for rsnapshot to resolve snapshot names, without it '
+                                                    'snapshots are paths')
+    parser.add_argument('-w', '--workers', help='number of threads copying files', type=int, default=8)
+    parser.add_argument('--progress-interval', help='seconds between progress lines', type=float, default=2.0)
+    parser.add_argument('snapshot', help='snapshot to restore from, e.g. daily.3')
+    parser.add_argument('path', help='path within the snapshot, e.g. localhost/home/user')
+    parser.add_argument('destination', help='path to restore to, files already restored identically are skipped')
+
+
+def run_restore(args):
+    snapshot_root = snapshot_root_of(args.config_file) if args.config_file is not None else ''
+    source = os.path.join(snapshot_root, args.snapshot, args.path.lstrip('/'))
+    if not os.path.lexists(source):
+        print('{path}: not found in {snapshot}'.format(path=args.path, snapshot=args.snapshot))
+        return 1
+
+    progress = restore_tree(source, args.destination, workers=args.workers, progress_interval=args.progress_interval)
+    print('Restored {files} files with {bytes} bytes to {destination}, {linked} hardlinks, {skipped} files already '
+          'restored'.format(files=progress.files - progress.skipped, bytes=progress.bytes, linked=progress.linked,
+                            skipped=progress.skipped, destination=args.destination))
+    return 0
+
+
+#
+# Find and versions commands
+#
+
+
+def add_catalog_arguments(parser):
+    parser.add_argument('-c', '--config-file', help='config file for rsnapshot of the snapshot root', required=True)
+    parser.add_argument('-s', '--state-dir', help='local folder of the catalog', default=default_state_dir())
+    parser.add_argument('--update', help='update the catalog before the lookup, walking new snapshots',
+                        action='store_true')
+
+
+def print_cataloging(name):
+    print('-- Cataloging {name}'.format(name=name))
+
+
+def open_catalog(args):
+    """
+    Open catalog of the snapshot root of a config, updating it if requested.
+
+    :return Catalog or None if it is empty
+    :rtype multilevelbackup.catalog.Catalog
+    """
+    with open(args.config_file, 'r') as config_file:
+        config = config_file.read()
+    snapshot_root = backup_root_from_config(config)
+
+    catalog = Catalog(Catalog.file_for_root(args.state_dir, snapshot_root))
+    if args.update:
+        catalog.update(snapshot_root, intervals_from_config(config), on_scan=print_cataloging)
+    if not catalog.snapshots:
+        print('Catalog of {root} is empty, back up with --catalog or pass --update'.format(root=snapshot_root))
+        catalog.close()
+        return None
+    return catalog
+
+
+def build_find_parser(parser):
+    parser.description = 'Find paths in the catalog of all snapshots and list the snapshots containing them.'
+    add_catalog_arguments(parser)
+    parser.add_argument('pattern', help='shell pattern of paths relative to the snapshots, e.g. \'*/etc/*.conf\'')
+
+
+def run_find(args):
+    catalog = open_catalog(args)
+    if catalog is None:
+        return 1
+
+    with catalog:
+        for relative, names in catalog.find(args.pattern):
+            print('{path}  {snapshots}'.format(path=relative, snapshots=' '.join(names)))
+    return 0
+
+
+def build_versions_parser(parser):
+    parser.description = 'List all versions of a path in the catalog with their modification time, size and snapshots.'
+    add_catalog_arguments(parser)
+    parser.add_argument('path', help='path relative to the snapshots or its end, e.g. /etc/hosts')
+
+
+def run_versions(args):
+    catalog = open_catalog(args)
+    if catalog is None:
+        return 1
+
+    with catalog:
+        versions = catalog.versions(args.path)
+    if not versions:
+        print('{path}: not found in any snapshot'.format(path=args.path))
+        return 1
+
+    current = None
+    for version in versions:
+        if version.path != current:
+            current = version.path
+            print('-- {path}'.format(path=current))
+        print(format_version(version))
+    return 0
+
+
+#
+# Simulate command
+#
+
+
+def build_simulate_parser(parser):
+    parser.description = 'Simulate years of backups with a virtual clock and show snapshot ages and coverage.'
+    parser.add_argument('-c', '--config-file', help='config file for rsnapshot to take the intervals from')
+    parser.add_argument('-r', '--retain', help='interval and retaining count instead of a config, e.g. daily=7',
+                        action='append', type=parse_retain, default=[])
+    parser.add_argument('-g', '--min-gap', help='minimum gap of an interval, e.g. weekly=7d or hourly=4h',
+                        action='append', type=parse_min_gap, default=[])
+    parser.add_argument('-p', '--pattern', help='uptime pattern: always, workdays, weekly, laptop or random:P, can be '
+                                                'given multiple times', action='append', type=parse_pattern)
+    parser.add_argument('--years', help='number of simulated years', type=int, default=1000)
+    parser.add_argument('--invocations-per-day', help='invocations on every day the machine is up', type=int,
+                        default=1)
+    parser.add_argument('--seed', help='seed of the random uptime patterns', type=int, default=0)
+    parser.add_argument('-w', '--workers', help='number of processes simulating random patterns', type=int,
+                        default=os.cpu_count() or 1)
+
+
+def run_simulate(args):
+    if args.config_file is not None:
+        with open(args.config_file, 'r') as config:
+            intervals = intervals_from_config(config.read())
+    else:
+        intervals = OrderedDict(args.retain) if args.retain else DEFAULT_INTERVALS
+
+    for pattern in args.pattern or ['always', 'workdays', 'laptop']:
+        result = simulate_pattern(intervals, dict(args.min_gap), pattern, args.years, args.invocations_per_day,
+                                  args.seed, workers=args.workers)
+        print(format_simulation(result))
+    return 0
+
+
+commands = OrderedDict([
+    ('backup', (build_backup_parser, run_backup)),
+    ('daemon', (build_daemon_parser, run_daemon)),
+    ('reap', (build_reap_parser, run_reap)),
+    ('usage', (build_usage_parser, run_usage)),
+    ('diff', (build_diff_parser, run_diff)),
+    ('verify', (build_verify_parser, run_verify)),
+    ('restore', (build_restore_parser, run_restore)),
+    ('find', (build_find_parser, run_find)),
+    ('versions', (build_versions_parser, run_versions)),
+    ('simulate', (build_simulate_parser, run_simulate)),
+])
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else list(argv)
+
+    # Backup is the default command, so plain `multilevel-backup -c <config>` keeps working
+    name = argv.pop(0) if argv and argv[0] in commands else 'backup'
+    prog = 'multilevel-backup' if name == 'backup' else 'multilevel-backup ' + name
+
+    build_parser, run = commands[name]
+    parser = ArgumentParser(prog=prog)
+    build_parser(parser)
+    return run(parser.parse_args(argv))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,3 +1,5 @@
+from collections import OrderedDict, namedtuple
+
 import re
 
 
@@ -21,19 +23,19 @@ def backup_root_from_config(config):
 
 def intervals_from_config(config):
     """
-    Determine intervals and their respective retaining count from rsnapshot config.
+    Determine intervals and their respective retaining count from rsnapshot config in file order.
 
     :param config: Rsnapshot config file content
     :type config: str
 
     :return Interval names and their counts
-    :rtype dict[str, int]
+    :rtype collections.OrderedDict[str, int]
     :raise ValueError: Raised if no intervals could be found
     """
 
     retain_pattern = r'^retain\t+(?P<name>\w+)\t+(?P<count>\d+)$'
 
-    intervals = {}
+    intervals = OrderedDict()
     for match in re.finditer(retain_pattern, config, re.MULTILINE):
         name = match.group('name')
         count = int(match.group('count'))
@@ -43,3 +45,82 @@ def intervals_from_config(config):
         raise ValueError('No backup intervals in rsnapshot config found')
 
     return intervals
+
+
+BackupPoint = namedtuple('BackupPoint', ['source', 'destination', 'options'])
+
+
+def backup_points_from_config(config):
+    """
+    Determine backup points (`backup` lines) from rsnapshot config.
+
+    :param config: Rsnapshot config file content
+    :type config: str
+
+    :return Backup points in file order, options are None if not given
+    :rtype list[BackupPoint]
+    """
+
+    backup_pattern = r'^backup\t+(?P<source>[^\t\n]+)\t+(?P<destination>[^\t\n]+?)(\t+(?P<options>[^\t\n]+))?\t*$'
+
+    return [BackupPoint(match.group('source'), match.group('destination'), match.group('options'))
+            for match in re.finditer(backup_pattern, config, re.MULTILINE)]
+
+
+def value_from_config(config, key):
+    """
+    Determine value of a simple `<key>\t<value>` line from rsnapshot config.
+
+    :return Value or None if key is not set
+    :rtype str
+    """
+
+    value_pattern = r'^{key}\t+(?P<value>.+?)\s*$'.format(key=re.escape(key))
+
+    match = re.search(value_pattern, config, re.MULTILINE)
+    return match.group('value') if match else None
+
+
+def values_from_config(config, key):
+    """
+    Determine values of all `<key>\t<value>` lines from rsnapshot config, e.g. for `exclude`.
+
+    :return Values in file order
+    :rtype list[str]
+    """
+
+    value_pattern = r'^{key}\t+(?P<value>.+?)\s*$'.format(key=re.escape(key))
+
+    return [match.group('value') for match in re.finditer(value_pattern, config, re.MULTILINE)]
+
+
+def directives_from_config(config):
+    """
+    Determine multilevel-backup settings from rsnapshot config. They are given as comment lines of the form
+    `#mlb\t<key>\t<value>`, so rsnapshot ignores them.
+
+    :return Keys and values
+    :rtype dict[str, str]
+    """
+
+    directive_pattern = r'^#mlb\t+(?P<key>\w+)\t+(?P<value>.+?)\s*$'
+
+    return dict((match.group('key'), match.group('value'))
+                for match in re.finditer(directive_pattern, config, re.MULTILINE))
+
+
+def options_from_string(options):
+    """
+    Split per backup point options (e.g. `exclude=/tmp,one_fs=1`) into their key and value.
+
+    :return Option keys and values in given order
+    :rtype list[(str, str)]
+    """
+    if not options:
+        return []
+
+    pairs = []
+    for option in options.split(','):
+        key, _, value = option.partition('=')
+        pairs.append((key.strip(), value.strip()))
+    return pairs
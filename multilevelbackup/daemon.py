@@ -0,0 +1,183 @@
+from os import path
+
+import asyncio
+import select
+import traceback
+
+
+class MountWatcher(object):
+    """
+    Call back on every change of the mount table.
+
+    The kernel signals changes of `/proc/self/mountinfo` with EPOLLPRI/EPOLLERR while the file is always readable, so it
+    is registered with an own epoll object for these events only, whose file descriptor is watched by the event loop.
+    """
+
+    def __init__(self, callback, mountinfo='/proc/self/mountinfo'):
+        self.callback = callback
+        self.mountinfo = mountinfo
+        self._file = None
+        self._epoll = None
+
+    def start(self, loop):
+        self._file = open(self.mountinfo, 'rb')
+        self._file.read()
+        self._epoll = select.epoll()
+        self._epoll.register(self._file.fileno(), select.EPOLLPRI | select.EPOLLERR)
+        loop.add_reader(self._epoll.fileno(), self._on_event)
+
+    def stop(self, loop):
+        if self._epoll is None:
+            return
+        loop.remove_reader(self._epoll.fileno())
+        self._epoll.close()
+        self._file.close()
+        self._epoll = self._file = None
+
+    def _on_event(self):
+        self._epoll.poll(0)
+        # Reading the table again acknowledges the change
+        self._file.seek(0)
+        self._file.read()
+        self.callback()
+
+
+class DaemonTarget(object):
+    """Snapshot root of one config with its manager and executor kept between runs."""
+
+    def __init__(self, conf_file, manager, executor):
+        """
+        :type manager: multilevelbackup.backup.DefaultSnapshotManager
+        """
+        self.conf_file = conf_file
+        self.manager = manager
+        self.executor = executor
+        # Set while the target is checked or backed up
+        self.running = False
+
+    @property
+    def snapshot_root(self):
+        return self.manager.backup_root
+
+    def is_available(self):
+        return path.isdir(self.snapshot_root)
+
+    def refresh(self):
+        """Drop cached state changed by other processes or by mounting a different device."""
+        if self.manager.ledger is not None:
+            self.manager.ledger.invalidate()
+        self.manager.inventory.revalidate()
+
+    def is_due(self):
+        return self.manager.upcoming_tasks[self.manager.levels.lowest.name]
+
+
+class BackupDaemon(object):
+    """
+    Run backups as soon as their snapshot root is available and the lowest level is due. Availability is checked after
+    every change of the mount table and regularly by a timer, e.g. for network shares mounted on demand. Checks run in
+    worker threads like the backups, so a hung mount only stalls its own target.
+    """
+
+    def __init__(self, targets, run, interval=3600.0, settle=2.0, watcher_factory=MountWatcher):
+        """
+        :type targets: list[DaemonTarget]
+        :param run: Called with a target to perform its backup, runs in a worker thread
+        :param interval: Seconds between regular checks
+        :param settle: Seconds to wait after a mount change before checking, so mounting can finish
+        """
+        self.targets = targets
+        self.run = run
+        self.interval = interval
+        self.settle = settle
+        self.watcher = watcher_factory(self._mounts_changed)
+        self._wakeup = None
+        self._stopped = None
+        self._mount_change = False
+        self._jobs = set()
+
+    def _mounts_changed(self):
+        self._mount_change = True
+        self._wakeup.set()
+
+    def stop(self):
+        self._stopped.set()
+        self._wakeup.set()
+
+    @staticmethod
+    def _probe(target):
+        """
+        Check whether a target is available and its lowest level is due, runs in a worker thread since scanning a slow
+        or hung mount blocks.
+
+        :type target: DaemonTarget
+        :rtype bool
+        """
+        if not target.is_available():
+            return False
+        try:
+            target.refresh()
+            return target.is_due()
+        except OSError as error:
+            # Device vanished while checking
+            print('-- Cannot check {root}: {error}'.format(root=target.snapshot_root, error=error))
+            return False
+
+    async def _run_target(self, target):
+        loop = asyncio.get_running_loop()
+        target.running = True
+        try:
+            if not await loop.run_in_executor(None, self._probe, target):
+                return
+            print('-- Starting backup of {root}'.format(root=target.snapshot_root))
+            await loop.run_in_executor(None, self.run, target)
+        except Exception:
+            print('-- Backup of {conf} failed'.format(conf=target.conf_file))
+            traceback.print_exc()
+        finally:
+            target.running = False
+
+    def check(self):
+        """
+        Check all targets that are not checked or backed up already in worker threads, and start the backups of the
+        available ones with a due level.
+
+        :return Targets checked
+        :rtype list[DaemonTarget]
+        """
+        checked = []
+        for target in self.targets:
+            if target.running:
+                continue
+            job = asyncio.ensure_future(self._run_target(target))
+            self._jobs.add(job)
+            job.add_done_callback(self._jobs.discard)
+            checked.append(target)
+        return checked
+
+    async def serve(self):
+        """Watch and run backups until :meth:`stop` is called."""
+        loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        self._stopped = asyncio.Event()
+        self.watcher.start(loop)
+        try:
+            self.check()
+            while not self._stopped.is_set():
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=self.interval)
+                except asyncio.TimeoutError:
+                    pass
+                if self._stopped.is_set():
+                    break
+
+                if self._mount_change:
+                    await asyncio.sleep(self.settle)
+                self._wakeup.clear()
+                self._mount_change = False
+                self.check()
+
+            if self._jobs:
+                await asyncio.wait(list(self._jobs))
+        finally:
+            self.watcher.stop(loop)
@@ -0,0 +1,132 @@
+from collections import namedtuple, OrderedDict
+from os import path
+
+import heapq
+import os
+import time
+
+from .manifest import hash_file, walk_files
+from .report import StepReport
+from .rotation import SYNC_FOLDER
+
+DedupResult = namedtuple('DedupResult', ['candidates', 'files', 'reclaimed_bytes', 'complete'])
+
+
+def _key(info):
+    """Attributes two files must share to be hardlinked without changing the snapshot."""
+    return info.st_size, info.st_mtime_ns, info.st_mode, info.st_uid, info.st_gid
+
+
+def _replace_with_link(source, target):
+    """Replace target atomically by a hardlink to source."""
+    temp_name = path.join(path.dirname(target), b'.' + path.basename(target) + b'.dedup')
+    os.link(source, temp_name)
+    try:
+        os.replace(temp_name, target)
+    except OSError:
+        os.unlink(temp_name)
+        raise
+
+
+class Deduplicator(object):
+    """
+    Replace new files of a snapshot by hardlinks to identical files of the previous snapshot, e.g. after a folder was
+    moved or renamed, which rsync's `--link-dest` cannot detect.
+
+    New files are files with a single link. At most `max_candidates` of them (the largest ones) are considered, and
+    only files of the previous snapshot with the same size, modification time, mode and owner are remembered, so memory
+    is bounded by the number of candidates. Contents are compared by hash, and only of files matching by attributes.
+    """
+
+    def __init__(self, min_size=1024 * 1024, max_candidates=100000, max_matches=4, time_limit=600.0,
+                 clock=time.monotonic):
+        """
+        :param min_size: Smallest file size considered in bytes
+        :param max_matches: Files of the previous snapshot remembered per attribute combination
+        :param time_limit: Seconds after which deduplication stops
+        """
+        self.min_size = min_size
+        self.max_candidates = max_candidates
+        self.max_matches = max_matches
+        self.time_limit = time_limit
+        self.clock = clock
+
+    def _candidates(self, snapshot):
+        new_files = ((info.st_size, relative, info) for relative, info in walk_files(snapshot)
+                     if info.st_nlink == 1 and info.st_size >= self.min_size)
+        return heapq.nlargest(self.max_candidates, new_files)
+
+    def _matches(self, previous, keys, deadline):
+        matches = {}
+        for relative, info in walk_files(previous):
+            if self.clock() > deadline:
+                break
+            key = _key(info)
+            if key not in keys:
+                continue
+            files = matches.setdefault(key, OrderedDict())
+            if info.st_ino not in files and len(files) < self.max_matches:
+                files[info.st_ino] = path.join(os.fsencode(previous), relative)
+        return matches
+
+    def deduplicate(self, snapshot, previous):
+        """
+        :param snapshot: New snapshot, e.g. the sync folder
+        :param previous: Previous snapshot
+        :rtype DedupResult
+        """
+        deadline = self.clock() + self.time_limit
+        if not path.isdir(previous):
+            return DedupResult(0, 0, 0, True)
+
+        candidates = self._candidates(snapshot)
+        matches = self._matches(previous, set(_key(info) for _, _, info in candidates), deadline)
+
+        digests = {}
+        files = reclaimed = 0
+        for size, relative, info in candidates:
+            if self.clock() > deadline:
+                return DedupResult(len(candidates), files, reclaimed, False)
+            sources = matches.get(_key(info))
+            if not sources:
+                continue
+
+            target = path.join(os.fsencode(snapshot), relative)
+            digest = hash_file(target)
+            for inode, source in sources.items():
+                if inode not in digests:
+                    digests[inode] = hash_file(source)
+                if digests[inode] == digest:
+                    try:
+                        _replace_with_link(source, target)
+                    except OSError as error:
+                        print('Note: cannot link {target}: {error}'.format(target=os.fsdecode(target), error=error))
+                        break
+                    files += 1
+                    reclaimed += size
+                    break
+        return DedupResult(len(candidates), files, reclaimed, True)
+
+
+class DedupStage(object):
+    """Post-sync stage hardlinking new files of the sync folder to identical files of the newest snapshot."""
+
+    name = 'dedup'
+
+    def __init__(self, deduplicator=None):
+        self.deduplicator = deduplicator if deduplicator is not None else Deduplicator()
+
+    def __call__(self, manager):
+        """
+        :type manager: multilevelbackup.backup.DefaultSnapshotManager
+        :rtype multilevelbackup.report.StepReport
+        """
+        start = time.monotonic()
+        result = self.deduplicator.deduplicate(path.join(manager.backup_root, SYNC_FOLDER),
+                                               manager.first_snapshot(manager.levels.lowest.name))
+
+        print('-- Deduplicated {files} of {candidates} new files, {size} bytes reclaimed{note}'.format(
+            files=result.files, candidates=result.candidates, size=result.reclaimed_bytes,
+            note='' if result.complete else ' (time limit reached)'))
+        return StepReport(self.name, time.monotonic() - start,
+                          counters=OrderedDict([('files', result.files), ('reclaimed_bytes', result.reclaimed_bytes)]))
@@ -0,0 +1,146 @@
+from collections import namedtuple, OrderedDict
+from os import path
+
+import os
+import stat
+
+ADDED = '+'
+REMOVED = '-'
+MODIFIED = 'M'
+
+DiffEntry = namedtuple('DiffEntry', ['change', 'path', 'size'])
+
+
+def _entries(folder):
+    """
+    Entries of a folder sorted by name with their stat results.
+
+    :rtype list[(str, os.stat_result)]
+    """
+    try:
+        with os.scandir(folder) as iterator:
+            entries = [(entry.name, entry.stat(follow_symlinks=False)) for entry in iterator]
+    except FileNotFoundError:
+        return []
+    entries.sort()
+    return entries
+
+
+def _walk_all(change, folder, relative):
+    """Emit every entry below a folder as added or removed."""
+    for name, info in _entries(folder):
+        yield from _single(change, folder, relative, name, info)
+
+
+def _is_unchanged(old, new, old_path, new_path):
+    if (old.st_dev, old.st_ino) == (new.st_dev, new.st_ino):
+        return True
+    # Symlinks are not necessarily hardlinked, compare their targets instead
+    if stat.S_ISLNK(old.st_mode) and stat.S_ISLNK(new.st_mode):
+        return os.readlink(old_path) == os.readlink(new_path)
+    return False
+
+
+def _diff_folders(old_folder, new_folder, relative):
+    old_entries = _entries(old_folder)
+    new_entries = _entries(new_folder)
+    old_position = new_position = 0
+
+    while old_position < len(old_entries) or new_position < len(new_entries):
+        old_name = old_entries[old_position][0] if old_position < len(old_entries) else None
+        new_name = new_entries[new_position][0] if new_position < len(new_entries) else None
+
+        if new_name is None or (old_name is not None and old_name < new_name):
+            yield from _removed(old_folder, relative, *old_entries[old_position])
+            old_position += 1
+        elif old_name is None or new_name < old_name:
+            yield from _added(new_folder, relative, *new_entries[new_position])
+            new_position += 1
+        else:
+            old_info = old_entries[old_position][1]
+            new_info = new_entries[new_position][1]
+            old_path = path.join(old_folder, old_name)
+            new_path = path.join(new_folder, new_name)
+            old_position += 1
+            new_position += 1
+
+            old_is_dir = stat.S_ISDIR(old_info.st_mode)
+            new_is_dir = stat.S_ISDIR(new_info.st_mode)
+            if old_is_dir and new_is_dir:
+                yield from _diff_folders(old_path, new_path, relative + new_name + '/')
+            elif old_is_dir or new_is_dir:
+                yield from _removed(old_folder, relative, old_name, old_info)
+                yield from _added(new_folder, relative, new_name, new_info)
+            elif not _is_unchanged(old_info, new_info, old_path, new_path):
+                yield DiffEntry(MODIFIED, relative + new_name, new_info.st_size)
+
+
+def _added(folder, relative, name, info):
+    return _single(ADDED, folder, relative, name, info)
+
+
+def _removed(folder, relative, name, info):
+    return _single(REMOVED, folder, relative, name, info)
+
+
+def _single(change, folder, relative, name, info):
+    if stat.S_ISDIR(info.st_mode):
+        yield DiffEntry(change, relative + name + '/', 0)
+        yield from _walk_all(change, path.join(folder, name), relative + name + '/')
+    else:
+        yield DiffEntry(change, relative + name, info.st_size)
+
+
+def diff_trees(old, new):
+    """
+    Compare two folder trees, usually two snapshots, by walking both in lockstep. Files with the same device and inode
+    (hardlinked by rsync) are unchanged, all other files with the same path are modified. File contents are never read.
+
+    Changes are generated in path order, only the entries of the currently compared folders are held in memory.
+    Folders are reported with a trailing slash.
+
+    :param old: Older tree
+    :param new: Newer tree
+    :rtype collections.Iterable[DiffEntry]
+    :raise ValueError: Raised if one of the trees does not exist
+    """
+    for folder in (old, new):
+        if not path.isdir(folder):
+            raise ValueError('Folder {folder} does not exist'.format(folder=folder))
+    return _diff_folders(old, new, '')
+
+
+class DiffSummary(object):
+    """Number of changed entries and their bytes per kind of change."""
+
+    labels = OrderedDict([(ADDED, 'added'), (REMOVED, 'removed'), (MODIFIED, 'modified')])
+
+    def __init__(self):
+        self.counts = OrderedDict((change, 0) for change in self.labels)
+        self.bytes = OrderedDict((change, 0) for change in self.labels)
+
+    def add(self, entry):
+        self.counts[entry.change] += 1
+        self.bytes[entry.change] += entry.size
+
+    @staticmethod
+    def of(entries):
+        """
+        Summarize changes.
+
+        :type entries: collections.Iterable[DiffEntry]
+        :rtype DiffSummary
+        """
+        summary = DiffSummary()
+        for entry in entries:
+            summary.add(entry)
+        return summary
+
+    def format(self):
+        return '\n'.join('{label:<9} {count:>12} entries {size:>16} bytes'.format(
+            label=label + ':', count=self.counts[change], size=self.bytes[change])
+            for change, label in self.labels.items())
+
+
+def format_entry(entry):
+    return '{change} {path}'.format(change=entry.change, path=entry.path)
@@ -0,0 +1,124 @@
+from os import path
+
+import hashlib
+import json
+import os
+import shutil
+import stat
+import threading
+
+from .helpers import atomic_write
+from .sync import source_host
+
+FINGERPRINT_FILE = '.fingerprints'
+
+
+def tree_fingerprint(folder, digest=None):
+    """
+    Summarize the metadata of a folder tree without reading any file content.
+
+    Every entry contributes its name, type, mode, owner, size, inode and modification and change time. Changing the
+    content of a file updates its modification time, and the change time catches everything else, including files
+    with a restored modification time. Entries are fed in sorted order, so the result only depends on the tree.
+
+    :param digest: Hash object to update or None to create one
+    :return Hash object
+    """
+    digest = digest if digest is not None else hashlib.blake2b(digest_size=32)
+    with os.scandir(os.fsencode(folder)) as iterator:
+        entries = sorted(iterator, key=lambda entry: entry.name)
+
+    for entry in entries:
+        info = entry.stat(follow_symlinks=False)
+        digest.update(entry.name + b'\0')
+        digest.update('{mode} {uid} {gid} {size} {ino} {mtime} {ctime}\n'.format(
+            mode=info.st_mode, uid=info.st_uid, gid=info.st_gid, size=info.st_size, ino=info.st_ino,
+            mtime=info.st_mtime_ns, ctime=info.st_ctime_ns).encode())
+        if stat.S_ISDIR(info.st_mode):
+            tree_fingerprint(entry.path, digest)
+        digest.update(b'/\n')
+    return digest
+
+
+def clone_tree(source, target):
+    """
+    Clone a folder tree by hardlinking all files, like `cp -al`. Folders are created with the metadata of the source.
+
+    :return Number of linked entries
+    :rtype int
+    """
+    os.mkdir(target)
+    linked = 0
+    with os.scandir(source) as iterator:
+        for entry in iterator:
+            target_entry = path.join(target, entry.name)
+            if entry.is_dir(follow_symlinks=False):
+                linked += clone_tree(entry.path, target_entry)
+            else:
+                os.link(entry.path, target_entry, follow_symlinks=False)
+                linked += 1
+
+    # Creating entries changed the modification time
+    shutil.copystat(source, target, follow_symlinks=False)
+    info = os.lstat(source)
+    try:
+        os.chown(target, info.st_uid, info.st_gid)
+    except PermissionError:
+        pass
+    return linked
+
+
+class ChangeDetector(object):
+    """
+    Detect backup point destinations whose local sources did not change since the previous snapshot.
+
+    After syncing a destination, the fingerprint of its sources and rsync settings is recorded in the
+    `.fingerprints` file of the snapshot. If the fingerprint is still the same before the next sync, the destination
+    of the previous snapshot is cloned by hardlinks instead of letting rsync compare every file. Destinations with
+    remote sources are always synced.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+
+    def fingerprint(self, points, settings):
+        """
+        Fingerprint all sources of a destination.
+
+        :type points: list[multilevelbackup.config.BackupPoint]
+        :param settings: rsync settings the destination is synced with, e.g. arguments and filters
+        :return Hex digest or None if a source is remote or cannot be walked
+        :rtype str
+        """
+        digest = hashlib.blake2b(digest_size=32)
+        digest.update(json.dumps(settings).encode())
+        for point in points:
+            if source_host(point.source) is not None:
+                return None
+            try:
+                info = os.lstat(point.source)
+                digest.update(json.dumps([point.source, point.options, info.st_mode, info.st_uid, info.st_gid,
+                                          info.st_mtime_ns, info.st_ctime_ns]).encode())
+                tree_fingerprint(point.source, digest)
+            except OSError:
+                return None
+        return digest.hexdigest()
+
+    @staticmethod
+    def recorded(snapshot):
+        """
+        :return Fingerprints of the destinations of a snapshot
+        :rtype dict[str, str]
+        """
+        try:
+            with open(path.join(snapshot, FINGERPRINT_FILE), 'r') as fingerprints:
+                recorded = json.load(fingerprints)
+        except (OSError, ValueError):
+            return {}
+        return recorded if isinstance(recorded, dict) else {}
+
+    def record(self, snapshot, destination, fingerprint):
+        with self._lock:
+            fingerprints = self.recorded(snapshot)
+            fingerprints[destination] = fingerprint
+            atomic_write(path.join(snapshot, FINGERPRINT_FILE), json.dumps(fingerprints, sort_keys=True))
@@ -0,0 +1,372 @@
+from os import path
+
+import os
+import re
+import shutil
+import subprocess
+import threading
+
+from .helpers import parse_size
+from .reaper import IO_CLASSES
+
+DIRECTIVE_PREFIX = 'governor_'
+
+# cgroup v2 period of cpu.max in microseconds
+_cpu_period = 100000
+
+_pressure_pattern = re.compile(r'^some avg10=(?P<avg10>[\d.]+)', re.MULTILINE)
+
+
+class GovernorPolicy(object):
+    """
+    Resource limits of the syncs of one config, given as `#mlb governor_<key> <value>` directives in the rsnapshot
+    config (see :func:`multilevelbackup.config.directives_from_config`).
+    """
+
+    def __init__(self, io_class=None, nice=0, bwlimit=None, io_max=None, cpu_max=None, pressure_high=20.0,
+                 pressure_low=5.0, load_high=None, catch_up=2.0):
+        """
+        :param io_class: I/O scheduling class (`idle` or `best-effort`) or None to keep it
+        :param nice: Niceness of the sync processes
+        :param bwlimit: Transfer rate of rsync in bytes per second
+        :param io_max: Read and write rate on the snapshot root device in bytes per second (cgroup v2)
+        :param cpu_max: Number of CPUs the syncs may use, e.g. 0.5 (cgroup v2)
+        :param pressure_high: I/O pressure (percentage of time stalled over 10 seconds) at which syncs are throttled
+        :param pressure_low: I/O pressure below which throttling ends
+        :param load_high: Load average per CPU at which syncs are throttled or None to ignore the load
+        :param catch_up: Lift all limits if a level is due for this multiple of its minimum gap, 0 to never lift them
+        """
+        self.io_class = io_class
+        self.nice = nice
+        self.bwlimit = bwlimit
+        self.io_max = io_max
+        self.cpu_max = cpu_max
+        self.pressure_high = pressure_high
+        self.pressure_low = pressure_low
+        self.load_high = load_high
+        self.catch_up = catch_up
+
+    _parsers = {
+        'io_class': str,
+        'nice': int,
+        'bwlimit': parse_size,
+        'io_max': parse_size,
+        'cpu_max': float,
+        'pressure_high': float,
+        'pressure_low': float,
+        'load_high': float,
+        'catch_up': float,
+    }
+
+    @staticmethod
+    def from_directives(directives):
+        """
+        Create policy from config directives.
+
+        :type directives: dict[str, str]
+        :return Policy or None if the config has no governor directives
+        :rtype GovernorPolicy
+        :raise ValueError: Raised if a directive is unknown or malformed
+        """
+        values = dict((key[len(DIRECTIVE_PREFIX):], value) for key, value in directives.items()
+                      if key.startswith(DIRECTIVE_PREFIX))
+        if not values:
+            return None
+
+        arguments = {}
+        for key, value in values.items():
+            if key not in GovernorPolicy._parsers:
+                raise ValueError('Unknown governor directive \'{key}\''.format(key=DIRECTIVE_PREFIX + key))
+            arguments[key] = GovernorPolicy._parsers[key](value)
+
+        if arguments.get('io_class') not in (None,) + tuple(IO_CLASSES):
+            raise ValueError('Invalid I/O class \'{io_class}\', expected one of {classes}'.format(
+                io_class=arguments['io_class'], classes=', '.join(sorted(IO_CLASSES))))
+        return GovernorPolicy(**arguments)
+
+
+def block_device(folder, sys_root='/sys'):
+    """
+    Determine the block device of a folder as `major:minor`, the whole disk for partitions since io.max cannot limit
+    partitions.
+
+    :rtype str
+    """
+    device = os.stat(folder).st_dev
+    name = '{major}:{minor}'.format(major=os.major(device), minor=os.minor(device))
+
+    sys_device = path.join(sys_root, 'dev', 'block', name)
+    if path.exists(path.join(sys_device, 'partition')):
+        with open(path.join(path.realpath(sys_device), '..', 'dev'), 'r') as parent:
+            return parent.read().strip()
+    return name
+
+
+class ResourceGovernor(object):
+    """
+    Limit the resources of the syncs of one snapshot root and adapt the limits to the load of the host.
+
+    Sync commands are started with `ionice`/`nice` and rsync's `--bwlimit`, and moved into a cgroup with `io.max` and
+    `cpu.max` limits if cgroup v2 is delegated to the user. While the syncs run, a thread checks the I/O pressure (PSI)
+    and the load average: above the high thresholds, the sync processes are moved to the idle I/O class, reniced to 19
+    if running as root and their cgroup I/O limit is quartered, until the pressure drops below the low threshold
+    again.
+
+    If a level is overdue, e.g. because the backup device was not available for a long time, the backup catches up
+    without any limits.
+    """
+
+    def __init__(self, policy, snapshot_root, overdue=None, interval=5.0, proc_root='/proc',
+                 cgroup_root='/sys/fs/cgroup', sys_root='/sys'):
+        """
+        :type policy: GovernorPolicy
+        :param overdue: Returns whether a level is overdue or None to never catch up
+        :param interval: Seconds between checks of the system pressure
+        """
+        self.policy = policy
+        self.snapshot_root = snapshot_root
+        self.overdue = overdue
+        self.interval = interval
+        self.proc_root = proc_root
+        self.cgroup_root = cgroup_root
+        self.sys_root = sys_root
+
+        # Only root may lower the niceness again after the pressure is relieved, so unprivileged syncs are throttled
+        # by their I/O class and cgroup limit only
+        self.renice = os.geteuid() == 0
+        self.active = True
+        self.throttled = False
+        self.cgroup = None
+        self._processes = set()
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._monitor = None
+
+    def start(self):
+        """Start governing the syncs of a backup."""
+        self.active = not (self.overdue is not None and self.overdue())
+        self.throttled = False
+        if not self.active:
+            print('-- Levels overdue, catching up without resource limits')
+            return
+
+        self.cgroup = self._create_cgroup()
+        self._stopped.clear()
+        self._monitor = threading.Thread(target=self._watch, name='governor', daemon=True)
+        self._monitor.start()
+
+    def stop(self):
+        if self._monitor is not None:
+            self._stopped.set()
+            self._monitor.join()
+            self._monitor = None
+
+        if self.cgroup is not None:
+            try:
+                os.rmdir(self.cgroup)
+            except OSError as error:
+                print('Note: cannot remove cgroup {cgroup}: {error}'.format(cgroup=self.cgroup, error=error))
+            self.cgroup = None
+
+    def command_prefix(self):
+        """
+        Arguments to run a sync command with, e.g. `ionice -c 3 nice -n 10`.
+
+        :rtype list[str]
+        """
+        prefix = []
+        if not self.active:
+            return prefix
+
+        if self.policy.io_class is not None and shutil.which('ionice') is not None:
+            prefix.extend(['ionice', '-c', IO_CLASSES[self.policy.io_class]])
+        if self.policy.nice and shutil.which('nice') is not None:
+            prefix.extend(['nice', '-n', str(self.policy.nice)])
+        return prefix
+
+    def rsync_args(self):
+        """:rtype list[str]"""
+        if not self.active or self.policy.bwlimit is None:
+            return []
+        # rsync expects KiB per second
+        return ['--bwlimit={rate}'.format(rate=max(self.policy.bwlimit // 1024, 1))]
+
+    def attach(self, process):
+        """
+        Govern a started sync process, passed as `on_start` to :func:`multilevelbackup.process.run_command` or
+        :func:`multilevelbackup.process.run_command_async`.
+
+        :type process: subprocess.Popen|asyncio.subprocess.Process
+        """
+        if not self.active:
+            return
+
+        if self.cgroup is not None:
+            try:
+                self._write(path.join(self.cgroup, 'cgroup.procs'), str(process.pid))
+            except OSError as error:
+                print('Note: cannot move sync into cgroup: {error}'.format(error=error))
+
+        with self._lock:
+            self._processes.add(process)
+            if self.throttled:
+                self._prioritize(process.pid, True)
+
+    @staticmethod
+    def _write(file_name, value):
+        with open(file_name, 'w') as control:
+            control.write(value)
+
+    def _create_cgroup(self):
+        """
+        Create a child cgroup of the current one with the I/O and CPU limits of the policy.
+
+        :return Path of the cgroup or None if no limits are set or cgroup v2 is not available
+        """
+        if self.policy.io_max is None and self.policy.cpu_max is None:
+            return None
+
+        cgroup = None
+        try:
+            with open(path.join(self.proc_root, 'self', 'cgroup'), 'r') as cgroups:
+                relative = next(line[3:].strip() for line in cgroups if line.startswith('0::'))
+            parent = path.join(self.cgroup_root, relative.lstrip('/'))
+            try:
+                self._write(path.join(parent, 'cgroup.subtree_control'), '+io +cpu')
+            except OSError as error:
+                # cgroup v2 refuses to enable controllers for children of a cgroup with processes of its own, which
+                # is the normal case for a user session or service, unless they are enabled already
+                with open(path.join(parent, 'cgroup.subtree_control'), 'r') as control:
+                    enabled = control.read().split()
+                limits = (('io', self.policy.io_max), ('cpu', self.policy.cpu_max))
+                missing = [name for name, limit in limits if limit is not None and name not in enabled]
+                if missing:
+                    print('Warning: cannot enable {controllers} controller of cgroup {parent}, syncing without cgroup '
+                          'limits ({error})'.format(controllers='+'.join(missing), parent=parent, error=error))
+                    return None
+
+            name = path.join(parent, 'multilevel-backup-{pid}'.format(pid=os.getpid()))
+            os.mkdir(name)
+            cgroup = name
+            if self.policy.io_max is not None:
+                self._write(path.join(cgroup, 'io.max'), self._io_max(self.policy.io_max))
+            if self.policy.cpu_max is not None:
+                self._write(path.join(cgroup, 'cpu.max'), '{quota} {period}'.format(
+                    quota=max(int(self.policy.cpu_max * _cpu_period), 1000), period=_cpu_period))
+            return cgroup
+        except (OSError, StopIteration) as error:
+            print('Warning: cgroup limits not available, syncing without them ({error})'.format(error=error))
+            if cgroup is not None:
+                try:
+                    os.rmdir(cgroup)
+                except OSError:
+                    pass
+            return None
+
+    def _io_max(self, rate):
+        return '{device} rbps={rate} wbps={rate}'.format(device=block_device(self.snapshot_root, self.sys_root),
+                                                         rate=rate)
+
+    def pressure(self):
+        """
+        Share of time some tasks were stalled on I/O during the last 10 seconds.
+
+        :return Percentage or None if PSI is not available
+        :rtype float
+        """
+        try:
+            with open(path.join(self.proc_root, 'pressure', 'io'), 'r') as pressure:
+                match = _pressure_pattern.search(pressure.read())
+        except OSError:
+            return None
+        return float(match.group('avg10')) if match else None
+
+    def load(self):
+        """
+        One minute load average per CPU.
+
+        :rtype float
+        """
+        try:
+            with open(path.join(self.proc_root, 'loadavg'), 'r') as loadavg:
+                load = float(loadavg.read().split()[0])
+        except (OSError, ValueError, IndexError):
+            return None
+        return load / (os.cpu_count() or 1)
+
+    def adjust(self):
+        """
+        Throttle or relieve the syncs according to the current pressure and load.
+
+        :return Whether the syncs are throttled
+        :rtype bool
+        """
+        pressure = self.pressure()
+        load = self.load() if self.policy.load_high is not None else None
+
+        high = (pressure is not None and pressure >= self.policy.pressure_high) or \
+            (load is not None and load >= self.policy.load_high)
+        low = (pressure is None or pressure <= self.policy.pressure_low) and \
+            (load is None or load < self.policy.load_high)
+
+        if high and not self.throttled:
+            print('-- System under pressure (I/O {pressure}%, load {load}), throttling sync'.format(
+                pressure=pressure, load=load))
+            self._set_throttled(True)
+        elif low and self.throttled:
+            print('-- System pressure relieved, continuing sync at configured limits')
+            self._set_throttled(False)
+        return self.throttled
+
+    def _watch(self):
+        while not self._stopped.wait(self.interval):
+            self.adjust()
+
+    def _set_throttled(self, throttled):
+        with self._lock:
+            self.throttled = throttled
+            # Popen and asyncio processes both set the return code once they are reaped
+            self._processes = set(process for process in self._processes if process.returncode is None)
+            for process in self._processes:
+                for pid in self._process_tree(process.pid):
+                    self._prioritize(pid, throttled)
+
+        if self.cgroup is not None and self.policy.io_max is not None:
+            rate = self.policy.io_max // 4 if throttled else self.policy.io_max
+            try:
+                self._write(path.join(self.cgroup, 'io.max'), self._io_max(max(rate, 1)))
+            except OSError as error:
+                print('Note: cannot change cgroup I/O limit: {error}'.format(error=error))
+
+    def _process_tree(self, pid):
+        """
+        Process and all its descendants, e.g. rsync started by rsnapshot and its receiver and generator processes.
+
+        :rtype list[int]
+        """
+        pids = [pid]
+        for current in pids:
+            try:
+                with open(path.join(self.proc_root, str(current), 'task', str(current), 'children'), 'r') as children:
+                    pids.extend(int(child) for child in children.read().split())
+            except OSError:
+                pass
+        return pids
+
+    def _prioritize(self, pid, throttled):
+        if self.renice:
+            try:
+                os.setpriority(os.PRIO_PROCESS, pid, 19 if throttled else self.policy.nice)
+            except ProcessLookupError:
+                pass
+            except OSError as error:
+                print('Note: cannot change priority of sync process {pid}: {error}'.format(pid=pid, error=error))
+
+        ionice = shutil.which('ionice')
+        if ionice is not None:
+            io_class = IO_CLASSES['idle'] if throttled else IO_CLASSES[self.policy.io_class or 'best-effort']
+            returncode = subprocess.call([ionice, '-c', io_class, '-p', str(pid)], stdout=subprocess.DEVNULL,
+                                         stderr=subprocess.DEVNULL)
+            # Ignore processes that exited in the meantime
+            if returncode != 0 and path.exists(path.join(self.proc_root, str(pid))):
+                print('Note: cannot change I/O priority of sync process {pid}'.format(pid=pid))
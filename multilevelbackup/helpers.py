@@ -1,6 +1,12 @@
 from os import path
 from datetime import date
 
+import os
+import re
+import tempfile
+
+_size_units = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+
 
 def folder_time(folder):
     """
@@ -21,11 +27,72 @@ def level_backup_needed(upper_first, lower_last, min_diff):
     if not path.exists(lower_last):
         return False
 
-    if path.exists(upper_first):
+    time_upper = folder_time(upper_first) if path.exists(upper_first) else None
+    return level_needed_by_date(time_upper, folder_time(lower_last), min_diff)
+
+
+def level_needed_by_date(upper_first_date, lower_last_date, min_diff):
+    """
+    Check whether backup of this increment level is needed based on the snapshot dates.
+
+    :param upper_first_date: Date of newest snapshot of this level or None if not existing
+    :param lower_last_date: Date of oldest snapshot of the lower level or None if not existing
+    :rtype bool
+    """
+    if lower_last_date is None:
+        return False
+
+    if upper_first_date is not None:
         # Only perform if enough time passed
-        time_upper = folder_time(upper_first)
-        time_lower = folder_time(lower_last)
-        return (time_lower - time_upper) >= min_diff
+        return (lower_last_date - upper_first_date) >= min_diff
     else:
         # First backup of higher level
         return True
+
+
+def atomic_write(file_name, content):
+    """
+    Replace file content atomically by writing a temporary file next to it and renaming it afterwards.
+
+    :param content: New file content
+    :type content: str or bytes
+    """
+    folder = path.dirname(path.abspath(file_name))
+    os.makedirs(folder, exist_ok=True)
+
+    handle, temp_name = tempfile.mkstemp(dir=folder, prefix='.' + path.basename(file_name) + '.')
+    try:
+        with os.fdopen(handle, 'wb' if isinstance(content, bytes) else 'w') as temp_file:
+            temp_file.write(content)
+            temp_file.flush()
+            os.fsync(temp_file.fileno())
+        os.replace(temp_name, file_name)
+    except BaseException:
+        os.unlink(temp_name)
+        raise
+
+
+def default_state_dir():
+    """
+    Determine local folder for state files. Can be overridden by the MULTILEVEL_BACKUP_STATE_DIR environment variable.
+
+    :rtype str
+    """
+    if 'MULTILEVEL_BACKUP_STATE_DIR' in os.environ:
+        return os.environ['MULTILEVEL_BACKUP_STATE_DIR']
+
+    state_home = os.environ.get('XDG_STATE_HOME') or path.join(path.expanduser('~'), '.local', 'state')
+    return path.join(state_home, 'multilevel-backup')
+
+
+def parse_size(text):
+    """
+    Parse a number of bytes of the form `<amount>[K|M|G]`, e.g. `50M`.
+
+    :rtype int
+    :raise ValueError: Raised if size is malformed
+    """
+    match = re.match(r'^(?P<amount>\d+(\.\d+)?)(?P<unit>[KMG]?)$', text.strip().upper())
+    if not match:
+        raise ValueError('Invalid size \'{text}\', expected e.g. \'50M\''.format(text=text))
+    return int(float(match.group('amount')) * _size_units[match.group('unit')])
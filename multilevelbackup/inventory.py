@@ -0,0 +1,124 @@
+import os
+import re
+from datetime import date
+
+from .rotation import TRASH_PREFIX
+
+
+class SnapshotInventory(object):
+    """
+    In-memory index of the snapshot directories below a snapshot root.
+
+    The root is read once with a single directory scan, the modification time of a snapshot is only requested
+    (and then cached) when it is actually needed. Call :meth:`invalidate` after the snapshot root was changed.
+    """
+
+    _snapshot_pattern = re.compile(r'^(?P<interval>\w+)\.(?P<index>\d+)$')
+
+    def __init__(self, snapshot_root):
+        self.snapshot_root = snapshot_root
+        self._entries = None
+        self._expired = None
+        self._scanned_root = None
+
+    def invalidate(self):
+        """Drop the index, the snapshot root is scanned again on next access."""
+        self._entries = None
+        self._expired = None
+
+    def _root_identity(self):
+        try:
+            stat = os.stat(self.snapshot_root)
+        except FileNotFoundError:
+            return None
+        return stat.st_dev, stat.st_ino, stat.st_mtime_ns
+
+    def revalidate(self):
+        """
+        Drop the index if the snapshot root changed since it was scanned, e.g. by a rotation of another process or
+        because a different device is mounted.
+        """
+        if self._entries is not None and self._root_identity() != self._scanned_root:
+            self.invalidate()
+
+    def refresh(self):
+        """Scan the snapshot root immediately."""
+        entries = {}
+        expired = []
+        self._scanned_root = self._root_identity()
+        try:
+            with os.scandir(self.snapshot_root) as iterator:
+                for entry in iterator:
+                    match = self._snapshot_pattern.match(entry.name)
+                    if match and entry.is_dir():
+                        key = (match.group('interval'), int(match.group('index')))
+                        entries[key] = entry
+                    elif entry.name.startswith(TRASH_PREFIX):
+                        expired.append(entry.name)
+        except FileNotFoundError:
+            pass
+
+        self._entries = entries
+        self._expired = sorted(expired)
+
+    @property
+    def expired(self):
+        """
+        Names of expired snapshots waiting in the trash for deletion.
+
+        :rtype list[str]
+        """
+        if self._expired is None:
+            self.refresh()
+        return self._expired
+
+    @property
+    def entries(self):
+        """
+        All snapshots found in the snapshot root.
+
+        :rtype dict[(str, int), os.DirEntry]
+        """
+        if self._entries is None:
+            self.refresh()
+        return self._entries
+
+    def exists(self, interval, index):
+        """
+        Check whether a snapshot exists.
+
+        :rtype bool
+        """
+        return (interval, index) in self.entries
+
+    def mtime(self, interval, index):
+        """
+        Get modification timestamp of a snapshot.
+
+        :return Timestamp or None if snapshot does not exist
+        :rtype float
+        """
+        entry = self.entries.get((interval, index))
+        if entry is None:
+            return None
+        return entry.stat().st_mtime
+
+    def snapshot_date(self, interval, index):
+        """
+        Get day timestamp of a snapshot.
+
+        :return Date or None if snapshot does not exist
+        :rtype datetime.date
+        """
+        stamp = self.mtime(interval, index)
+        if stamp is None:
+            return None
+        return date.fromtimestamp(stamp)
+
+    def indices(self, interval):
+        """
+        All existing snapshot indices of an interval in ascending order.
+
+        :rtype list[int]
+        """
+        return sorted(index for name, index in self.entries if name == interval)
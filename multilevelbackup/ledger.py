@@ -0,0 +1,147 @@
+from os import path
+from datetime import date, datetime, timedelta
+
+import hashlib
+import json
+import time
+
+from .helpers import atomic_write
+
+
+class SnapshotLedger(object):
+    """
+    Local record of the snapshot state of one snapshot root.
+
+    The ledger is stored outside of the backup device and answers the same date queries as
+    :class:`multilevelbackup.inventory.SnapshotInventory`, so decisions can be made without touching the backup device.
+    It is only trusted while it is consistent with the current config and not older than `max_age`.
+    """
+
+    def __init__(self, ledger_file, read_only=False, max_age=timedelta(days=7)):
+        self.ledger_file = ledger_file
+        self.read_only = read_only
+        self.max_age = max_age
+        self._data = None
+
+    @staticmethod
+    def file_for_root(state_dir, snapshot_root):
+        """
+        Determine ledger file of a snapshot root within the state folder.
+
+        :rtype str
+        """
+        key = hashlib.sha1(path.normpath(snapshot_root).encode('utf-8')).hexdigest()[:16]
+        return path.join(state_dir, 'ledger-{key}.json'.format(key=key))
+
+    def invalidate(self):
+        """Drop the loaded ledger, it is read again on next access (e.g. after another process updated it)."""
+        self._data = None
+
+    @property
+    def data(self):
+        if self._data is None:
+            try:
+                with open(self.ledger_file, 'r') as ledger:
+                    self._data = json.load(ledger)
+            except (OSError, ValueError):
+                self._data = {}
+        return self._data
+
+    def is_consistent(self, snapshot_root, intervals, now=None):
+        """
+        Check whether ledger can be trusted for given snapshot root and intervals.
+
+        :type intervals: dict[str, int]
+        :rtype bool
+        """
+        data = self.data
+        if data.get('snapshot_root') != path.normpath(snapshot_root) or data.get('intervals') != dict(intervals):
+            return False
+
+        reconciled = data.get('reconciled')
+        if reconciled is None:
+            return False
+
+        now = time.time() if now is None else now
+        age = now - reconciled
+        return 0 <= age <= self.max_age.total_seconds()
+
+    def mtime(self, interval, index):
+        """
+        Get recorded modification timestamp of a snapshot.
+
+        :return Timestamp or None if snapshot is not recorded
+        :rtype float
+        """
+        return self.data.get('snapshots', {}).get(interval, {}).get(str(index))
+
+    def snapshot_date(self, interval, index):
+        """
+        Get recorded day timestamp of a snapshot.
+
+        :return Date or None if snapshot is not recorded
+        :rtype datetime.date
+        """
+        stamp = self.mtime(interval, index)
+        if stamp is None:
+            return None
+        return date.fromtimestamp(stamp)
+
+    def indices(self, interval):
+        """
+        All recorded snapshot indices of an interval in ascending order.
+
+        :rtype list[int]
+        """
+        return sorted(int(index) for index in self.data.get('snapshots', {}).get(interval, {}))
+
+    @property
+    def expired(self):
+        """
+        Recorded names of expired snapshots waiting in the trash for deletion.
+
+        :rtype list[str]
+        """
+        return self.data.get('expired', [])
+
+    def last_performed(self, step):
+        """
+        Get time a step was recorded the last time.
+
+        :return Time or None if step was never recorded
+        :rtype datetime.datetime
+        """
+        stamp = self.data.get('steps', {}).get(step)
+        if stamp is None:
+            return None
+        return datetime.fromtimestamp(stamp)
+
+    def record_step(self, step, now=None):
+        """Record completion of an executor step."""
+        now = time.time() if now is None else now
+        self.data.setdefault('steps', {})[step] = now
+
+    def reconcile(self, inventory, intervals, now=None):
+        """
+        Replace recorded snapshot state by the state found on disk.
+
+        :type inventory: multilevelbackup.inventory.SnapshotInventory
+        :type intervals: dict[str, int]
+        """
+        snapshots = {}
+        for interval, index in inventory.entries:
+            snapshots.setdefault(interval, {})[str(index)] = inventory.mtime(interval, index)
+
+        data = self.data
+        data['snapshot_root'] = path.normpath(inventory.snapshot_root)
+        data['intervals'] = dict(intervals)
+        data['snapshots'] = snapshots
+        data['expired'] = list(inventory.expired)
+        data['reconciled'] = time.time() if now is None else now
+
+    def save(self):
+        """Write ledger to disk unless it is read only."""
+        if self.read_only:
+            return
+
+        atomic_write(self.ledger_file, json.dumps(self.data, indent=2, sort_keys=True))
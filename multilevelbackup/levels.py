@@ -0,0 +1,192 @@
+from collections import OrderedDict
+from datetime import date, datetime, timedelta
+
+import re
+
+from .helpers import level_needed_by_date
+
+DEFAULT_MIN_GAPS = {
+    'hourly': timedelta(hours=1),
+    'daily': timedelta(days=1),
+    'weekly': timedelta(days=7),
+    'monthly': timedelta(days=28),
+    'yearly': timedelta(days=364),
+}
+
+
+class Level(object):
+    """Single backup level with its retaining count and minimum gap between two snapshots."""
+
+    def __init__(self, name, count, min_gap):
+        self.name = name
+        self.count = count
+        self.min_gap = min_gap
+
+    @property
+    def last_index(self):
+        return self.count - 1
+
+    @property
+    def by_day(self):
+        """Whether gaps are measured in calendar days (True) or exact time (False)."""
+        return self.min_gap % timedelta(days=1) == timedelta(0)
+
+    def to_time(self, stamp):
+        """
+        Convert timestamp to the granularity used for this level.
+
+        :rtype datetime.date|datetime.datetime
+        """
+        if stamp is None:
+            return None
+        return date.fromtimestamp(stamp) if self.by_day else datetime.fromtimestamp(stamp)
+
+    def __repr__(self):
+        return 'Level({name!r}, {count!r}, {gap!r})'.format(name=self.name, count=self.count, gap=self.min_gap)
+
+
+class LevelChain(object):
+    """
+    Chain of backup levels from lowest to highest, e.g. hourly, daily, weekly, monthly, yearly.
+
+    The lowest level is due if its newest snapshot is older than its minimum gap. Every higher level is due if the lower
+    one is due and the oldest snapshot of the lower level is at least the minimum gap newer than the newest snapshot of
+    this level.
+    """
+
+    def __init__(self, levels):
+        if not levels:
+            raise ValueError('No backup intervals given')
+        self.levels = list(levels)
+
+    @staticmethod
+    def from_intervals(intervals, min_gaps=None):
+        """
+        Create chain from interval names and counts in ascending order.
+
+        :type intervals: collections.OrderedDict[str, int]
+        :param min_gaps: Minimum gaps overriding the default ones
+        :type min_gaps: dict[str, datetime.timedelta]
+        :raise ValueError: Raised if no minimum gap is known for an interval
+        """
+        gaps = dict(DEFAULT_MIN_GAPS)
+        gaps.update(min_gaps or {})
+
+        levels = []
+        for name, count in intervals.items():
+            if name not in gaps:
+                raise ValueError('No minimum gap for interval \'{name}\' known'.format(name=name))
+            levels.append(Level(name, count, gaps[name]))
+
+        return LevelChain(levels)
+
+    @property
+    def lowest(self):
+        return self.levels[0]
+
+    @property
+    def names(self):
+        return [level.name for level in self.levels]
+
+    def __iter__(self):
+        return iter(self.levels)
+
+    def __getitem__(self, name):
+        for level in self.levels:
+            if level.name == name:
+                return level
+        raise KeyError(name)
+
+    def lower(self, name):
+        """
+        Get level directly below given one.
+
+        :return Lower level or None for lowest level
+        :rtype Level
+        """
+        position = self.names.index(name)
+        return self.levels[position-1] if position > 0 else None
+
+    def is_lowest_due(self, snapshots, now=None):
+        """
+        Check whether lowest level is due.
+
+        :param snapshots: Snapshot source like :class:`multilevelbackup.inventory.SnapshotInventory`
+        :param now: Current timestamp
+        :rtype bool
+        """
+        level = self.lowest
+        newest = level.to_time(snapshots.mtime(level.name, 0))
+        if newest is None:
+            return True
+
+        current = level.to_time(datetime.now().timestamp() if now is None else now)
+        return current - newest >= level.min_gap
+
+    def is_level_due(self, name, snapshots, now=None):
+        """
+        Check whether given level is due regardless of the levels below.
+
+        :rtype bool
+        """
+        lower = self.lower(name)
+        if lower is None:
+            return self.is_lowest_due(snapshots, now)
+
+        level = self[name]
+        return level_needed_by_date(level.to_time(snapshots.mtime(level.name, 0)),
+                                    level.to_time(snapshots.mtime(lower.name, lower.last_index)),
+                                    level.min_gap)
+
+    def due_levels(self, snapshots, now=None):
+        """
+        Compute the cascade of due levels in one pass. A level can only be due if all levels below are due.
+
+        :return Level names in ascending order and whether they are due
+        :rtype collections.OrderedDict[str, bool]
+        """
+        tasks = OrderedDict((name, False) for name in self.names)
+        for level in self.levels:
+            if not self.is_level_due(level.name, snapshots, now):
+                break
+            tasks[level.name] = True
+
+        return tasks
+
+    def overdue_levels(self, snapshots, factor, now=None):
+        """
+        Determine due levels whose newest snapshot is older than `factor` times their minimum gap, e.g. since the
+        backup device was not available for a while. Levels without snapshots are not overdue.
+
+        :param factor: Multiple of the minimum gap
+        :param now: Current timestamp
+        :return Names of overdue levels in ascending order
+        :rtype list[str]
+        """
+        now = datetime.now().timestamp() if now is None else now
+        overdue = []
+        for name, due in self.due_levels(snapshots, now).items():
+            if not due:
+                break
+            newest = snapshots.mtime(name, 0)
+            if newest is not None and now - newest >= factor * self[name].min_gap.total_seconds():
+                overdue.append(name)
+
+        return overdue
+
+
+def parse_min_gap(text):
+    """
+    Parse minimum gap definition of the form `<interval>=<amount><unit>`, unit being `h` (hours) or `d` (days).
+
+    :return Interval name and minimum gap
+    :rtype (str, datetime.timedelta)
+    :raise ValueError: Raised if definition is malformed
+    """
+    match = re.match(r'^(?P<name>\w+)=(?P<amount>\d+)(?P<unit>[hd])$', text.strip())
+    if not match:
+        raise ValueError('Invalid minimum gap \'{text}\', expected e.g. \'weekly=7d\''.format(text=text))
+
+    amount = int(match.group('amount'))
+    gap = timedelta(hours=amount) if match.group('unit') == 'h' else timedelta(days=amount)
+    return match.group('name'), gap
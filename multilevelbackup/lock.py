@@ -0,0 +1,81 @@
+from os import path
+
+import fcntl
+import hashlib
+import os
+
+
+class RunLock(object):
+    """
+    Cross-process lock of a snapshot root based on `flock`, with coalescing of concurrent requests.
+
+    The first process holds the run lock. The second one takes the pending lock and queues up for the run lock, as its
+    run may be needed after the running one finished. Every further process finds the pending lock taken: a run is
+    already queued which will do its work as well, so it does not run at all. Locks are released by the kernel when a
+    process dies, so no stale lock files need to be cleaned up.
+    """
+
+    def __init__(self, lock_folder, snapshot_root):
+        key = hashlib.sha1(path.normpath(snapshot_root).encode('utf-8')).hexdigest()[:16]
+        self.snapshot_root = snapshot_root
+        self.run_file = path.join(lock_folder, 'run-{key}.lock'.format(key=key))
+        self.pending_file = path.join(lock_folder, 'pending-{key}.lock'.format(key=key))
+        self._run = None
+
+    @staticmethod
+    def _open(lock_file):
+        os.makedirs(path.dirname(lock_file), exist_ok=True)
+        return os.open(lock_file, os.O_RDWR | os.O_CREAT, 0o644)
+
+    @staticmethod
+    def _try_lock(handle, operation=fcntl.LOCK_EX):
+        try:
+            fcntl.flock(handle, operation | fcntl.LOCK_NB)
+            return True
+        except BlockingIOError:
+            return False
+
+    def acquire(self):
+        """
+        Acquire run lock, waiting for a running backup if needed.
+
+        :return Whether the lock was acquired, False if the request was merged into an already queued run
+        :rtype bool
+        """
+        handle = self._open(self.run_file)
+        if not self._try_lock(handle):
+            pending = self._open(self.pending_file)
+            try:
+                if not self._try_lock(pending):
+                    os.close(handle)
+                    return False
+                print('-- Backup of {root} is running, waiting for it to finish'.format(root=self.snapshot_root))
+                fcntl.flock(handle, fcntl.LOCK_EX)
+            finally:
+                # Closing releases the pending lock, so the next request can queue up again
+                os.close(pending)
+
+        os.ftruncate(handle, 0)
+        os.write(handle, '{pid}\n'.format(pid=os.getpid()).encode())
+        self._run = handle
+        return True
+
+    def release(self):
+        if self._run is not None:
+            os.close(self._run)
+            self._run = None
+
+    def wait(self):
+        """Wait until the queued run finished, after :meth:`acquire` merged the request into it."""
+        for lock_file in (self.pending_file, self.run_file):
+            handle = self._open(lock_file)
+            try:
+                fcntl.flock(handle, fcntl.LOCK_SH)
+            finally:
+                os.close(handle)
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, *args):
+        self.release()
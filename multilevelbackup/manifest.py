@@ -0,0 +1,214 @@
+from collections import namedtuple, OrderedDict
+from os import path
+
+import hashlib
+import mmap
+import os
+import struct
+import tempfile
+import time
+
+from .report import StepReport
+from .rotation import SYNC_FOLDER
+
+MANIFEST_FILE = '.manifest'
+
+ManifestEntry = namedtuple('ManifestEntry', ['path', 'size', 'mtime_ns', 'inode', 'digest'])
+
+_header = struct.Struct('<4sBQ')
+_record = struct.Struct('<QIQqQ32s')
+_magic = b'MLBM'
+_version = 1
+_chunk_size = 1024 * 1024
+
+
+def hash_file(file_name):
+    """
+    Hash file content.
+
+    :rtype bytes
+    """
+    digest = hashlib.blake2b(digest_size=32)
+    with open(file_name, 'rb') as data:
+        for chunk in iter(lambda: data.read(_chunk_size), b''):
+            digest.update(chunk)
+    return digest.digest()
+
+
+def _path_key(relative):
+    return relative.split(b'/')
+
+
+def walk_files(folder, relative=b''):
+    """
+    Walk all regular files below a folder, entries of every folder sorted by name.
+
+    :return Relative paths (as bytes) and stat results
+    :rtype collections.Iterable[(bytes, os.stat_result)]
+    """
+    with os.scandir(os.fsencode(folder)) as iterator:
+        entries = sorted(iterator, key=lambda entry: entry.name)
+    for entry in entries:
+        name = relative + entry.name
+        if entry.is_dir(follow_symlinks=False):
+            yield from walk_files(entry.path, name + b'/')
+        elif entry.is_file(follow_symlinks=False):
+            yield name, entry.stat(follow_symlinks=False)
+
+
+class Manifest(object):
+    """
+    Memory-mapped manifest of a snapshot: path, size, modification time, inode and content hash of every regular file.
+
+    The file consists of a header, fixed-size records ordered by path and the paths of all records. Records are in the
+    order of a depth-first walk with sorted folders, so paths can be looked up by binary search on the path components.
+    """
+
+    def __init__(self, manifest_file):
+        """
+        :raise ValueError: Raised if the file is not a manifest of this version
+        """
+        with open(manifest_file, 'rb') as data:
+            self._map = mmap.mmap(data.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if len(self._map) < _header.size:
+            self.close()
+            raise ValueError('Truncated manifest {name}'.format(name=manifest_file))
+        magic, version, self._count = _header.unpack_from(self._map)
+        if magic != _magic or version != _version:
+            self.close()
+            raise ValueError('Unknown manifest format of {name}'.format(name=manifest_file))
+        self._paths = _header.size + self._count * _record.size
+        if len(self._map) < self._paths:
+            self.close()
+            raise ValueError('Truncated manifest {name}'.format(name=manifest_file))
+
+    def close(self):
+        self._map.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return self._count
+
+    def _raw_path(self, index):
+        offset, length = struct.unpack_from('<QI', self._map, _header.size + index * _record.size)
+        return self._map[self._paths + offset:self._paths + offset + length]
+
+    def __getitem__(self, index):
+        if not 0 <= index < self._count:
+            raise IndexError(index)
+        offset, length, size, mtime_ns, inode, digest = _record.unpack_from(self._map,
+                                                                            _header.size + index * _record.size)
+        relative = self._map[self._paths + offset:self._paths + offset + length]
+        return ManifestEntry(os.fsdecode(relative), size, mtime_ns, inode, digest)
+
+    def __iter__(self):
+        for index in range(self._count):
+            yield self[index]
+
+    def find(self, relative):
+        """
+        Look up a path.
+
+        :rtype ManifestEntry
+        """
+        key = _path_key(os.fsencode(relative))
+        low, high = 0, self._count
+        while low < high:
+            middle = (low + high) // 2
+            if _path_key(self._raw_path(middle)) < key:
+                low = middle + 1
+            else:
+                high = middle
+        if low < self._count and _path_key(self._raw_path(low)) == key:
+            return self[low]
+        return None
+
+
+def _open_manifest(manifest_file):
+    try:
+        return Manifest(manifest_file)
+    except (OSError, ValueError):
+        return None
+
+
+def write_manifest(snapshot, previous=None):
+    """
+    Write manifest of a snapshot into the snapshot folder. Hashes of files still hardlinked to the same path in the
+    previous manifest (same inode, size and modification time) are reused, so only new and changed files are read.
+
+    :param previous: Manifest file of the previous snapshot
+    :return Number of files and number of hashed files
+    :rtype (int, int)
+    """
+    old = _open_manifest(previous) if previous is not None else None
+    manifest_file = path.join(snapshot, MANIFEST_FILE)
+    handle, temp_name = tempfile.mkstemp(dir=snapshot, prefix=MANIFEST_FILE + '.')
+    count = hashed = 0
+    try:
+        with os.fdopen(handle, 'w+b') as data, tempfile.TemporaryFile() as paths:
+            data.write(_header.pack(_magic, _version, 0))
+            offset = 0
+            for relative, info in walk_files(snapshot):
+                if relative == MANIFEST_FILE.encode() or relative.startswith(MANIFEST_FILE.encode() + b'.'):
+                    continue
+
+                entry = old.find(os.fsdecode(relative)) if old is not None else None
+                if entry is not None and (entry.inode, entry.size, entry.mtime_ns) == \
+                        (info.st_ino, info.st_size, info.st_mtime_ns):
+                    digest = entry.digest
+                else:
+                    digest = hash_file(path.join(os.fsencode(snapshot), relative))
+                    hashed += 1
+
+                data.write(_record.pack(offset, len(relative), info.st_size, info.st_mtime_ns, info.st_ino, digest))
+                paths.write(relative)
+                offset += len(relative)
+                count += 1
+
+            paths.seek(0)
+            for chunk in iter(lambda: paths.read(_chunk_size), b''):
+                data.write(chunk)
+            data.seek(0)
+            data.write(_header.pack(_magic, _version, count))
+            data.flush()
+            os.fsync(data.fileno())
+        os.replace(temp_name, manifest_file)
+    except BaseException:
+        if path.exists(temp_name):
+            os.unlink(temp_name)
+        raise
+    finally:
+        if old is not None:
+            old.close()
+    return count, hashed
+
+
+class ManifestStage(object):
+    """
+    Post-sync stage writing the manifest of the sync folder. The manifest of the last sync (kept in the sync folder by
+    rsnapshot) or of the newest snapshot of the lowest level is used to reuse hashes.
+    """
+
+    name = 'manifest'
+
+    def __call__(self, manager):
+        """
+        :type manager: multilevelbackup.backup.DefaultSnapshotManager
+        :rtype multilevelbackup.report.StepReport
+        """
+        start = time.monotonic()
+        sync_folder = path.join(manager.backup_root, SYNC_FOLDER)
+        candidates = [path.join(sync_folder, MANIFEST_FILE),
+                      path.join(manager.first_snapshot(manager.levels.lowest.name), MANIFEST_FILE)]
+        previous = next((candidate for candidate in candidates if path.isfile(candidate)), None)
+
+        count, hashed = write_manifest(sync_folder, previous)
+        print('-- Manifest of {count} files written, {hashed} files hashed'.format(count=count, hashed=hashed))
+        return StepReport(self.name, time.monotonic() - start,
+                          counters=OrderedDict([('files', count), ('hashed_files', hashed)]))
@@ -0,0 +1,144 @@
+from os import path
+from collections import OrderedDict
+
+import hashlib
+import json
+import time
+
+from .helpers import atomic_write
+
+_prefix = 'multilevel_backup_'
+
+
+class Metric(object):
+    """Single metric with its samples, each sample consisting of labels and a value."""
+
+    def __init__(self, name, help_text, kind='gauge'):
+        self.name = _prefix + name
+        self.help_text = help_text
+        self.kind = kind
+        self.samples = []
+
+    def add(self, value, **labels):
+        self.samples.append((OrderedDict(sorted(labels.items())), value))
+        return self
+
+
+def collect_metrics(manager, report, now=None):
+    """
+    Collect metrics of a backup run. The snapshot state is taken from the manager (ledger or already scanned
+    inventory), so collecting does not walk any snapshot.
+
+    :type manager: multilevelbackup.backup.DefaultSnapshotManager
+    :type report: multilevelbackup.report.RunReport
+    :rtype list[Metric]
+    """
+    now = time.time() if now is None else now
+    root = manager.backup_root
+    snapshots = manager.snapshots
+    ledger = manager.ledger
+
+    run = Metric('last_run_timestamp_seconds', 'Time of the last invocation.').add(now, root=root)
+    performed = Metric('last_run_performed', 'Whether the last invocation performed a backup.')
+    performed.add(int(report.performed), root=root)
+    failed = Metric('last_run_failed', 'Whether the last invocation failed.').add(int(report.error is not None),
+                                                                                  root=root)
+    metrics = [run, performed, failed]
+
+    newest = Metric('newest_snapshot_timestamp_seconds', 'Modification time of the newest snapshot per level.')
+    age = Metric('newest_snapshot_age_seconds', 'Age of the newest snapshot per level.')
+    count = Metric('snapshots', 'Number of snapshots per level.')
+    success = Metric('last_success_timestamp_seconds', 'Time of the last successful backup per level.')
+    for level in manager.intervals:
+        mtime = snapshots.mtime(level, 0)
+        count.add(len(snapshots.indices(level)), root=root, level=level)
+        if mtime is not None:
+            newest.add(mtime, root=root, level=level)
+            age.add(max(now - mtime, 0), root=root, level=level)
+
+        performed_at = ledger.last_performed(level) if ledger is not None else None
+        if performed_at is not None:
+            success.add(performed_at.timestamp(), root=root, level=level)
+        elif mtime is not None:
+            success.add(mtime, root=root, level=level)
+    metrics.extend([newest, age, count, success])
+
+    backlog = Metric('expired_snapshots_pending', 'Number of expired snapshots waiting for the reaper.')
+    metrics.append(backlog.add(len(snapshots.expired), root=root))
+
+    if report.performed:
+        duration = Metric('step_duration_seconds', 'Wall time of the steps of the last backup.')
+        counter = Metric('step_counter', 'Counters of the steps of the last backup, e.g. bytes reclaimed.')
+        for step in report.steps:
+            duration.add(step.duration, root=root, step=step.name)
+            for name, value in step.counters.items():
+                counter.add(value, root=root, step=step.name, counter=name)
+
+        stats = report.stats
+        metrics.extend([
+            duration,
+            counter,
+            Metric('transferred_bytes', 'Bytes of the files transferred by the last sync.').add(
+                stats.transferred_size, root=root),
+            Metric('transferred_files', 'Number of files transferred by the last sync.').add(
+                stats.files_transferred, root=root),
+        ])
+
+    return metrics
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    escaped = ('{key}="{value}"'.format(key=key, value=str(value).replace('\\', '\\\\').replace('"', '\\"')
+                                        .replace('\n', '\\n')) for key, value in labels.items())
+    return '{' + ','.join(escaped) + '}'
+
+
+def format_prometheus(metrics):
+    """
+    Format metrics in the Prometheus text exposition format.
+
+    :rtype str
+    """
+    lines = []
+    for metric in metrics:
+        if not metric.samples:
+            continue
+        lines.append('# HELP {name} {help}'.format(name=metric.name, help=metric.help_text))
+        lines.append('# TYPE {name} {kind}'.format(name=metric.name, kind=metric.kind))
+        for labels, value in metric.samples:
+            lines.append('{name}{labels} {value}'.format(name=metric.name, labels=_format_labels(labels),
+                                                         value=repr(float(value))))
+    return '\n'.join(lines) + '\n'
+
+
+def format_json(metrics):
+    """
+    Format metrics as JSON object of metric names and their samples.
+
+    :rtype str
+    """
+    data = OrderedDict()
+    for metric in metrics:
+        data[metric.name] = [OrderedDict([('labels', labels), ('value', value)]) for labels, value in metric.samples]
+    return json.dumps(data, indent=2)
+
+
+class MetricsExporter(object):
+    """Write metrics of every run atomically into a folder, e.g. the textfile folder of the Prometheus node exporter."""
+
+    formats = OrderedDict([('prometheus', ('prom', format_prometheus)), ('json', ('json', format_json))])
+
+    def __init__(self, folder, output_format='prometheus'):
+        self.folder = folder
+        self.extension, self._format = self.formats[output_format]
+
+    def file_for_root(self, snapshot_root):
+        key = hashlib.sha1(path.normpath(snapshot_root).encode('utf-8')).hexdigest()[:16]
+        return path.join(self.folder, 'multilevel_backup_{key}.{extension}'.format(key=key, extension=self.extension))
+
+    def export(self, manager, report):
+        """Collect and write metrics of a backup run."""
+        metrics = collect_metrics(manager, report)
+        atomic_write(self.file_for_root(manager.backup_root), self._format(metrics))
@@ -0,0 +1,364 @@
+from os import path
+from collections import OrderedDict
+
+import functools
+import os
+import shlex
+import time
+
+from .config import backup_root_from_config, intervals_from_config, backup_points_from_config, value_from_config, \
+    values_from_config, options_from_string
+from .fingerprint import ChangeDetector, clone_tree
+from .process import run_command
+from .report import RsyncOutputParser, StatsCollector, StepReport, is_output
+from .rotation import RotationEngine, RotationPlan, SYNC_FOLDER
+from .ssh import SshPool
+from .sync import IncompleteSyncError, SyncCheckpoint, source_host, ssh_destination, group_destinations, \
+    sync_concurrently
+
+# rsync exit code for files vanished during transfer, which rsnapshot treats as success as well
+_rsync_vanished = 24
+
+# Folder within a destination keeping partially transferred files of an interrupted sync
+PARTIAL_FOLDER = '.rsync-partial'
+
+# rsnapshot filter settings and their rsync options
+_filter_options = {'include': 'include', 'exclude': 'exclude', 'include_file': 'include-from',
+                   'exclude_file': 'exclude-from'}
+_filter_keys = ('include', 'exclude', 'include_file', 'exclude_file')
+
+
+class NativeSettings(object):
+    """Settings of an rsnapshot config relevant for running rsync directly."""
+
+    def __init__(self, config):
+        """
+        :param config: Rsnapshot config file content
+        :type config: str
+        """
+        self.snapshot_root = backup_root_from_config(config)
+        self.intervals = intervals_from_config(config)
+        self.backup_points = backup_points_from_config(config)
+
+        self.rsync = value_from_config(config, 'cmd_rsync') or 'rsync'
+        self.short_args = shlex.split(value_from_config(config, 'rsync_short_args') or '-a')
+        self.long_args = shlex.split(value_from_config(config, 'rsync_long_args') or
+                                     '--delete --numeric-ids --relative --delete-excluded')
+        self.ssh = value_from_config(config, 'cmd_ssh')
+        self.ssh_args = value_from_config(config, 'ssh_args')
+        self.one_fs = value_from_config(config, 'one_fs') == '1'
+        self.filters = [(key, value) for key in _filter_keys for value in values_from_config(config, key)]
+
+    @staticmethod
+    def from_file(conf_file):
+        with open(conf_file, 'r') as config:
+            return NativeSettings(config.read())
+
+    @property
+    def lowest_interval(self):
+        return next(iter(self.intervals))
+
+
+def filter_args(filters):
+    """
+    Convert rsnapshot include/exclude settings to rsync arguments.
+
+    :type filters: list[(str, str)]
+    :rtype list[str]
+    """
+    return ['--{option}={value}'.format(option=_filter_options[key], value=value) for key, value in filters]
+
+
+class NativeBackupExecutor(object):
+    """
+    Perform backup steps by running rsync directly instead of rsnapshot.
+
+    Every sync builds a fresh `.sync` folder with `--link-dest` against the newest snapshot of the lowest level, so
+    unchanged files are hardlinked. Rotating the lowest level renames `.sync` to `<lowest>.0` instead of copying it.
+    All due levels are rotated at once by the :class:`multilevelbackup.rotation.RotationEngine`, expired snapshots are
+    moved into the trash and deleted later by the :class:`multilevelbackup.reaper.Reaper`.
+
+    An interrupted sync is resumed by the next one: destinations already synced are skipped according to the
+    :class:`multilevelbackup.sync.SyncCheckpoint` and partially transferred files are kept for rsync to continue.
+    The sync folder is only taken over once the checkpoint marks it complete.
+
+    With a :class:`multilevelbackup.fingerprint.ChangeDetector`, destinations whose local sources did not change since
+    the previous snapshot are cloned from it by hardlinks without running rsync.
+
+    Backup points pulled over SSH share one connection per host during a sync (see
+    :class:`multilevelbackup.ssh.SshPool`), and points of the same destination and host are synced by one rsync call.
+    """
+
+    def __init__(self, conf_file, dry_run=False, sync_workers=1, settings=None, governor=None, change_detector=None,
+                 multiplex_ssh=True, on_progress=None):
+        """
+        :param governor: Resource governor of the syncs or None
+        :type governor: multilevelbackup.governor.ResourceGovernor
+        :param change_detector: Detector of unchanged sources or None to always run rsync
+        :type change_detector: multilevelbackup.fingerprint.ChangeDetector
+        :param multiplex_ssh: Share one SSH connection per host between the rsync calls of a sync
+        :param on_progress: Called with the destination and every :class:`multilevelbackup.report.ProgressEvent` of
+            its rsync calls, e.g. a :class:`multilevelbackup.report.ProgressPrinter`
+        """
+        self.settings = settings or NativeSettings.from_file(conf_file)
+        self.dry_run = dry_run
+        self.sync_workers = sync_workers
+        self.governor = governor
+        self.change_detector = change_detector
+        self.multiplex_ssh = multiplex_ssh
+        self.on_progress = on_progress
+        self.ssh_pool = None
+        self.rotation = RotationEngine(self.settings.snapshot_root)
+
+    @property
+    def snapshot_root(self):
+        return self.settings.snapshot_root
+
+    @property
+    def sync_folder(self):
+        return path.join(self.snapshot_root, SYNC_FOLDER)
+
+    def snapshot_path(self, interval, index):
+        return path.join(self.snapshot_root, '{interval}.{index}'.format(interval=interval, index=index))
+
+    def _point_args(self, point):
+        """
+        Determine rsync arguments of a backup point, the config settings overridden by the options of the point.
+
+        :return Short and long arguments, filters and whether to stay on one file system
+        :rtype (list[str], list[str], list[(str, str)], bool)
+        """
+        settings = self.settings
+        short_args = list(settings.short_args)
+        long_args = list(settings.long_args)
+        filters = list(settings.filters)
+        one_fs = settings.one_fs
+
+        for key, value in options_from_string(point.options):
+            if key == 'rsync_short_args':
+                short_args = shlex.split(value)
+            elif key == 'rsync_long_args':
+                long_args = shlex.split(value)
+            elif key == 'one_fs':
+                one_fs = value == '1'
+            elif key in _filter_keys:
+                filters.append((key, value))
+        return short_args, long_args, filters, one_fs
+
+    def rsync_command(self, point, merged=()):
+        """
+        Build rsync call syncing one backup point into the sync folder.
+
+        :type point: multilevelbackup.config.BackupPoint
+        :param merged: Further backup points with the same destination, host and options synced by the same call
+        :rtype list[str]
+        """
+        settings = self.settings
+        short_args, long_args, filters, one_fs = self._point_args(point)
+
+        command = [settings.rsync] + short_args + long_args + ['--stats', '--info=progress2']
+        if self.governor is not None:
+            command.extend(self.governor.rsync_args())
+        if one_fs:
+            command.append('--one-file-system')
+        command.extend(filter_args(filters))
+
+        remote = source_host(point.source) is not None
+        ssh_target = ssh_destination(point.source)
+        if ssh_target is not None and self.ssh_pool is not None:
+            command.append('--rsh=' + self.ssh_pool.rsh(ssh_target))
+        elif remote and settings.ssh is not None:
+            command.append('--rsh=' + ' '.join([settings.ssh] + shlex.split(settings.ssh_args or '')))
+
+        target = path.join(self.sync_folder, point.destination)
+        previous = path.join(self.snapshot_path(settings.lowest_interval, 0), point.destination)
+        if path.isdir(previous):
+            command.append('--link-dest=' + path.abspath(previous))
+        if not path.isdir(previous) and not path.exists(target):
+            # Nothing is hardlinked to the new files, so they can be written in place
+            command.append('--inplace')
+        else:
+            # Keep partially transferred files of an interrupted sync
+            command.append('--partial-dir=' + PARTIAL_FOLDER)
+
+        if not remote:
+            # Delta transfer only costs time on local copies
+            command.append('--whole-file')
+
+        command.extend([point.source] + [other.source for other in merged] + [target])
+        return command
+
+    def _batches(self, points):
+        """
+        Merge backup points of the same destination pulled over SSH from the same host with the same options, so they
+        are synced by a single rsync call over a single connection. This requires `--relative`, which keeps the sources
+        apart within the destination.
+
+        :type points: list[multilevelbackup.config.BackupPoint]
+        :return Backup points synced by one call each
+        :rtype list[list[multilevelbackup.config.BackupPoint]]
+        """
+        batches = []
+        merged = {}
+        for point in points:
+            short_args, long_args, _, _ = self._point_args(point)
+            relative = '--relative' in long_args or \
+                any('R' in arg for arg in short_args if arg.startswith('-') and not arg.startswith('--'))
+            key = (ssh_destination(point.source), point.destination, point.options)
+            if key[0] is None or not relative:
+                batches.append([point])
+            elif key in merged:
+                merged[key].append(point)
+            else:
+                merged[key] = [point]
+                batches.append(merged[key])
+        return batches
+
+    def _run(self, command, collector, label):
+        on_start = None
+        if self.governor is not None:
+            command = self.governor.command_prefix() + command
+            on_start = self.governor.attach
+
+        print(' '.join(shlex.quote(argument) for argument in command))
+        if self.dry_run:
+            return
+
+        on_progress = None
+        if self.on_progress is not None:
+            on_progress = functools.partial(self.on_progress, label)
+        parser = RsyncOutputParser(on_progress)
+        run_command(command, handlers=[parser], accepted=(0, _rsync_vanished), echo=is_output, on_start=on_start)
+        collector.add(parser.stats)
+
+    def _clone_unchanged(self, destination, fingerprint):
+        """
+        Clone destination from the newest snapshot if its sources did not change since.
+
+        :return Whether the destination was cloned
+        :rtype bool
+        """
+        previous = self.snapshot_path(self.settings.lowest_interval, 0)
+        target = path.join(self.sync_folder, destination)
+        if ChangeDetector.recorded(previous).get(destination) != fingerprint or path.lexists(target) or \
+                not path.isdir(path.join(previous, destination)):
+            return False
+
+        print('-- Sources of {destination} unchanged, cloning {previous}'.format(destination=destination,
+                                                                                 previous=previous))
+        clone_tree(path.join(previous, destination), target)
+        self.change_detector.record(self.sync_folder, destination, fingerprint)
+        return True
+
+    def _sync_destination(self, destination, collector, checkpoint=None, unchanged=None):
+        points = [point for point in self.settings.backup_points if point.destination == destination]
+
+        fingerprint = None
+        if self.change_detector is not None and not self.dry_run:
+            # Taken before syncing, so changes during the sync are caught by the next one
+            settings = self.settings
+            fingerprint = self.change_detector.fingerprint(points, [settings.rsync, settings.short_args,
+                                                                    settings.long_args, settings.filters,
+                                                                    settings.one_fs])
+            if fingerprint is not None and self._clone_unchanged(destination, fingerprint):
+                unchanged.append(destination)
+                checkpoint.destination_done(destination)
+                return
+
+        commands = [self.rsync_command(batch[0], batch[1:]) for batch in self._batches(points)]
+        if not self.dry_run:
+            os.makedirs(path.join(self.sync_folder, destination), exist_ok=True)
+
+        for command in commands:
+            self._run(command, collector, destination)
+
+        if fingerprint is not None:
+            self.change_detector.record(self.sync_folder, destination, fingerprint)
+        if checkpoint is not None:
+            checkpoint.destination_done(destination)
+
+    def perform_sync(self):
+        """:rtype multilevelbackup.report.StepReport"""
+        print('-- Performing sync')
+        start = time.monotonic()
+        collector = StatsCollector()
+        points = self.settings.backup_points
+        unchanged = []
+
+        checkpoint = None
+        if not self.dry_run:
+            # Complete interrupted rotation before syncing against the newest snapshot
+            self.rotation.recover()
+            os.makedirs(self.sync_folder, exist_ok=True)
+
+            checkpoint = SyncCheckpoint(self.snapshot_root).load()
+            if checkpoint.resumed:
+                print('-- Resuming interrupted sync, skipping {destinations}'.format(
+                    destinations=', '.join(checkpoint.destinations)))
+            checkpoint.begin()
+            pending = checkpoint.pending(point.destination for point in points)
+            points = [point for point in points if point.destination in pending]
+
+        if self.multiplex_ssh:
+            self.ssh_pool = SshPool(self.settings.ssh or 'ssh', self.settings.ssh_args or '')
+        governed = self.governor is not None and not self.dry_run
+        if governed:
+            self.governor.start()
+        try:
+            groups = group_destinations(points)
+            sync_concurrently(groups,
+                              lambda destination: self._sync_destination(destination, collector, checkpoint, unchanged),
+                              max(self.sync_workers, 1))
+        finally:
+            if governed:
+                self.governor.stop()
+            if self.ssh_pool is not None:
+                self.ssh_pool.close()
+                self.ssh_pool = None
+
+        if not self.dry_run:
+            # Snapshot time is the time of the sync
+            os.utime(self.sync_folder)
+            checkpoint.finish()
+
+        counters = None
+        if self.change_detector is not None:
+            counters = OrderedDict([('unchanged_destinations', len(unchanged))])
+        return StepReport('sync', time.monotonic() - start, collector.stats, counters)
+
+    def perform_level(self, level):
+        return self.perform_levels([level])
+
+    def perform_levels(self, levels):
+        """
+        Rotate given levels as one batch.
+
+        :param levels: Levels in the order they are rotated (highest first)
+        :rtype multilevelbackup.report.StepReport
+        """
+        print('\n-- Performing {levels} backup'.format(levels=', '.join(levels)))
+        start = time.monotonic()
+
+        checkpoint = None
+        if self.settings.lowest_interval in levels and not self.dry_run:
+            checkpoint = SyncCheckpoint(self.snapshot_root).load()
+            if not checkpoint.complete:
+                raise IncompleteSyncError('Sync folder of {root} is not synced completely, not rotating'.format(
+                    root=self.snapshot_root))
+
+        existing = self.rotation.existing_names()
+        if self.dry_run:
+            # Sync folder is not created in dry runs
+            existing.add(SYNC_FOLDER)
+        plan = RotationPlan.create(self.settings.intervals, levels, existing)
+
+        for line in plan.describe(self.snapshot_root):
+            print(line)
+
+        if not self.dry_run:
+            # Expired snapshots are left in the trash for the reaper
+            self.rotation.apply(plan)
+        if checkpoint is not None:
+            checkpoint.remove()
+
+        return StepReport('+'.join(levels), time.monotonic() - start)
@@ -0,0 +1,152 @@
+from os import path
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+import glob
+import os
+import time
+
+from .config import backup_root_from_config
+
+
+def configs_from_paths(paths):
+    """
+    Expand config files and folders containing config files (`*.conf`) to a list of config files.
+
+    :rtype list[str]
+    """
+    config_files = []
+    for config_path in paths:
+        if path.isdir(config_path):
+            config_files.extend(sorted(glob.glob(path.join(config_path, '*.conf'))))
+        else:
+            config_files.append(config_path)
+    return config_files
+
+
+def device_of_config(conf_file):
+    """
+    Determine device (st_dev) holding the snapshot root of a config. If the snapshot root does not exist yet, the
+    device of the nearest existing parent folder is used.
+
+    :rtype int
+    """
+    with open(conf_file, 'r') as config:
+        folder = path.abspath(backup_root_from_config(config.read()))
+
+    while not path.exists(folder):
+        folder = path.dirname(folder)
+    return os.stat(folder).st_dev
+
+
+class JobResult(object):
+    """Outcome of a backup job for one config file."""
+
+    performed = 'performed'
+    skipped = 'skipped'
+    failed = 'failed'
+
+    def __init__(self, config_file, outcome, duration, error=None):
+        self.config_file = config_file
+        self.outcome = outcome
+        self.duration = duration
+        self.error = error
+
+    def __repr__(self):
+        return 'JobResult({file!r}, {outcome!r})'.format(file=self.config_file, outcome=self.outcome)
+
+
+def run_job(job, config_file, *args):
+    """
+    Run job for one config file and capture its outcome. The job returns whether a backup was performed.
+
+    :rtype JobResult
+    """
+    start = time.monotonic()
+    try:
+        performed = job(config_file, *args)
+    except Exception as error:
+        return JobResult(config_file, JobResult.failed, time.monotonic() - start, error='{name}: {error}'.format(
+            name=type(error).__name__, error=error))
+
+    outcome = JobResult.performed if performed else JobResult.skipped
+    return JobResult(config_file, outcome, time.monotonic() - start)
+
+
+class BackupScheduler(object):
+    """
+    Run jobs for many config files in parallel. Jobs are grouped by the device of their snapshot root, so that at most
+    `jobs_per_device` jobs write to the same device and at most `max_jobs` jobs run overall.
+    """
+
+    def __init__(self, max_jobs=4, jobs_per_device=1, pool_factory=ProcessPoolExecutor, device_key=device_of_config):
+        self.max_jobs = max_jobs
+        self.jobs_per_device = jobs_per_device
+        self._pool_factory = pool_factory
+        self._device_key = device_key
+
+    def _group_by_device(self, config_files):
+        groups = OrderedDict()
+        for config_file in config_files:
+            try:
+                device = self._device_key(config_file)
+            except (OSError, ValueError):
+                # Let the job itself report the broken config
+                device = config_file
+            groups.setdefault(device, deque()).append(config_file)
+        return groups
+
+    def run(self, config_files, job, *args):
+        """
+        Run job for every config file. The job must be picklable if a process pool is used.
+
+        :return Results in order of the given config files
+        :rtype list[JobResult]
+        """
+        pending = self._group_by_device(config_files)
+        running = dict((device, 0) for device in pending)
+        results = {}
+
+        with self._pool_factory(max_workers=self.max_jobs) as pool:
+            futures = {}
+            while pending or futures:
+                # Start as many jobs as allowed, rotating through devices
+                for device in list(pending):
+                    queue = pending[device]
+                    while queue and len(futures) < self.max_jobs and running[device] < self.jobs_per_device:
+                        future = pool.submit(run_job, job, queue.popleft(), *args)
+                        futures[future] = device
+                        running[device] += 1
+                    if not queue:
+                        del pending[device]
+
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    running[futures.pop(future)] -= 1
+                    result = future.result()
+                    results[result.config_file] = result
+
+        return [results[config_file] for config_file in config_files]
+
+
+def format_summary(results):
+    """
+    Format consolidated summary of job results.
+
+    :type results: list[JobResult]
+    :rtype str
+    """
+    lines = ['{outcome:<10} {duration:>9} {file}'.format(outcome='OUTCOME', duration='DURATION', file='CONFIG')]
+    for result in results:
+        lines.append('{outcome:<10} {duration:>8.1f}s {file}'.format(outcome=result.outcome,
+                                                                     duration=result.duration,
+                                                                     file=result.config_file))
+        if result.error is not None:
+            lines.append('{indent}{error}'.format(indent=' ' * 21, error=result.error))
+
+    counts = OrderedDict((outcome, 0) for outcome in (JobResult.performed, JobResult.skipped, JobResult.failed))
+    for result in results:
+        counts[result.outcome] += 1
+    lines.append(', '.join('{count} {outcome}'.format(count=count, outcome=outcome)
+                           for outcome, count in counts.items()))
+    return '\n'.join(lines)
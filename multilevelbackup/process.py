@@ -0,0 +1,135 @@
+import asyncio
+import codecs
+import io
+import locale
+import os
+import signal
+import subprocess
+import sys
+
+
+def run_command(command, handlers=(), accepted=(0,), echo=True, on_start=None):
+    """
+    Run a command and stream its output line by line, stdout and stderr combined. Carriage returns (used by progress
+    output) end a line as well.
+
+    :param command: Program and arguments
+    :type command: list[str]
+    :param handlers: Objects with a `feed(line)` method receiving every line
+    :param accepted: Return codes treated as success
+    :param echo: Print every line to stdout, or a function returning whether to print a line
+    :param on_start: Called with the :class:`subprocess.Popen` object right after the command was started
+    :return Return code
+    :rtype int
+    :raise subprocess.CalledProcessError: Raised if the return code is not accepted
+    """
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True,
+                               bufsize=1)
+    if on_start is not None:
+        on_start(process)
+    with process.stdout:
+        for line in process.stdout:
+            _emit(line.rstrip('\n'), handlers, echo)
+
+    return_code = process.wait()
+    if return_code not in accepted:
+        raise subprocess.CalledProcessError(return_code, command)
+    return return_code
+
+
+def _emit(line, handlers, echo):
+    if echo(line) if callable(echo) else echo:
+        print(line)
+        sys.stdout.flush()
+    for handler in handlers:
+        handler.feed(line)
+
+
+def _signal_group(process, signal_number):
+    try:
+        os.killpg(process.pid, signal_number)
+    except ProcessLookupError:
+        pass
+
+
+async def _terminate(process, grace):
+    """Stop the process group of a process, forcibly if it does not exit within the grace period, and reap it."""
+    _signal_group(process, signal.SIGTERM)
+    try:
+        await asyncio.wait_for(process.wait(), grace)
+    except asyncio.TimeoutError:
+        pass
+    finally:
+        if process.returncode is None:
+            _signal_group(process, signal.SIGKILL)
+    await process.wait()
+
+
+async def run_command_async(command, handlers=(), accepted=(0,), echo=True, on_start=None, kill_grace=5.0):
+    """
+    Run a command like :func:`run_command` without blocking the event loop.
+
+    The command runs in a process group of its own. If the awaiting task is cancelled, e.g. by a timeout, the whole
+    group is terminated, so no rsync started by the command keeps running, and killed after `kill_grace` seconds.
+
+    :param on_start: Called with the :class:`asyncio.subprocess.Process` object right after the command was started
+    :param kill_grace: Seconds between terminating and killing the process group on cancellation
+    :return Return code
+    :rtype int
+    :raise subprocess.CalledProcessError: Raised if the return code is not accepted
+    """
+    process = await asyncio.create_subprocess_exec(*command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                                   start_new_session=True)
+    try:
+        if on_start is not None:
+            on_start(process)
+
+        # Same line splitting as universal newlines: \r, \n and \r\n end a line
+        decoder = io.IncrementalNewlineDecoder(
+            codecs.getincrementaldecoder(locale.getpreferredencoding(False))(errors='replace'), translate=True)
+        pending = ''
+        while True:
+            data = await process.stdout.read(64 * 1024)
+            lines = (pending + decoder.decode(data, final=not data)).split('\n')
+            pending = lines.pop()
+            for line in lines:
+                _emit(line, handlers, echo)
+            if not data:
+                break
+        if pending:
+            _emit(pending, handlers, echo)
+
+        return_code = await process.wait()
+    except BaseException:
+        await _terminate(process, kill_grace)
+        raise
+
+    if return_code not in accepted:
+        raise subprocess.CalledProcessError(return_code, command)
+    return return_code
+
+
+def run_sync(coroutine):
+    """
+    Run a coroutine to completion on a new event loop, e.g. to offer a blocking variant of an async API. If the
+    caller is interrupted, e.g. by Ctrl-C, the coroutine is cancelled and can stop its child processes before the
+    exception is passed on.
+
+    :return Result of the coroutine
+    """
+    loop = asyncio.new_event_loop()
+    try:
+        task = loop.create_task(coroutine)
+        try:
+            return loop.run_until_complete(task)
+        except BaseException:
+            if not task.done():
+                task.cancel()
+                try:
+                    loop.run_until_complete(task)
+                except (asyncio.CancelledError, Exception):
+                    pass
+            raise
+    finally:
+        loop.run_until_complete(loop.shutdown_asyncgens())
+        loop.close()
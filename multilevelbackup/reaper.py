@@ -0,0 +1,148 @@
+from os import path
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+import os
+import shutil
+import subprocess
+import threading
+
+from .rotation import TRASH_PREFIX
+
+IO_CLASSES = {'idle': '3', 'best-effort': '2'}
+
+
+def lower_priority(io_class=None, niceness=0, thread_only=False):
+    """
+    Lower CPU and I/O priority of the current process. Threads started afterwards inherit the priority.
+
+    :param io_class: I/O scheduling class (`idle` or `best-effort`) or None to keep it
+    :param niceness: Increment of the nice value
+    :param thread_only: Only lower the calling thread, e.g. one deleting snapshots during a backup. Linux keeps both
+        priorities per thread, elsewhere the nice value applies to the whole process
+    """
+    if niceness:
+        os.nice(niceness)
+
+    if io_class is not None:
+        ionice = shutil.which('ionice')
+        if ionice is None:
+            print('Note: ionice not found, keeping I/O priority')
+            return
+        if not thread_only:
+            task = os.getpid()
+        elif hasattr(threading, 'get_native_id'):
+            task = threading.get_native_id()
+        else:
+            print('Note: thread id unknown, keeping I/O priority')
+            return
+        subprocess.check_call([ionice, '-c', IO_CLASSES[io_class], '-p', str(task)])
+
+
+def run_lowered(function, io_class=None, niceness=0):
+    """
+    Call a function on a thread of its own with lowered CPU and I/O priority, e.g. to delete snapshots within a process
+    that continues with further backups. Threads started by the function inherit the priority, it ends with them.
+
+    :param io_class: I/O scheduling class (`idle` or `best-effort`) or None to keep it
+    :param niceness: Increment of the nice value
+    :return Result of the function
+    """
+    outcome = {}
+
+    def run():
+        try:
+            lower_priority(io_class, niceness, thread_only=True)
+            outcome['result'] = function()
+        except BaseException as error:
+            outcome['error'] = error
+
+    thread = threading.Thread(target=run, name='lowered-priority')
+    thread.start()
+    thread.join()
+    if 'error' in outcome:
+        raise outcome['error']
+    return outcome['result']
+
+
+def _clear_folder(folder):
+    """
+    Unlink all non-folder entries of a folder.
+
+    :return Number of unlinked entries and subfolders
+    :rtype (int, list[str])
+    """
+    unlinked = 0
+    subfolders = []
+    with os.scandir(folder) as iterator:
+        for entry in iterator:
+            if entry.is_dir(follow_symlinks=False):
+                subfolders.append(entry.path)
+            else:
+                os.unlink(entry.path)
+                unlinked += 1
+    return unlinked, subfolders
+
+
+class Reaper(object):
+    """
+    Delete expired snapshots moved into the trash (`_delete.*` folders) of a snapshot root.
+
+    Files are unlinked by a pool of threads, one folder at a time per thread, which keeps several metadata operations in
+    flight. The trash folders are the only state, so an interrupted reaper simply continues on the next run.
+    """
+
+    def __init__(self, snapshot_root, workers=4):
+        self.snapshot_root = snapshot_root
+        self.workers = workers
+
+    def pending(self):
+        """
+        Trash folders waiting for deletion.
+
+        :rtype list[str]
+        """
+        try:
+            with os.scandir(self.snapshot_root) as iterator:
+                return sorted(entry.path for entry in iterator
+                              if entry.name.startswith(TRASH_PREFIX) and entry.is_dir(follow_symlinks=False))
+        except FileNotFoundError:
+            return []
+
+    def delete_tree(self, folder):
+        """
+        Delete a folder tree in parallel.
+
+        :return Number of deleted files
+        :rtype int
+        """
+        folders = [folder]
+        unlinked = 0
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            running = {pool.submit(_clear_folder, folder)}
+            while running:
+                done, running = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    count, subfolders = future.result()
+                    unlinked += count
+                    folders.extend(subfolders)
+                    running.update(pool.submit(_clear_folder, subfolder) for subfolder in subfolders)
+
+        # Every folder was added after its parent, so children are removed first
+        for current in reversed(folders):
+            os.rmdir(current)
+        return unlinked
+
+    def reap(self):
+        """
+        Delete all pending trash folders.
+
+        :return Number of deleted snapshots and files
+        :rtype (int, int)
+        """
+        snapshots = 0
+        files = 0
+        for folder in self.pending():
+            print('-- Deleting {name}'.format(name=path.basename(folder)))
+            files += self.delete_tree(folder)
+            snapshots += 1
+        return snapshots, files
@@ -0,0 +1,205 @@
+from collections import OrderedDict, namedtuple
+
+import re
+import threading
+import time
+
+ProgressEvent = namedtuple('ProgressEvent', ['bytes', 'percent', 'rate', 'eta'])
+
+
+def _number(text):
+    return int(text.replace(',', '').replace('.', ''))
+
+
+class TransferStats(object):
+    """Transfer statistics of one or more rsync runs."""
+
+    fields = ('files', 'files_transferred', 'total_size', 'transferred_size', 'bytes_sent', 'bytes_received')
+
+    def __init__(self, **values):
+        for field in self.fields:
+            setattr(self, field, values.get(field, 0))
+
+    def merge(self, other):
+        """Add statistics of another run."""
+        for field in self.fields:
+            setattr(self, field, getattr(self, field) + getattr(other, field))
+
+    def as_dict(self):
+        return OrderedDict((field, getattr(self, field)) for field in self.fields)
+
+    def __eq__(self, other):
+        return isinstance(other, TransferStats) and self.as_dict() == other.as_dict()
+
+    def __repr__(self):
+        return 'TransferStats({values})'.format(values=', '.join('{field}={value}'.format(field=field, value=value)
+                                                                 for field, value in self.as_dict().items()))
+
+
+class RsyncOutputParser(object):
+    """
+    Parse rsync output line by line into transfer statistics (`--stats`) and progress events (`--info=progress2`).
+    Lines not understood are ignored, so the parser can be fed with any output.
+    """
+
+    _stats_patterns = [
+        ('files', re.compile(r'^Number of files: ([\d,.]+)')),
+        ('files_transferred', re.compile(r'^Number of (?:regular )?files transferred: ([\d,.]+)')),
+        ('total_size', re.compile(r'^Total file size: ([\d,.]+) bytes')),
+        ('transferred_size', re.compile(r'^Total transferred file size: ([\d,.]+) bytes')),
+        ('bytes_sent', re.compile(r'^Total bytes sent: ([\d,.]+)')),
+        ('bytes_received', re.compile(r'^Total bytes received: ([\d,.]+)')),
+    ]
+    _progress_pattern = re.compile(r'^\s*(?P<bytes>[\d,.]+)\s+(?P<percent>\d+)%\s+(?P<rate>\S+/s)\s+(?P<eta>[\d:]+)')
+
+    def __init__(self, on_progress=None):
+        """
+        :param on_progress: Called with every :class:`ProgressEvent`
+        """
+        self.stats = TransferStats()
+        self.on_progress = on_progress
+
+    @classmethod
+    def is_progress(cls, line):
+        """
+        Check whether a line is a progress update, which is reported by :attr:`on_progress` instead of being printed.
+
+        :rtype bool
+        """
+        return cls._progress_pattern.match(line) is not None
+
+    def feed(self, line):
+        line = line.strip()
+        for field, pattern in self._stats_patterns:
+            match = pattern.match(line)
+            if match:
+                setattr(self.stats, field, _number(match.group(1)))
+                return
+
+        match = self._progress_pattern.match(line)
+        if match and self.on_progress is not None:
+            self.on_progress(ProgressEvent(bytes=_number(match.group('bytes')), percent=int(match.group('percent')),
+                                           rate=match.group('rate'), eta=match.group('eta')))
+
+
+def is_output(line):
+    """Whether to print a line of rsync output, progress updates are reported by :class:`ProgressPrinter`."""
+    return not RsyncOutputParser.is_progress(line)
+
+
+class ProgressPrinter(object):
+    """
+    Print the progress of concurrent rsync runs, at most one line per run and interval. Called with a label of the run
+    (e.g. the destination) and a :class:`ProgressEvent`, thread-safe.
+    """
+
+    def __init__(self, interval=10.0, clock=time.monotonic):
+        """
+        :param interval: Seconds between two progress lines of the same run
+        """
+        self.interval = interval
+        self.clock = clock
+        self._printed = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, label, event):
+        with self._lock:
+            now = self.clock()
+            if now - self._printed.get(label, now - self.interval) < self.interval:
+                return
+            self._printed[label] = now
+        print('-- Progress of {label}: {bytes} bytes ({percent}%) at {rate}, {eta} remaining'.format(
+            label=label, bytes=event.bytes, percent=event.percent, rate=event.rate, eta=event.eta), flush=True)
+
+
+class StepReport(object):
+    """Wall time and transfer statistics of one executor step, plus counters of steps not transferring anything."""
+
+    def __init__(self, name, duration=0.0, stats=None, counters=None):
+        """
+        :type stats: TransferStats
+        :param counters: Step specific counters, e.g. number of hashed files
+        :type counters: collections.OrderedDict[str, int]
+        """
+        self.name = name
+        self.duration = duration
+        self.stats = stats
+        self.counters = counters if counters is not None else OrderedDict()
+
+    def __repr__(self):
+        return 'StepReport({name!r}, {duration:.3f})'.format(name=self.name, duration=self.duration)
+
+
+class StatsCollector(object):
+    """Thread-safe accumulation of the statistics of concurrent rsync runs."""
+
+    def __init__(self):
+        self.stats = TransferStats()
+        self._lock = threading.Lock()
+
+    def add(self, stats):
+        with self._lock:
+            self.stats.merge(stats)
+
+
+class RunReport(object):
+    """Result of :func:`multilevelbackup.backup.perform_backup`."""
+
+    def __init__(self, tasks=None):
+        """
+        :param tasks: Levels and whether they were due
+        :type tasks: collections.OrderedDict[str, bool]
+        """
+        self.tasks = tasks if tasks is not None else OrderedDict()
+        self.steps = []
+        self.error = None
+
+    @property
+    def performed(self):
+        """Whether a backup was performed."""
+        return bool(self.steps)
+
+    def add_step(self, step):
+        self.steps.append(step)
+
+    def step(self, name):
+        """
+        Get first step of given name.
+
+        :rtype StepReport
+        """
+        for step in self.steps:
+            if step.name == name:
+                return step
+        return None
+
+    @property
+    def duration(self):
+        return sum(step.duration for step in self.steps)
+
+    @property
+    def stats(self):
+        """
+        Transfer statistics of all steps.
+
+        :rtype TransferStats
+        """
+        stats = TransferStats()
+        for step in self.steps:
+            if step.stats is not None:
+                stats.merge(step.stats)
+        return stats
+
+    def format(self):
+        """
+        Format report as table of steps.
+
+        :rtype str
+        """
+        lines = ['{step:<24} {duration:>10} {files:>12} {size:>16}'.format(step='STEP', duration='DURATION',
+                                                                           files='TRANSFERRED', size='BYTES')]
+        for step in self.steps + [StepReport('total', self.duration, self.stats)]:
+            stats = step.stats or TransferStats()
+            lines.append('{step:<24} {duration:>9.1f}s {files:>12} {size:>16}'.format(
+                step=step.name, duration=step.duration, files=stats.files_transferred, size=stats.transferred_size))
+        return '\n'.join(lines)
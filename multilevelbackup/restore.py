@@ -0,0 +1,269 @@
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from os import path
+
+import errno
+import os
+import stat
+import threading
+import time
+
+_chunk_size = 8 * 1024 * 1024
+_fallback_errors = {errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP}
+_temporary_suffix = '.restore-tmp'
+
+
+def _copy_range(source_fd, target_fd):
+    while os.copy_file_range(source_fd, target_fd, _chunk_size):
+        pass
+
+
+def _send(source_fd, target_fd):
+    while os.sendfile(target_fd, source_fd, None, _chunk_size):
+        pass
+
+
+def _read_write(source_fd, target_fd):
+    while True:
+        data = os.read(source_fd, 1024 * 1024)
+        if not data:
+            return
+        view = memoryview(data)
+        while view:
+            view = view[os.write(target_fd, view):]
+
+
+def copy_data(source, target):
+    """
+    Copy the content of a file without passing it through user space if possible: `copy_file_range` (which even
+    shares blocks on filesystems supporting it), `sendfile` if the kernel cannot copy between the filesystems, and plain
+    reads and writes as last resort. All methods continue at the current file positions, so a fallback does not copy
+    anything twice.
+    """
+    methods = [_send, _read_write]
+    if hasattr(os, 'copy_file_range'):
+        methods.insert(0, _copy_range)
+
+    source_fd = os.open(source, os.O_RDONLY)
+    try:
+        target_fd = os.open(target, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        try:
+            for method in methods:
+                try:
+                    method(source_fd, target_fd)
+                    return
+                except OSError as error:
+                    if error.errno not in _fallback_errors or method is methods[-1]:
+                        raise
+        finally:
+            os.close(target_fd)
+    finally:
+        os.close(source_fd)
+
+
+def copy_metadata(info, target):
+    """
+    Apply owner, mode and access and modification time of a stat result to a restored entry. The owner is only kept
+    if the process may change it.
+
+    :type info: os.stat_result
+    """
+    is_link = stat.S_ISLNK(info.st_mode)
+    try:
+        os.chown(target, info.st_uid, info.st_gid, follow_symlinks=False)
+    except PermissionError:
+        pass
+    if not is_link:
+        # After chown, which clears setuid and setgid bits
+        os.chmod(target, stat.S_IMODE(info.st_mode))
+    os.utime(target, ns=(info.st_atime_ns, info.st_mtime_ns), follow_symlinks=not is_link)
+
+
+def is_restored(info, target):
+    """
+    Check whether a regular file was already restored completely, e.g. by an interrupted restore. The modification time
+    is applied after the content was copied, so a partial copy never matches.
+
+    :type info: os.stat_result
+    :rtype bool
+    """
+    try:
+        current = os.lstat(target)
+    except FileNotFoundError:
+        return False
+    return stat.S_ISREG(current.st_mode) and current.st_size == info.st_size and \
+        current.st_mtime_ns == info.st_mtime_ns
+
+
+class RestorePlan(object):
+    """
+    Entries below a snapshot path to restore. Every inode is copied once, all further paths of it within the restored
+    set become hardlinks to the first copy.
+    """
+
+    def __init__(self, source, target):
+        self.source = source
+        self.target = target
+        self.folders = []
+        self.files = []
+        self.links = []
+        self.others = []
+        self.total_bytes = 0
+
+    @staticmethod
+    def create(source, target):
+        """
+        Walk the source. Folders are listed parents first.
+
+        :rtype RestorePlan
+        """
+        plan = RestorePlan(source, target)
+        first_paths = {}
+        pending = [(source, target, os.lstat(source))]
+        while pending:
+            source_entry, target_entry, info = pending.pop()
+            if stat.S_ISDIR(info.st_mode):
+                plan.folders.append((target_entry, info))
+                with os.scandir(source_entry) as iterator:
+                    for entry in iterator:
+                        pending.append((entry.path, path.join(target_entry, entry.name),
+                                        entry.stat(follow_symlinks=False)))
+            elif stat.S_ISREG(info.st_mode):
+                key = (info.st_dev, info.st_ino)
+                if info.st_nlink > 1 and key in first_paths:
+                    plan.links.append((target_entry, first_paths[key]))
+                    continue
+                first_paths[key] = target_entry
+                plan.files.append((source_entry, target_entry, info))
+                plan.total_bytes += info.st_size
+            else:
+                plan.others.append((source_entry, target_entry, info))
+        return plan
+
+
+class RestoreProgress(object):
+    """Thread-safe counters of a restore."""
+
+    def __init__(self, total_files, total_bytes):
+        self.total_files = total_files
+        self.total_bytes = total_bytes
+        self.files = 0
+        self.bytes = 0
+        self.skipped = 0
+        self.linked = 0
+        self._lock = threading.Lock()
+
+    def add(self, size, skipped=False):
+        with self._lock:
+            self.files += 1
+            self.bytes += size
+            self.skipped += skipped
+
+    def format(self):
+        return '{files}/{total_files} files, {bytes}/{total_bytes} bytes'.format(
+            files=self.files, total_files=self.total_files, bytes=self.bytes, total_bytes=self.total_bytes)
+
+
+def _restore_file(source, target, info, progress):
+    if is_restored(info, target):
+        progress.add(info.st_size, skipped=True)
+        return
+
+    # Replace instead of overwriting, the target might be hardlinked to other files
+    temporary = path.join(path.dirname(target), '.' + path.basename(target) + _temporary_suffix)
+    try:
+        copy_data(source, temporary)
+        copy_metadata(info, temporary)
+        os.replace(temporary, target)
+    except BaseException:
+        _remove(temporary)
+        raise
+    progress.add(info.st_size)
+
+
+def _restore_other(source, target, info):
+    if stat.S_ISLNK(info.st_mode):
+        link = os.readlink(source)
+        try:
+            if os.readlink(target) == link:
+                return
+        except OSError:
+            pass
+        _remove(target)
+        os.symlink(link, target)
+    else:
+        _remove(target)
+        try:
+            os.mknod(target, info.st_mode, info.st_rdev)
+        except PermissionError:
+            print('Note: cannot restore special file {target}'.format(target=target))
+            return
+    copy_metadata(info, target)
+
+
+def _remove(target):
+    try:
+        os.unlink(target)
+    except FileNotFoundError:
+        pass
+
+
+def restore_tree(source, target, workers=4, progress_interval=2.0, pool_factory=ThreadPoolExecutor):
+    """
+    Restore a file or folder of a snapshot with metadata, keeping hardlinks between the restored files.
+
+    Folders are created first, then files are copied by a pool of threads, since the copies run in the kernel. Files
+    already restored with the same size and modification time are skipped, so an interrupted restore continues where
+    it stopped. Hardlinks are created once all files are copied, folder metadata is applied last.
+
+    :param progress_interval: Seconds between progress lines
+    :rtype RestoreProgress
+    """
+    plan = RestorePlan.create(source, target)
+    progress = RestoreProgress(len(plan.files), plan.total_bytes)
+
+    os.makedirs(path.dirname(path.abspath(target)), exist_ok=True)
+    for folder, _ in plan.folders:
+        if path.isdir(folder):
+            # Restored before, its final mode may not allow to write into it
+            os.chmod(folder, stat.S_IMODE(os.stat(folder).st_mode) | stat.S_IRWXU)
+        else:
+            os.makedirs(folder)
+    for source_entry, target_entry, info in plan.others:
+        _restore_other(source_entry, target_entry, info)
+
+    with pool_factory(max_workers=workers) as pool:
+        files = iter(plan.files)
+        running = set()
+        last_report = time.monotonic()
+        try:
+            while True:
+                # Keep the queue short, a snapshot may contain millions of files
+                for source_entry, target_entry, info in files:
+                    running.add(pool.submit(_restore_file, source_entry, target_entry, info, progress))
+                    if len(running) >= workers * 4:
+                        break
+                if not running:
+                    break
+
+                done, running = wait(running, timeout=progress_interval, return_when=FIRST_COMPLETED)
+                for future in done:
+                    future.result()
+                if time.monotonic() - last_report >= progress_interval:
+                    print('-- Restored {progress}'.format(progress=progress.format()), flush=True)
+                    last_report = time.monotonic()
+        except BaseException:
+            for future in running:
+                future.cancel()
+            raise
+
+    for link, first_path in plan.links:
+        if path.lexists(link) and path.samefile(link, first_path):
+            continue
+        _remove(link)
+        os.link(first_path, link)
+        progress.linked += 1
+
+    # Creating entries changed the modification times, deepest folders first
+    for folder, info in reversed(plan.folders):
+        copy_metadata(info, folder)
+    return progress
@@ -0,0 +1,215 @@
+from os import path
+
+import json
+import os
+import shlex
+import time
+
+from .helpers import atomic_write
+
+SYNC_FOLDER = '.sync'
+TRASH_PREFIX = '_delete.'
+JOURNAL_FILE = '.rotation-journal'
+
+
+class RotationError(Exception):
+    """Raised if the snapshot root does not match a rotation step."""
+
+
+def fsync_folder(folder):
+    """Flush renames within a folder to disk."""
+    handle = os.open(folder, os.O_RDONLY)
+    try:
+        os.fsync(handle)
+    finally:
+        os.close(handle)
+
+
+def snapshot_name(interval, index):
+    return '{interval}.{index}'.format(interval=interval, index=index)
+
+
+class RotationPlan(object):
+    """Ordered renames within a snapshot root performing the rotation of one or more levels."""
+
+    def __init__(self, renames):
+        """
+        :param renames: Source and target names relative to the snapshot root
+        :type renames: list[(str, str)]
+        """
+        self.renames = list(renames)
+
+    @staticmethod
+    def create(intervals, levels, existing, stamp=None):
+        """
+        Plan the rotation of all given levels at once. Expired snapshots are renamed into the trash.
+
+        :param intervals: All interval names and retaining counts in ascending order
+        :type intervals: collections.OrderedDict[str, int]
+        :param levels: Levels to rotate, in the order they are rotated (highest first)
+        :type levels: list[str]
+        :param existing: Names existing in the snapshot root
+        :type existing: set[str]
+        :rtype RotationPlan
+        """
+        stamp = time.strftime('%Y%m%dT%H%M%S') if stamp is None else stamp
+        names = list(intervals)
+        existing = set(existing)
+        renames = []
+
+        def rename(source, target):
+            renames.append((source, target))
+            existing.remove(source)
+            existing.add(target)
+
+        for level in levels:
+            position = names.index(level)
+            count = intervals[level]
+            if position == 0:
+                source = SYNC_FOLDER
+            else:
+                lower = names[position-1]
+                source = snapshot_name(lower, intervals[lower] - 1)
+
+            if source not in existing:
+                continue
+
+            oldest = snapshot_name(level, count-1)
+            if oldest in existing:
+                rename(oldest, '{prefix}{stamp}.{name}'.format(prefix=TRASH_PREFIX, stamp=stamp, name=oldest))
+
+            for index in reversed(range(count-1)):
+                current = snapshot_name(level, index)
+                if current in existing:
+                    rename(current, snapshot_name(level, index+1))
+
+            rename(source, snapshot_name(level, 0))
+
+        return RotationPlan(renames)
+
+    @property
+    def expired(self):
+        """Trash names of the snapshots expired by this plan."""
+        return [target for _, target in self.renames if target.startswith(TRASH_PREFIX)]
+
+    def describe(self, snapshot_root):
+        """
+        Describe plan as shell commands.
+
+        :rtype list[str]
+        """
+        return ['mv {source} {target}'.format(source=shlex.quote(path.join(snapshot_root, source)),
+                                              target=shlex.quote(path.join(snapshot_root, target)))
+                for source, target in self.renames]
+
+    def __len__(self):
+        return len(self.renames)
+
+
+class RotationEngine(object):
+    """
+    Apply rotation plans as a journaled batch of renames.
+
+    The plan is written to a journal in the snapshot root before the first rename and every completed rename is appended
+    to it. An interrupted rotation can therefore be completed or rolled back by replaying the journal. Only the rename
+    following the last recorded one is uncertain, which is resolved by checking whether its source or target exists.
+    """
+
+    def __init__(self, snapshot_root):
+        self.snapshot_root = snapshot_root
+
+    @property
+    def journal_file(self):
+        return path.join(self.snapshot_root, JOURNAL_FILE)
+
+    def existing_names(self):
+        try:
+            return set(os.listdir(self.snapshot_root))
+        except FileNotFoundError:
+            return set()
+
+    def plan(self, intervals, levels):
+        """
+        Plan rotation of given levels for the current content of the snapshot root.
+
+        :rtype RotationPlan
+        """
+        return RotationPlan.create(intervals, levels, self.existing_names())
+
+    def _is_performed(self, source, target):
+        """
+        Check whether rename was already performed.
+
+        :raise RotationError: Raised if snapshot root matches neither state
+        """
+        source_exists = path.lexists(path.join(self.snapshot_root, source))
+        target_exists = path.lexists(path.join(self.snapshot_root, target))
+
+        if source_exists != target_exists:
+            return target_exists
+        raise RotationError('Cannot rename {source} to {target} in {root}'.format(source=source, target=target,
+                                                                                  root=self.snapshot_root))
+
+    def _write_journal(self, renames):
+        atomic_write(self.journal_file, json.dumps(renames) + '\n')
+        fsync_folder(self.snapshot_root)
+
+    def _read_journal(self):
+        """
+        :return Renames and number of completed renames or None if no rotation was interrupted
+        :rtype (list[(str, str)], int)
+        """
+        try:
+            with open(self.journal_file, 'r') as journal:
+                lines = journal.read().splitlines()
+        except FileNotFoundError:
+            return None
+
+        renames = [tuple(rename) for rename in json.loads(lines[0])]
+        return renames, len(lines) - 1
+
+    def _replay(self, renames, done=0):
+        with open(self.journal_file, 'a') as journal:
+            for position in range(done, len(renames)):
+                source, target = renames[position]
+                if position > done or not self._is_performed(source, target):
+                    os.rename(path.join(self.snapshot_root, source), path.join(self.snapshot_root, target))
+                    fsync_folder(self.snapshot_root)
+
+                journal.write('.\n')
+                journal.flush()
+                os.fsync(journal.fileno())
+
+        os.unlink(self.journal_file)
+        fsync_folder(self.snapshot_root)
+
+    def apply(self, plan):
+        """Apply rotation plan. An interrupted rotation is completed first."""
+        self.recover()
+        if not len(plan):
+            return
+
+        self._write_journal(plan.renames)
+        self._replay(plan.renames)
+
+    def recover(self, rollback=False):
+        """
+        Complete an interrupted rotation or roll it back.
+
+        :return Whether an interrupted rotation was found
+        :rtype bool
+        """
+        journal = self._read_journal()
+        if journal is None:
+            return False
+
+        renames, done = journal
+        if rollback:
+            if done < len(renames) and self._is_performed(*renames[done]):
+                done += 1
+            renames = [(target, source) for source, target in reversed(renames[:done])]
+            self._write_journal(renames)
+            done = 0
+
+        self._replay(renames, done)
+        return True
@@ -0,0 +1,456 @@
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date, timedelta
+
+import contextlib
+import random
+import re
+import time
+
+from .backup import DefaultSnapshotManager, perform_backup_async
+from .process import run_sync
+from .report import StepReport
+from .rotation import SYNC_FOLDER, RotationPlan, snapshot_name
+
+SIMULATED_ROOT = '<simulated>'
+DAY = 24 * 60 * 60
+
+# Monday, so day numbers map to weekdays directly
+SIMULATION_START = date(2001, 1, 1)
+
+# Random uptime patterns are simulated in independent runs of this length
+CHUNK_YEARS = 100
+
+
+class VirtualClock(object):
+    """Clock of a simulation, only moving forward when it is set."""
+
+    def __init__(self, now=0.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class MemorySnapshotStore(object):
+    """
+    Snapshot root kept in memory, offering the parts of :class:`multilevelbackup.inventory.SnapshotInventory` used to
+    decide upcoming levels. Snapshots are only names with a modification time, expired ones are dropped immediately.
+    """
+
+    _snapshot_pattern = re.compile(r'^(?P<interval>\w+)\.(?P<index>\d+)$')
+
+    def __init__(self):
+        self.names = {}
+
+    def invalidate(self):
+        pass
+
+    def revalidate(self):
+        pass
+
+    @property
+    def expired(self):
+        return []
+
+    def exists(self, interval, index):
+        return snapshot_name(interval, index) in self.names
+
+    def mtime(self, interval, index):
+        return self.names.get(snapshot_name(interval, index))
+
+    def snapshot_date(self, interval, index):
+        stamp = self.mtime(interval, index)
+        return date.fromtimestamp(stamp) if stamp is not None else None
+
+    def indices(self, interval):
+        indices = []
+        for name in self.names:
+            match = self._snapshot_pattern.match(name)
+            if match and match.group('interval') == interval:
+                indices.append(int(match.group('index')))
+        return sorted(indices)
+
+
+class SimulatedExecutor(object):
+    """
+    Executor performing syncs and rotations on a :class:`MemorySnapshotStore`. Rotations are planned like the ones of
+    :class:`multilevelbackup.native.NativeBackupExecutor`, so snapshots move between the levels the same way.
+    """
+
+    def __init__(self, store, intervals, clock):
+        """
+        :type store: MemorySnapshotStore
+        :param intervals: Interval names and retaining counts in ascending order
+        :type intervals: collections.OrderedDict[str, int]
+        :type clock: VirtualClock
+        """
+        self.store = store
+        self.intervals = intervals
+        self.clock = clock
+        self.syncs = 0
+
+    def perform_sync(self):
+        self.store.names[SYNC_FOLDER] = self.clock()
+        self.syncs += 1
+        return StepReport('sync')
+
+    def perform_levels(self, levels):
+        names = self.store.names
+        plan = RotationPlan.create(self.intervals, levels, set(names), stamp='simulated')
+        expired = set(plan.expired)
+        for source, target in plan.renames:
+            stamp = names.pop(source)
+            if target not in expired:
+                names[target] = stamp
+        return StepReport('+'.join(levels))
+
+
+class UptimePattern(object):
+    """Decides whether the machine runs on a simulated day, day 0 being a Monday."""
+
+    def __init__(self, name, is_up, period=None):
+        """
+        :param is_up: Callable taking the day number
+        :param period: Number of days after which a deterministic pattern repeats, None for random patterns
+        """
+        self.name = name
+        self.is_up = is_up
+        self.period = period
+
+    def __call__(self, day):
+        return self.is_up(day)
+
+
+def uptime_pattern(name, rng):
+    """
+    Create an uptime pattern by name:
+
+    - `always`: every day
+    - `workdays`: Monday to Friday
+    - `weekly`: Sundays only
+    - `laptop`: 80% of the days, plus two or three weeks of vacation about twice a year
+    - `random:P`: every day with probability P, e.g. `random:0.5`
+
+    :param rng: Random generator of the simulation
+    :type rng: random.Random
+    :rtype UptimePattern
+    :raise ValueError: Raised if the pattern is unknown
+    """
+    if name == 'always':
+        return UptimePattern(name, lambda day: True, period=1)
+    if name == 'workdays':
+        return UptimePattern(name, lambda day: day % 7 < 5, period=7)
+    if name == 'weekly':
+        return UptimePattern(name, lambda day: day % 7 == 6, period=7)
+
+    if name == 'laptop':
+        vacation = [0]
+
+        def laptop(day):
+            if vacation[0] > 0:
+                vacation[0] -= 1
+                return False
+            if rng.random() < 2 / 365:
+                vacation[0] = rng.randint(14, 21) - 1
+                return False
+            return rng.random() < 0.8
+        return UptimePattern(name, laptop)
+
+    match = re.match(r'^random:(?P<probability>[\d.]+)$', name)
+    if match:
+        probability = float(match.group('probability'))
+        if 0 < probability <= 1:
+            return UptimePattern(name, lambda day: rng.random() < probability)
+
+    raise ValueError('Unknown uptime pattern \'{name}\', expected always, workdays, weekly, laptop or random:P'.format(
+        name=name))
+
+
+def parse_pattern(text):
+    """
+    Check name of an uptime pattern, see :func:`uptime_pattern`.
+
+    :rtype str
+    :raise ValueError: Raised if the pattern is unknown
+    """
+    uptime_pattern(text, random.Random())
+    return text
+
+
+def parse_retain(text):
+    """
+    Parse retaining count of the form `<interval>=<count>`.
+
+    :rtype (str, int)
+    :raise ValueError: Raised if definition is malformed
+    """
+    match = re.match(r'^(?P<name>\w+)=(?P<count>\d+)$', text.strip())
+    if not match or int(match.group('count')) < 1:
+        raise ValueError('Invalid retaining count \'{text}\', expected e.g. \'daily=7\''.format(text=text))
+    return match.group('name'), int(match.group('count'))
+
+
+class LevelStats(object):
+    """Snapshot count and age of the newest snapshot of a level, accumulated over all samples."""
+
+    def __init__(self, name):
+        self.name = name
+        self.samples = 0
+        self.snapshots = 0
+        self.age_total = 0.0
+        self.age_max = 0.0
+
+    @property
+    def mean_snapshots(self):
+        return self.snapshots / self.samples if self.samples else 0.0
+
+    @property
+    def mean_age(self):
+        return self.age_total / self.samples if self.samples else 0.0
+
+
+class SimulationResult(object):
+    """
+    Statistics of a simulation, sampled at the end of every day after the warm-up. Ages and gaps are given in days.
+    """
+
+    _counters = ['days', 'up_days', 'backup_days', 'syncs', 'samples', 'oldest_total', 'spacing_total']
+    _level_counters = ['samples', 'snapshots', 'age_total']
+
+    def __init__(self, pattern, intervals):
+        self.pattern = pattern
+        self.days = 0
+        self.up_days = 0
+        self.backup_days = 0
+        self.syncs = 0
+        self.samples = 0
+        self.levels = OrderedDict((name, LevelStats(name)) for name in intervals)
+        self.oldest_min = None
+        self.oldest_total = 0.0
+        self.spacing_total = 0.0
+        self.spacing_max = 0.0
+        self.cycle = None
+
+        # Level and whether it is the newest snapshot of the level, by snapshot name
+        self._snapshots = {}
+        for name, count in intervals.items():
+            for index in range(count):
+                self._snapshots[snapshot_name(name, index)] = (self.levels[name], index == 0)
+
+    @property
+    def years(self):
+        return self.days / 365.2425
+
+    def sample(self, store, now):
+        """Record the state of the snapshot store."""
+        points = []
+        for name, stamp in store.names.items():
+            snapshot = self._snapshots.get(name)
+            if snapshot is None:
+                continue
+            stats, newest = snapshot
+            stats.snapshots += 1
+            if newest:
+                age = (now - stamp) / DAY
+                stats.samples += 1
+                stats.age_total += age
+                stats.age_max = max(stats.age_max, age)
+            points.append(stamp)
+
+        if not points:
+            return
+        points.sort()
+        self.samples += 1
+        oldest = (now - points[0]) / DAY
+        self.oldest_min = oldest if self.oldest_min is None else min(self.oldest_min, oldest)
+        self.oldest_total += oldest
+
+        # Worst loss when restoring: the largest gap between two restore points or since the newest one
+        points.append(now)
+        spacing = max(newer - older for older, newer in zip(points, points[1:])) / DAY
+        self.spacing_total += spacing
+        self.spacing_max = max(self.spacing_max, spacing)
+
+    def merge(self, other):
+        """Add the statistics of an independent simulation of the same pattern."""
+        for name in self._counters:
+            setattr(self, name, getattr(self, name) + getattr(other, name))
+        for stats, other_stats in zip(self.levels.values(), other.levels.values()):
+            for name in self._level_counters:
+                setattr(stats, name, getattr(stats, name) + getattr(other_stats, name))
+            stats.age_max = max(stats.age_max, other_stats.age_max)
+        if other.oldest_min is not None:
+            self.oldest_min = other.oldest_min if self.oldest_min is None else min(self.oldest_min, other.oldest_min)
+        self.spacing_max = max(self.spacing_max, other.spacing_max)
+
+    def counters(self):
+        """
+        :return Values of all accumulating counters, e.g. to repeat a cycle
+        :rtype list[float]
+        """
+        values = [getattr(self, name) for name in self._counters]
+        for stats in self.levels.values():
+            values.extend(getattr(stats, name) for name in self._level_counters)
+        return values
+
+    def repeat(self, previous, times):
+        """
+        Add the counters accumulated since `previous` was taken again `times` times. Maxima and minima stay the same,
+        since the repeated days had the same state.
+
+        :param previous: Counters as returned by :meth:`counters`
+        """
+        values = iter(current - before for current, before in zip(self.counters(), previous))
+        for name in self._counters:
+            setattr(self, name, getattr(self, name) + next(values) * times)
+        for stats in self.levels.values():
+            for name in self._level_counters:
+                setattr(stats, name, getattr(stats, name) + next(values) * times)
+
+
+def simulate(intervals, min_gaps=None, pattern='always', years=100, invocations=1, seed=0, warmup=None):
+    """
+    Simulate daily invocations of multilevel-backup with the real level decisions and :func:`perform_backup_async`,
+    against a virtual clock and a snapshot root in memory. All invocations share one event loop.
+
+    Deterministic uptime patterns run into a cycle once all levels are filled: as soon as the snapshot ages at the start
+    of a day repeat an earlier day, the remaining simulation only repeats this cycle and it is fast-forwarded. This is
+    exact as long as all minimum gaps are whole days, otherwise every day is simulated.
+
+    :param intervals: Interval names and retaining counts in ascending order
+    :type intervals: collections.OrderedDict[str, int]
+    :param min_gaps: Minimum gaps overriding the default ones
+    :param pattern: Uptime pattern, see :func:`uptime_pattern`
+    :param invocations: Invocations per day the machine is up, spread evenly over the day
+    :param warmup: Days before the first sample, by default the time to fill all levels
+    :rtype SimulationResult
+    """
+    is_up = uptime_pattern(pattern, random.Random(seed))
+    clock = VirtualClock()
+    store = MemorySnapshotStore()
+    manager = DefaultSnapshotManager(SIMULATED_ROOT, intervals, min_gaps, inventory=store, clock=clock)
+    executor = SimulatedExecutor(store, intervals, clock)
+    result = SimulationResult(pattern, intervals)
+
+    if warmup is None:
+        warmup = max(level.count * level.min_gap.days for level in manager.levels)
+    end = warmup + int(years * 365.2425)
+    offsets = [(invocation + 0.5) * DAY / invocations for invocation in range(invocations)]
+
+    # Day and invocation of every timestamp, snapshot ages are compared by them
+    moments = {}
+
+    def moment(day, invocation):
+        # Local midnight, days are not always 24 hours long
+        stamp = time.mktime((SIMULATION_START + timedelta(days=day)).timetuple()) + offsets[invocation]
+        moments[stamp] = (day, invocation)
+        return stamp
+
+    async def run_days():
+        # One event loop for all invocations
+        cyclic = is_up.period is not None and all(level.by_day for level in manager.levels)
+        seen = {}
+        day = 0
+        while day < end:
+            recording = day >= warmup
+            if cyclic and recording:
+                state = (day % is_up.period, frozenset((name, day - moments[stamp][0], moments[stamp][1])
+                                                       for name, stamp in store.names.items()))
+                if state in seen:
+                    first, counters = seen[state]
+                    cycles = (end - day) // (day - first)
+                    result.repeat(counters, cycles)
+                    result.cycle = day - first
+                    shift = cycles * (day - first)
+                    for name, stamp in list(store.names.items()):
+                        store.names[name] = moment(moments[stamp][0] + shift, moments[stamp][1])
+                    day += shift
+                    cyclic = False
+                    continue
+                seen[state] = (day, result.counters())
+
+            if is_up(day):
+                syncs = executor.syncs
+                for invocation in range(invocations):
+                    clock.now = moment(day, invocation)
+                    await perform_backup_async(manager, executor)
+                if recording:
+                    result.up_days += 1
+                    result.backup_days += executor.syncs > syncs
+                    result.syncs += executor.syncs - syncs
+
+            if recording:
+                result.days += 1
+                result.sample(store, time.mktime((SIMULATION_START + timedelta(days=day + 1)).timetuple()) - 1)
+            day += 1
+
+    # The report of every invocation is of no interest
+    with contextlib.redirect_stdout(_Discard()):
+        run_sync(run_days())
+
+    return result
+
+
+def simulate_pattern(intervals, min_gaps=None, pattern='always', years=100, invocations=1, seed=0, workers=1,
+                     pool_factory=ProcessPoolExecutor):
+    """
+    Simulate an uptime pattern like :func:`simulate`. Random patterns do not run into a cycle, so they are split into
+    independent runs of 100 years, each with its own warm-up and seed. The runs are simulated on `workers` processes
+    and merged, the result does not depend on the number of workers.
+
+    :rtype SimulationResult
+    """
+    if uptime_pattern(pattern, random.Random(seed)).period is not None or years <= CHUNK_YEARS:
+        return simulate(intervals, min_gaps, pattern, years, invocations, seed)
+
+    chunks = []
+    while years > 0:
+        chunks.append(min(years, CHUNK_YEARS))
+        years -= chunks[-1]
+    arguments = [(intervals, min_gaps, pattern, chunk_years, invocations,
+                  '{seed}.{chunk}'.format(seed=seed, chunk=chunk)) for chunk, chunk_years in enumerate(chunks)]
+
+    if workers > 1:
+        with pool_factory(max_workers=workers) as pool:
+            results = [future.result() for future in [pool.submit(simulate, *args) for args in arguments]]
+    else:
+        results = [simulate(*args) for args in arguments]
+
+    result = results[0]
+    for other in results[1:]:
+        result.merge(other)
+    return result
+
+
+class _Discard(object):
+    def write(self, text):
+        return len(text)
+
+    def flush(self):
+        pass
+
+
+def format_simulation(result):
+    """
+    Format statistics of a simulation.
+
+    :type result: SimulationResult
+    :rtype str
+    """
+    lines = ['-- Pattern {pattern}: {years:.0f} years, {up:.1%} days up, {backups:.1%} days backed up, {syncs} syncs'
+             .format(pattern=result.pattern, years=result.years, up=result.up_days / max(result.days, 1),
+                     backups=result.backup_days / max(result.days, 1), syncs=result.syncs)]
+    if not result.samples:
+        lines.append('Simulation too short to sample')
+        return '\n'.join(lines)
+
+    lines.append('{level:<10} {snapshots:>10} {mean:>16} {max:>16}'.format(level='LEVEL', snapshots='SNAPSHOTS',
+                                                                           mean='NEWEST AGE AVG', max='NEWEST AGE MAX'))
+    for stats in result.levels.values():
+        lines.append('{0.name:<10} {0.mean_snapshots:>10.1f} {0.mean_age:>14.1f} d {0.age_max:>14.1f} d'.format(stats))
+    lines.append('Oldest restore point: {minimum:.1f} d min, {mean:.1f} d avg'.format(
+        minimum=result.oldest_min or 0.0, mean=result.oldest_total / result.samples))
+    lines.append('Restore point spacing: {mean:.1f} d avg of largest gap, {worst:.1f} d worst'.format(
+        mean=result.spacing_total / result.samples, worst=result.spacing_max))
+    return '\n'.join(lines)
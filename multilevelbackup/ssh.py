@@ -0,0 +1,81 @@
+from os import path
+
+import os
+import shlex
+import shutil
+import subprocess
+import tempfile
+import threading
+
+
+class SshPool(object):
+    """
+    Shared SSH connections of a backup run, one OpenSSH ControlMaster per destination.
+
+    The first rsync to a host opens the master connection and leaves it running in the background, all further rsync
+    runs to this host reuse it without another handshake and authentication. The control sockets are kept in a private
+    temporary folder. :meth:`close` stops all masters and removes the folder, it is safe to call more than once.
+    """
+
+    def __init__(self, ssh='ssh', ssh_args='', persist=60):
+        """
+        :param ssh: SSH command, e.g. `cmd_ssh` of the config
+        :param ssh_args: Additional SSH arguments, e.g. `ssh_args` of the config
+        :param persist: Seconds an idle master connection stays open, so masters of a killed run expire by themselves
+        """
+        self.ssh = ssh
+        self.ssh_args = shlex.split(ssh_args)
+        self.persist = persist
+        self.destinations = set()
+        self.control_folder = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _control_options(control_folder):
+        # %C is a hash of local host, remote host, port and user, which keeps socket paths short
+        return ['-o', 'ControlPath=' + path.join(control_folder, '%C')]
+
+    def rsh(self, destination):
+        """
+        Remote shell for rsync syncing from a destination, creating the pool on first use.
+
+        :param destination: SSH destination, e.g. `root@example.com`
+        :return Value for rsync's `--rsh`
+        :rtype str
+        """
+        with self._lock:
+            if self.control_folder is None:
+                self.control_folder = tempfile.mkdtemp(prefix='mlb-ssh-')
+            self.destinations.add(destination)
+
+        options = ['-o', 'ControlMaster=auto', '-o', 'ControlPersist={persist}'.format(persist=self.persist)]
+        command = [self.ssh] + self.ssh_args + options + self._control_options(self.control_folder)
+        return ' '.join(shlex.quote(argument) for argument in command)
+
+    def close(self):
+        """Stop all master connections."""
+        with self._lock:
+            destinations = sorted(self.destinations)
+            control_folder = self.control_folder
+            self.destinations = set()
+            self.control_folder = None
+
+        if control_folder is None:
+            return
+        if not os.listdir(control_folder):
+            # No master was started, e.g. in a dry run
+            destinations = []
+        for destination in destinations:
+            command = [self.ssh] + self.ssh_args + self._control_options(control_folder) + ['-O', 'exit', destination]
+            try:
+                subprocess.call(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=30)
+            except (OSError, subprocess.TimeoutExpired) as error:
+                print('Note: cannot close SSH connection to {destination}: {error}'.format(destination=destination,
+                                                                                           error=error))
+        shutil.rmtree(control_folder, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,255 @@
+from os import path
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import asyncio
+import json
+import os
+import re
+import threading
+import time
+
+from .helpers import atomic_write
+from .rotation import SYNC_FOLDER
+
+CHECKPOINT_FILE = '.sync.checkpoint'
+
+_remote_patterns = [
+    re.compile(r'^rsync://(?:[^@/]+@)?(?P<host>[^/:]+)'),
+    re.compile(r'^(?:[^@/:]+@)?(?P<host>[^/:]+)::'),
+    re.compile(r'^(?:[^@/:]+@)?(?P<host>[^/:]+):'),
+]
+
+
+class SyncError(Exception):
+    """Raised if the sync of at least one backup point failed."""
+
+    def __init__(self, failures):
+        """
+        :param failures: Failed backup point destinations and their errors
+        :type failures: dict[str, Exception]
+        """
+        self.failures = failures
+        details = '; '.join('{destination}: {error}'.format(destination=destination, error=error)
+                            for destination, error in failures.items())
+        super(SyncError, self).__init__('Sync of {count} backup point(s) failed ({details})'.format(
+            count=len(failures), details=details))
+
+
+class IncompleteSyncError(Exception):
+    """Raised if the sync folder would be taken over by the lowest level without being synced completely."""
+
+
+class SyncCheckpoint(object):
+    """
+    Progress of the sync into the sync folder of a snapshot root, stored next to the sync folder.
+
+    Destinations are recorded as soon as they are synced completely, so a sync interrupted by suspending the machine or
+    unplugging the drive continues with the remaining destinations into the same sync folder. The sync is marked
+    complete once all destinations were synced. A checkpoint belongs to the sync folder it was written for and expires
+    after `max_age` seconds without progress, a stale sync is synced again completely.
+    """
+
+    def __init__(self, snapshot_root, max_age=7 * 24 * 3600.0, clock=time.time):
+        self.checkpoint_file = path.join(snapshot_root, CHECKPOINT_FILE)
+        self.sync_folder = path.join(snapshot_root, SYNC_FOLDER)
+        self.max_age = max_age
+        self.clock = clock
+        self.updated = None
+        self.folder = None
+        self.destinations = []
+        self.complete = False
+        self._lock = threading.Lock()
+
+    def _folder_identity(self):
+        try:
+            info = os.stat(self.sync_folder)
+        except FileNotFoundError:
+            return None
+        return [info.st_dev, info.st_ino]
+
+    def _reset(self):
+        self.updated = None
+        self.folder = None
+        self.destinations = []
+        self.complete = False
+
+    def load(self):
+        """Load checkpoint if it belongs to the current sync folder and is not stale."""
+        try:
+            with open(self.checkpoint_file, 'r') as checkpoint:
+                data = json.load(checkpoint)
+            self.updated = float(data['updated'])
+            self.folder = data['folder']
+            self.destinations = list(data['destinations'])
+            self.complete = bool(data['complete'])
+        except (OSError, ValueError, KeyError, TypeError):
+            self._reset()
+            return self
+
+        if self.clock() - self.updated > self.max_age or \
+                (self.folder is not None and self.folder != self._folder_identity()):
+            self._reset()
+        return self
+
+    def save(self):
+        self.updated = self.clock()
+        self.folder = self._folder_identity()
+        atomic_write(self.checkpoint_file, json.dumps({'updated': self.updated, 'folder': self.folder,
+                                                       'destinations': self.destinations,
+                                                       'complete': self.complete}))
+
+    def remove(self):
+        self._reset()
+        try:
+            os.unlink(self.checkpoint_file)
+        except FileNotFoundError:
+            pass
+
+    @property
+    def resumed(self):
+        """Whether an interrupted sync is continued."""
+        return bool(self.destinations) and not self.complete
+
+    def pending(self, destinations):
+        """
+        :return Destinations not synced yet
+        :rtype list[str]
+        """
+        return [destination for destination in destinations if destination not in self.destinations]
+
+    def begin(self):
+        """Start a sync, continuing the loaded one if it was interrupted."""
+        if self.complete:
+            # Synced again, e.g. after the rotation failed
+            self._reset()
+        self.save()
+
+    def destination_done(self, destination):
+        with self._lock:
+            if destination not in self.destinations:
+                self.destinations.append(destination)
+            self.save()
+
+    def finish(self):
+        with self._lock:
+            self.complete = True
+            self.save()
+
+
+def source_host(source):
+    """
+    Determine remote host of a backup point source.
+
+    :return Host name or None for local sources
+    :rtype str
+    """
+    for pattern in _remote_patterns:
+        match = pattern.match(source)
+        if match:
+            return match.group('host')
+    return None
+
+
+def ssh_destination(source):
+    """
+    Determine the SSH destination of a backup point source synced over a remote shell, e.g. `root@example.com` for
+    `root@example.com:/etc/`.
+
+    :return User and host or None for local sources and rsync daemon sources
+    :rtype str
+    """
+    if source.startswith('rsync://'):
+        return None
+    match = re.match(r'^(?P<destination>(?:[^@/:]+@)?[^/:]+):(?!:)', source)
+    return match.group('destination') if match else None
+
+
+def source_group(source):
+    """
+    Determine group of a backup point source: the remote host for remote sources, the device for local ones.
+
+    :rtype str
+    """
+    host = source_host(source)
+    if host is not None:
+        return 'host:' + host
+
+    try:
+        return 'device:{device}'.format(device=os.stat(path.abspath(source)).st_dev)
+    except OSError:
+        return 'path:' + source
+
+
+def group_destinations(backup_points):
+    """
+    Group destinations of backup points by their source group. rsnapshot syncs all points of a destination at once, so
+    each destination is assigned to the group of its first backup point.
+
+    :type backup_points: list[multilevelbackup.config.BackupPoint]
+    :rtype collections.OrderedDict[str, list[str]]
+    """
+    groups = OrderedDict()
+    seen = set()
+    for point in backup_points:
+        if point.destination in seen:
+            continue
+        seen.add(point.destination)
+        groups.setdefault(source_group(point.source), []).append(point.destination)
+    return groups
+
+
+def sync_concurrently(groups, sync_destination, workers):
+    """
+    Sync groups concurrently, destinations within a group one after another. All syncs are finished before returning.
+
+    :param groups: Destinations per group
+    :type groups: dict[str, list[str]]
+    :param sync_destination: Function syncing a single destination
+    :param workers: Maximum number of groups synced at the same time
+    :raise SyncError: Raised after all syncs finished if at least one failed
+    """
+
+    def sync_group(destinations):
+        failures = OrderedDict()
+        for destination in destinations:
+            try:
+                sync_destination(destination)
+            except Exception as error:
+                failures[destination] = error
+        return failures
+
+    failures = OrderedDict()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for group_failures in pool.map(sync_group, groups.values()):
+            failures.update(group_failures)
+
+    if failures:
+        raise SyncError(failures)
+
+
+async def sync_concurrently_async(groups, sync_destination, workers):
+    """
+    Sync groups concurrently like :func:`sync_concurrently`, with a coroutine function syncing a single destination
+    instead of threads. Cancelling cancels all running syncs.
+
+    :raise SyncError: Raised after all syncs finished if at least one failed
+    """
+    slots = asyncio.Semaphore(workers)
+
+    async def sync_group(destinations):
+        failures = OrderedDict()
+        async with slots:
+            for destination in destinations:
+                try:
+                    await sync_destination(destination)
+                except Exception as error:
+                    failures[destination] = error
+        return failures
+
+    failures = OrderedDict()
+    for group_failures in await asyncio.gather(*[sync_group(destinations) for destinations in groups.values()]):
+        failures.update(group_failures)
+
+    if failures:
+        raise SyncError(failures)
@@ -0,0 +1,297 @@
+from array import array
+from bisect import bisect_left
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from os import path
+
+import hashlib
+import heapq
+import os
+import struct
+import time
+
+from .helpers import atomic_write
+from .inventory import SnapshotInventory
+from .rotation import snapshot_name
+
+SnapshotUsage = namedtuple('SnapshotUsage', ['name', 'files', 'unique_bytes', 'shared_bytes'])
+IndexEntry = namedtuple('IndexEntry', ['size', 'nlink', 'first', 'last', 'snapshots'])
+
+
+def _scan_folder(folder):
+    """
+    Stat all non-folder entries of a folder.
+
+    :return Inode, allocated bytes and link count of every entry and subfolders
+    :rtype (list[(int, int, int)], list[str])
+    """
+    records = []
+    subfolders = []
+    with os.scandir(folder) as iterator:
+        for entry in iterator:
+            if entry.is_dir(follow_symlinks=False):
+                subfolders.append(entry.path)
+            else:
+                stat = entry.stat(follow_symlinks=False)
+                records.append((stat.st_ino, stat.st_blocks * 512, stat.st_nlink))
+    return records, subfolders
+
+
+class SnapshotScan(object):
+    """
+    Inodes of one snapshot in ascending order with their allocated bytes, link counts (at scan time) and number of
+    paths within the snapshot, stored in flat arrays.
+    """
+
+    _header = struct.Struct('<4sBdQ')
+    _magic = b'MLBU'
+    _version = 1
+
+    def __init__(self, inodes=None, sizes=None, nlinks=None, paths=None, scanned=None):
+        self.inodes = inodes if inodes is not None else array('Q')
+        self.sizes = sizes if sizes is not None else array('Q')
+        self.nlinks = nlinks if nlinks is not None else array('Q')
+        self.paths = paths if paths is not None else array('Q')
+        self.scanned = time.time() if scanned is None else scanned
+
+    def __len__(self):
+        return len(self.inodes)
+
+    @staticmethod
+    def walk(folder, workers=8):
+        """
+        Walk a snapshot with a pool of threads, one folder at a time per thread.
+
+        :rtype SnapshotScan
+        """
+        inodes = array('Q')
+        sizes = array('Q')
+        nlinks = array('Q')
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            running = {pool.submit(_scan_folder, folder)}
+            while running:
+                done, running = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    records, subfolders = future.result()
+                    for inode, size, nlink in records:
+                        inodes.append(inode)
+                        sizes.append(size)
+                        nlinks.append(nlink)
+                    running.update(pool.submit(_scan_folder, subfolder) for subfolder in subfolders)
+
+        # Sort by inode and merge hardlinks within the snapshot
+        scan = SnapshotScan()
+        for position in sorted(range(len(inodes)), key=inodes.__getitem__):
+            if scan.inodes and scan.inodes[-1] == inodes[position]:
+                scan.paths[-1] += 1
+                continue
+            scan.inodes.append(inodes[position])
+            scan.sizes.append(sizes[position])
+            scan.nlinks.append(nlinks[position])
+            scan.paths.append(1)
+        return scan
+
+    def to_bytes(self):
+        header = self._header.pack(self._magic, self._version, self.scanned, len(self))
+        return header + b''.join(values.tobytes() for values in (self.inodes, self.sizes, self.nlinks, self.paths))
+
+    @staticmethod
+    def from_bytes(data):
+        """
+        :raise ValueError: Raised if data is not a scan of this version
+        """
+        header = SnapshotScan._header
+        if len(data) < header.size:
+            raise ValueError('Truncated snapshot scan')
+        magic, version, scanned, count = header.unpack_from(data)
+        if magic != SnapshotScan._magic or version != SnapshotScan._version:
+            raise ValueError('Unknown snapshot scan format')
+
+        columns = []
+        offset = header.size
+        for _ in range(4):
+            values = array('Q')
+            end = offset + count * values.itemsize
+            if end > len(data):
+                raise ValueError('Truncated snapshot scan')
+            values.frombytes(data[offset:end])
+            columns.append(values)
+            offset = end
+        return SnapshotScan(*columns, scanned=scanned)
+
+
+class ScanCache(object):
+    """
+    Scans of the snapshots of one snapshot root, stored in the local state folder.
+
+    A scan is keyed by device, inode and modification time of its snapshot folder. Rotation only renames snapshot
+    folders, so after a rotation only the new snapshot has to be walked.
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+
+    @staticmethod
+    def folder_for_root(state_dir, snapshot_root):
+        key = hashlib.sha1(path.normpath(snapshot_root).encode('utf-8')).hexdigest()[:16]
+        return path.join(state_dir, 'usage-{key}'.format(key=key))
+
+    @staticmethod
+    def key(snapshot):
+        stat = os.stat(snapshot)
+        return '{dev}-{ino}-{mtime}.scan'.format(dev=stat.st_dev, ino=stat.st_ino, mtime=stat.st_mtime_ns)
+
+    def load(self, key):
+        """
+        :return Cached scan or None if not cached
+        :rtype SnapshotScan
+        """
+        try:
+            with open(path.join(self.folder, key), 'rb') as scan_file:
+                return SnapshotScan.from_bytes(scan_file.read())
+        except (OSError, ValueError):
+            return None
+
+    def store(self, key, scan):
+        atomic_write(path.join(self.folder, key), scan.to_bytes())
+
+    def prune(self, keys):
+        """Remove all scans except the given ones."""
+        try:
+            names = os.listdir(self.folder)
+        except FileNotFoundError:
+            return
+        for name in set(names) - set(keys):
+            os.unlink(path.join(self.folder, name))
+
+
+class UsageIndex(object):
+    """
+    Index of all inodes of a set of snapshots with their allocated bytes, link count and the first and last snapshot
+    containing them, stored in flat arrays sorted by inode.
+
+    Bytes of an inode found in a single snapshot are unique to it and freed by deleting the snapshot, all other bytes
+    are shared. Links from outside of the snapshots (like the `.sync` folder of rsnapshot) are not considered.
+    """
+
+    def __init__(self, names, scans):
+        """
+        :param names: Snapshot names, newest first
+        :type names: list[str]
+        :type scans: list[SnapshotScan]
+        """
+        self.names = list(names)
+        self.inodes = array('Q')
+        self.sizes = array('Q')
+        self.nlinks = array('Q')
+        self.first = array('H')
+        self.last = array('H')
+        self.counts = array('H')
+
+        self._files = [len(scan) for scan in scans]
+        self._unique = [0] * len(scans)
+        self._shared = [0] * len(scans)
+        self._build(scans)
+
+    def _build(self, scans):
+        def entries(position, scan):
+            for offset, inode in enumerate(scan.inodes):
+                yield inode, position, offset
+
+        group = []
+        for entry in heapq.merge(*(entries(position, scan) for position, scan in enumerate(scans))):
+            if group and group[0][0] != entry[0]:
+                self._add(group, scans)
+                group = []
+            group.append(entry)
+        if group:
+            self._add(group, scans)
+
+    def _add(self, group, scans):
+        inode, first, offset = group[0]
+        size = scans[first].sizes[offset]
+        # Link counts only change by adding or removing snapshots, so the latest scan knows best
+        newest = max(group, key=lambda entry: scans[entry[1]].scanned)
+        self.inodes.append(inode)
+        self.sizes.append(size)
+        self.nlinks.append(scans[newest[1]].nlinks[newest[2]])
+        self.first.append(first)
+        self.last.append(group[-1][1])
+        self.counts.append(len(group))
+
+        usage = self._unique if len(group) == 1 else self._shared
+        for _, position, _ in group:
+            usage[position] += size
+
+    def __len__(self):
+        return len(self.inodes)
+
+    @property
+    def total_bytes(self):
+        return sum(self.sizes)
+
+    def lookup(self, inode):
+        """
+        :return Index entry of an inode or None if not part of any snapshot
+        :rtype IndexEntry
+        """
+        low = bisect_left(self.inodes, inode)
+        if low == len(self.inodes) or self.inodes[low] != inode:
+            return None
+        return IndexEntry(size=self.sizes[low], nlink=self.nlinks[low], first=self.names[self.first[low]],
+                          last=self.names[self.last[low]], snapshots=self.counts[low])
+
+    def usage(self):
+        """
+        Unique and shared bytes per snapshot, newest first.
+
+        :rtype list[SnapshotUsage]
+        """
+        return [SnapshotUsage(name, files, unique, shared) for name, files, unique, shared
+                in zip(self.names, self._files, self._unique, self._shared)]
+
+
+def build_usage_index(snapshot_root, intervals, cache=None, workers=8):
+    """
+    Scan all snapshots of a snapshot root and index their inodes. Cached scans are reused.
+
+    :type intervals: dict[str, int]
+    :type cache: ScanCache
+    :rtype UsageIndex
+    """
+    inventory = SnapshotInventory(snapshot_root)
+    names = [snapshot_name(interval, index) for interval in intervals for index in inventory.indices(interval)]
+
+    scans = []
+    keys = []
+    for name in names:
+        snapshot = path.join(snapshot_root, name)
+        scan = None
+        if cache is not None:
+            keys.append(ScanCache.key(snapshot))
+            scan = cache.load(keys[-1])
+        if scan is None:
+            print('-- Scanning {name}'.format(name=name))
+            scan = SnapshotScan.walk(snapshot, workers)
+            if cache is not None:
+                cache.store(keys[-1], scan)
+        scans.append(scan)
+
+    if cache is not None:
+        cache.prune(keys)
+    return UsageIndex(names, scans)
+
+
+def format_usage(index):
+    """
+    Format usage of all snapshots as table.
+
+    :type index: UsageIndex
+    :rtype str
+    """
+    lines = ['{name:<16} {files:>12} {unique:>16} {shared:>16}'.format(name='SNAPSHOT', files='FILES',
+                                                                       unique='UNIQUE BYTES', shared='SHARED BYTES')]
+    for usage in index.usage():
+        lines.append('{0.name:<16} {0.files:>12} {0.unique_bytes:>16} {0.shared_bytes:>16}'.format(usage))
+    lines.append('{name:<16} {files:>12} {total:>16}'.format(name='total', files=len(index), total=index.total_bytes))
+    return '\n'.join(lines)
@@ -0,0 +1,165 @@
+from collections import deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from os import path
+
+import hashlib
+import json
+import os
+import time
+
+from .helpers import atomic_write
+from .manifest import MANIFEST_FILE, Manifest, hash_file
+
+MISSING = 'missing'
+SIZE = 'size'
+CONTENT = 'content'
+ERROR = 'error'
+
+Failure = namedtuple('Failure', ['path', 'reason'])
+
+
+def _check_files(snapshot, entries):
+    """
+    Re-hash files of a snapshot, run in a worker process.
+
+    :param entries: Relative paths, sizes and digests from the manifest
+    :return Failures
+    :rtype list[(str, str)]
+    """
+    failures = []
+    for relative, size, digest in entries:
+        file_name = path.join(snapshot, relative)
+        try:
+            if os.stat(file_name).st_size != size:
+                failures.append((relative, SIZE))
+            elif hash_file(file_name) != digest:
+                failures.append((relative, CONTENT))
+        except FileNotFoundError:
+            failures.append((relative, MISSING))
+        except OSError:
+            # E.g. unreadable or a read error of the device, the other files are verified nevertheless
+            failures.append((relative, ERROR))
+    return failures
+
+
+class RateLimiter(object):
+    """Limit throughput by waiting before work of a given amount is started."""
+
+    def __init__(self, rate, clock=time.monotonic, sleep=time.sleep):
+        """
+        :param rate: Amount per second or None for no limit
+        """
+        self.rate = rate
+        self.clock = clock
+        self.sleep = sleep
+        self._start = None
+        self._amount = 0
+
+    def acquire(self, amount):
+        if not self.rate:
+            return
+        now = self.clock()
+        if self._start is None:
+            self._start = now
+        self._amount += amount
+        # Wait until the total amount so far is within the rate
+        delay = self._amount / self.rate - (now - self._start)
+        if delay > 0:
+            self.sleep(delay)
+
+
+class VerifyCheckpoint(object):
+    """
+    Progress of the verification of one manifest, stored in the local state folder. The position is the number of
+    manifest entries completely verified, so an interrupted verification continues from there.
+    """
+
+    def __init__(self, state_dir, manifest_file):
+        info = os.stat(manifest_file)
+        identity = '{name}\0{dev}\0{ino}\0{mtime}'.format(name=path.abspath(manifest_file), dev=info.st_dev,
+                                                          ino=info.st_ino, mtime=info.st_mtime_ns)
+        key = hashlib.sha1(identity.encode('utf-8', 'surrogateescape')).hexdigest()[:16]
+        self.checkpoint_file = path.join(state_dir, 'verify-{key}.json'.format(key=key))
+        self.position = 0
+        self.failures = []
+
+    def load(self):
+        try:
+            with open(self.checkpoint_file, 'r') as checkpoint:
+                data = json.load(checkpoint)
+            self.position = data['position']
+            self.failures = [Failure(*failure) for failure in data['failures']]
+        except (OSError, ValueError, KeyError, TypeError):
+            self.position = 0
+            self.failures = []
+        return self
+
+    def save(self):
+        atomic_write(self.checkpoint_file, json.dumps({'position': self.position, 'failures': self.failures}))
+
+    def remove(self):
+        try:
+            os.unlink(self.checkpoint_file)
+        except FileNotFoundError:
+            pass
+
+
+def verify_snapshot(snapshot, workers=4, rate=None, checkpoint=None, batch_size=64, checkpoint_interval=10.0,
+                    pool_factory=ProcessPoolExecutor):
+    """
+    Re-hash all files of a snapshot and compare them with its manifest.
+
+    Files are hashed in batches by a pool of processes. Batches are started only as fast as the rate limit allows and
+    are completed in manifest order, so the checkpoint is saved regularly with the number of entries verified.
+
+    :param rate: Maximum bytes read per second or None for no limit
+    :type checkpoint: VerifyCheckpoint
+    :return Number of verified files and failures
+    :rtype (int, list[Failure])
+    :raise ValueError: Raised if the snapshot has no valid manifest
+    """
+    limiter = RateLimiter(rate)
+    position = checkpoint.position if checkpoint is not None else 0
+    failures = list(checkpoint.failures) if checkpoint is not None else []
+    last_save = time.monotonic()
+
+    with Manifest(path.join(snapshot, MANIFEST_FILE)) as manifest, pool_factory(max_workers=workers) as pool:
+        total = len(manifest)
+        running = deque()
+        next_index = position
+
+        try:
+            while next_index < total or running:
+                # Keep every worker busy with one more batch queued
+                while next_index < total and len(running) < workers * 2:
+                    end = min(next_index + batch_size, total)
+                    entries = [(entry.path, entry.size, entry.digest)
+                               for entry in (manifest[index] for index in range(next_index, end))]
+                    limiter.acquire(sum(size for _, size, _ in entries))
+                    running.append((end, pool.submit(_check_files, snapshot, entries)))
+                    next_index = end
+
+                end, future = running.popleft()
+                failures.extend(Failure(*failure) for failure in future.result())
+                position = end
+
+                if checkpoint is not None and time.monotonic() - last_save >= checkpoint_interval:
+                    _save_checkpoint(checkpoint, position, failures)
+                    last_save = time.monotonic()
+        except BaseException:
+            # Interrupted, e.g. by shutdown, continue from the last completed batch next time
+            if checkpoint is not None:
+                _save_checkpoint(checkpoint, position, failures)
+            for _, future in running:
+                future.cancel()
+            raise
+
+    if checkpoint is not None:
+        checkpoint.remove()
+    return total, failures
+
+
+def _save_checkpoint(checkpoint, position, failures):
+    checkpoint.position = position
+    checkpoint.failures = failures
+    checkpoint.save()
@@ -0,0 +1,173 @@
+from collections import OrderedDict
+
+from multilevelbackup import AsyncBackupExecutor, DefaultBackupExecutor, StepTimeoutError, perform_backup, \
+    perform_backup_async
+from multilevelbackup.process import run_command_async, run_sync
+
+import asyncio
+import os
+import pytest
+import subprocess
+import sys
+import threading
+import time
+
+
+#
+# Test helper
+#
+
+
+class FixedManager(object):
+    def __init__(self, **tasks):
+        self.upcoming_tasks = OrderedDict(sorted(tasks.items()))
+        self.performed = []
+
+    def step_performed(self, step):
+        self.performed.append(step)
+
+
+class SleepingExecutor(object):
+    def __init__(self, sync_seconds=0.0):
+        self.sync_seconds = sync_seconds
+        self.rotated = []
+
+    async def perform_sync(self):
+        await asyncio.sleep(self.sync_seconds)
+
+    def perform_levels(self, levels):
+        self.rotated.extend(levels)
+
+
+class Collector(object):
+    def __init__(self):
+        self.lines = []
+
+    def feed(self, line):
+        self.lines.append(line)
+
+
+def is_running(pid, wait=2.0):
+    """Whether a process still exists and is no zombie after waiting up to `wait` seconds for it to end."""
+    deadline = time.monotonic() + wait
+    while True:
+        try:
+            with open('/proc/{pid}/stat'.format(pid=pid), 'r') as stat:
+                running = stat.read().rsplit(')', 1)[1].split()[0] != 'Z'
+        except FileNotFoundError:
+            running = False
+        if not running or time.monotonic() > deadline:
+            return running
+        time.sleep(0.01)
+
+
+#
+# Actual tests
+#
+
+
+def test_run_command_async_streams_lines(capsys):
+    script = 'import sys; sys.stdout.write("a\\rb\\r\\nc\\n"); sys.stderr.write("d")'
+    collector = Collector()
+    assert run_sync(run_command_async([sys.executable, '-c', script], handlers=[collector])) == 0
+
+    assert collector.lines == ['a', 'b', 'c', 'd']
+    assert capsys.readouterr().out == 'a\nb\nc\nd\n'
+
+
+def test_run_command_async_failure():
+    with pytest.raises(subprocess.CalledProcessError) as excinfo:
+        run_sync(run_command_async([sys.executable, '-c', 'import sys; sys.exit(3)'], echo=False))
+    assert excinfo.value.returncode == 3
+
+
+def test_run_command_async_outside_main_thread():
+    # The daemon performs backups in a worker thread with an event loop of its own
+    results = []
+    thread = threading.Thread(target=lambda: results.append(
+        run_sync(run_command_async([sys.executable, '-c', 'pass'], echo=False))))
+    thread.start()
+    thread.join(10.0)
+    assert results == [0]
+
+
+@pytest.mark.skipif(not os.path.isdir('/proc/self'), reason='requires /proc')
+def test_cancel_stops_process_group():
+    # The command starts a child of its own, which has to be stopped as well
+    script = 'import subprocess, time; print(subprocess.Popen(["sleep", "60"]).pid, flush=True); time.sleep(60)'
+    collector = Collector()
+
+    async def run():
+        await asyncio.wait_for(run_command_async([sys.executable, '-c', script], handlers=[collector], echo=False,
+                                                 kill_grace=1.0), 1.0)
+
+    with pytest.raises(asyncio.TimeoutError):
+        run_sync(run())
+
+    assert not is_running(int(collector.lines[0]))
+
+
+def test_step_timeout():
+    manager = FixedManager(daily=True, weekly=False)
+    executor = SleepingExecutor(sync_seconds=10.0)
+
+    with pytest.raises(StepTimeoutError):
+        run_sync(perform_backup_async(manager, executor, timeouts={'sync': 0.05}))
+    with pytest.raises(StepTimeoutError):
+        perform_backup(manager, executor, timeouts={'sync': 0.05})
+    assert manager.performed == []
+    assert executor.rotated == []
+
+
+def test_async_and_blocking_steps():
+    manager = FixedManager(daily=True, weekly=True)
+    executor = SleepingExecutor()
+
+    report = perform_backup(manager, executor)
+
+    assert executor.rotated == ['weekly', 'daily']
+    assert manager.performed == ['sync', 'weekly', 'daily']
+    assert [step.name for step in report.steps] == ['sync', 'weekly+daily']
+
+
+def test_background_overlaps_rotation():
+    started = threading.Event()
+    manager = FixedManager(daily=True)
+
+    class WaitingExecutor(SleepingExecutor):
+        def perform_levels(self, levels):
+            # Only returns if the background work runs at the same time
+            assert started.wait(5.0)
+            super(WaitingExecutor, self).perform_levels(levels)
+
+    def background(background_manager):
+        assert background_manager is manager
+        started.set()
+
+    perform_backup(manager, WaitingExecutor(), background=[background])
+    assert manager.performed == ['sync', 'daily']
+
+
+def test_background_failure_reported_after_rotation():
+    manager = FixedManager(daily=True)
+    executor = SleepingExecutor()
+
+    def background(_):
+        raise RuntimeError('reaping failed')
+
+    with pytest.raises(RuntimeError):
+        perform_backup(manager, executor, background=[background])
+    assert executor.rotated == ['daily']
+
+
+def test_blocking_executor_wraps_async_executor(mocker):
+    async def hang(*args, **kwargs):
+        await asyncio.sleep(10.0)
+
+    run = mocker.patch('multilevelbackup.backup.run_command_async', side_effect=hang)
+    executor = DefaultBackupExecutor(conf_file='rsnapshot.conf')
+    assert isinstance(executor.async_executor, AsyncBackupExecutor)
+
+    with pytest.raises(StepTimeoutError):
+        run_sync(perform_backup_async(FixedManager(daily=True), executor, timeouts={'sync': 0.05}))
+    assert run.call_count == 1
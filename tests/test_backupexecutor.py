@@ -18,7 +18,7 @@ def backup_executor(request):
 
 @pytest.fixture(scope='function')
 def mock_call_process(mocker):
-    return mocker.patch('subprocess.check_call')
+    return mocker.patch('multilevelbackup.backup.run_command_async')
 
 
 def get_call_from_mock(mock_call_process):
@@ -52,28 +52,52 @@ def test_perform_sync(backup_executor, mock_call_process):
     assert full_call.find('sync') != -1
 
 
-def test_perform_daily(backup_executor, mock_call_process):
+@pytest.mark.parametrize('level', ['hourly', 'daily', 'weekly', 'monthly', 'yearly'])
+def test_perform_level(backup_executor, mock_call_process, level):
     executor, dry_run = backup_executor
-    executor.perform_daily()
+    executor.perform_level(level)
 
     full_call = get_call_from_mock(mock_call_process)
     check_call(full_call, dry_run=dry_run)
-    assert full_call.find('daily') != -1
+    assert full_call.endswith(' ' + level)
 
 
-def test_perform_weekly(backup_executor, mock_call_process):
-    executor, dry_run = backup_executor
-    executor.perform_weekly()
+def create_config(tmpdir, lines):
+    config = tmpdir.join('rsnapshot.conf')
+    config.write('snapshot_root\t{root}/snapshots/\n'.format(root=tmpdir) + '\n'.join(lines) + '\n')
+    return str(config)
 
-    full_call = get_call_from_mock(mock_call_process)
-    check_call(full_call, dry_run=dry_run)
-    assert full_call.find('weekly') != -1
 
+def test_perform_sync_concurrent(tmpdir, mock_call_process):
+    conf_file = create_config(tmpdir, ['backup\ta@one:/etc/\tone/', 'backup\ta@two:/etc/\ttwo/',
+                                       'backup\ta@two:/home/\ttwo/'])
+    executor = DefaultBackupExecutor(conf_file=conf_file, sync_workers=2)
+    executor.perform_sync()
 
-def test_perform_monthly(backup_executor, mock_call_process):
-    executor, dry_run = backup_executor
-    executor.perform_monthly()
+    calls = sorted(' '.join(call[0][0]) for call in mock_call_process.call_args_list)
+    assert calls == ['rsnapshot -c {file} sync one/'.format(file=conf_file),
+                     'rsnapshot -c {file} sync two/'.format(file=conf_file)]
 
-    full_call = get_call_from_mock(mock_call_process)
-    check_call(full_call, dry_run=dry_run)
-    assert full_call.find('monthly') != -1
+
+def test_perform_sync_concurrent_lockfile(tmpdir, mock_call_process):
+    conf_file = create_config(tmpdir, ['lockfile\t/var/run/rsnapshot.pid', 'backup\ta@one:/etc/\tone/',
+                                       'backup\ta@two:/etc/\ttwo/'])
+    executor = DefaultBackupExecutor(conf_file=conf_file, sync_workers=2)
+    executor.perform_sync()
+
+    assert mock_call_process.call_count == 1
+    assert get_call_from_mock(mock_call_process).endswith(' sync')
+
+
+@pytest.mark.parametrize('sync_workers', [1, 2])
+def test_dry_run_not_governed(tmpdir, mock_call_process, mocker, sync_workers):
+    conf_file = create_config(tmpdir, ['backup\ta@one:/etc/\tone/', 'backup\ta@two:/etc/\ttwo/'])
+    governor = mocker.Mock()
+    governor.command_prefix.return_value = ['nice']
+    executor = DefaultBackupExecutor(conf_file=conf_file, dry_run=True, sync_workers=sync_workers, governor=governor)
+    executor.perform_sync()
+
+    calls = mock_call_process.call_args_list
+    assert len(calls) == sync_workers
+    assert all(call[0][0][0] == 'rsnapshot' and call[1]['on_start'] is None for call in calls)
+    assert governor.start.call_count == 0
@@ -0,0 +1,31 @@
+from os import path
+
+import json
+import subprocess
+import sys
+
+BENCHMARK = path.join(path.dirname(path.dirname(path.abspath(__file__))), 'benchmarks', 'run.py')
+
+
+#
+# Actual tests
+#
+
+
+def test_benchmarks_write_results(tmpdir):
+    output = str(tmpdir.join('results.json'))
+    subprocess.check_call([sys.executable, BENCHMARK, '--files', '20', '--repeat', '1', '-o', output])
+
+    with open(output) as results_file:
+        results = json.load(results_file)
+    assert results['meta']['files'] == 20
+    names = [result['name'] for result in results['results']]
+    assert names[0] == 'decision_inventory'
+    assert 'rotation_all_levels' in names
+    assert 'deletion_reaper_4' in names
+    assert names[-1] == 'backup_native_fake_rsync'
+    assert all(result['min'] <= result['median'] for result in results['results'])
+
+    # Comparing against itself with a negative threshold reports every benchmark as regression
+    assert subprocess.call([sys.executable, BENCHMARK, '--files', '20', '--repeat', '1', '--only', 'decision',
+                            '-o', str(tmpdir.join('new.json')), '--compare', output, '--threshold', '-1']) == 1
@@ -0,0 +1,200 @@
+from collections import OrderedDict
+
+from multilevelbackup.catalog import Catalog, format_version
+from multilevelbackup.cli import main
+from multilevelbackup.rotation import SYNC_FOLDER, RotationPlan
+
+import multilevelbackup.catalog
+import os
+import pytest
+import shutil
+
+
+#
+# Test helper
+#
+
+
+intervals = OrderedDict([('daily', 3)])
+
+
+class SnapshotRoot(object):
+    """Snapshot root taking snapshots like rsync with --link-dest: unchanged files are hardlinked."""
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.files = {}
+        self.stamp = 1000000000
+        os.makedirs(folder)
+
+    def take(self, **changes):
+        self.files.update(changes)
+        sync = os.path.join(self.folder, SYNC_FOLDER)
+        previous = os.path.join(self.folder, 'daily.0')
+        for name, content in self.files.items():
+            target = os.path.join(sync, 'host', name)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            if name not in changes and os.path.exists(os.path.join(previous, 'host', name)):
+                os.link(os.path.join(previous, 'host', name), target)
+            elif content is not None:
+                with open(target, 'w') as data:
+                    data.write(content)
+        self.files = {name: content for name, content in self.files.items() if content is not None}
+
+        self.stamp += 24 * 60 * 60
+        os.utime(sync, (self.stamp, self.stamp))
+        existing = set(os.listdir(self.folder))
+        for source, target in RotationPlan.create(intervals, ['daily'], existing).renames:
+            if target.startswith('_delete.'):
+                shutil.rmtree(os.path.join(self.folder, source))
+            else:
+                os.rename(os.path.join(self.folder, source), os.path.join(self.folder, target))
+
+
+@pytest.fixture(scope='function')
+def root(tmpdir):
+    return SnapshotRoot(str(tmpdir.join('snapshots')))
+
+
+@pytest.fixture(scope='function')
+def catalog(tmpdir):
+    with Catalog(Catalog.file_for_root(str(tmpdir.join('state')), str(tmpdir.join('snapshots')))) as catalog:
+        yield catalog
+
+
+#
+# Actual tests
+#
+
+
+def test_versions(root, catalog):
+    root.take(a='1', b='x', **{'sub/c': 'c'})
+    root.take(a='22')
+    root.take()
+
+    scanned = []
+    assert catalog.update(root.folder, intervals, on_scan=scanned.append) == (0, 3, 0)
+    assert scanned == catalog.snapshots == ['daily.2', 'daily.1', 'daily.0']
+
+    versions = catalog.versions('host/a')
+    assert [(version.size, version.snapshots) for version in versions] == [(1, ['daily.2']),
+                                                                           (2, ['daily.0', 'daily.1'])]
+    assert versions[1].inode == os.stat(os.path.join(root.folder, 'daily.0', 'host', 'a')).st_ino
+    assert format_version(versions[0]).endswith(' 1 daily.2')
+
+    assert catalog.versions('/sub/c') == catalog.versions('host/sub/c')
+    assert catalog.versions('missing') == []
+    assert catalog.find('*/[bc]') == [('host/b', ['daily.0', 'daily.1', 'daily.2']),
+                                      ('host/sub/c', ['daily.0', 'daily.1', 'daily.2'])]
+
+
+def test_small_batches(root, catalog, monkeypatch):
+    monkeypatch.setattr(multilevelbackup.catalog, '_batch_size', 2)
+    monkeypatch.setattr(multilevelbackup.catalog, '_lookup_size', 1)
+    root.take(a='1', b='x', c='y', **{'sub/d': 'd'})
+    root.take(a='22', e='new')
+
+    assert catalog.update(root.folder, intervals) == (0, 2, 0)
+    assert [version.snapshots for version in catalog.versions('host/a')] == [['daily.1'], ['daily.0']]
+    assert [relative for relative, _ in catalog.find('*')] == ['host/a', 'host/b', 'host/c', 'host/e', 'host/sub/d']
+    assert catalog.find('*/sub/d') == [('host/sub/d', ['daily.0', 'daily.1'])]
+
+
+def test_incremental_update(root, catalog, mocker):
+    walk = mocker.patch('multilevelbackup.catalog.walk_files', side_effect=multilevelbackup.catalog.walk_files)
+    root.take(a='1', b='x')
+    root.take(a='22')
+    catalog.update(root.folder, intervals)
+    assert walk.call_count == 2
+
+    # Rotation only relabels, only the new snapshot is walked
+    root.take(b=None, c='new')
+    assert catalog.update(root.folder, intervals) == (2, 1, 0)
+    assert walk.call_count == 3
+    assert catalog.find('*/b') == [('host/b', ['daily.1', 'daily.2'])]
+
+    # Expired snapshot drops versions and paths only it contained
+    root.take(a='333')
+    assert catalog.update(root.folder, intervals) == (2, 1, 1)
+    assert [version.snapshots for version in catalog.versions('host/a')] == [['daily.1', 'daily.2'], ['daily.0']]
+    assert catalog.find('*/b') == [('host/b', ['daily.2'])]
+
+    root.take()
+    root.take()
+    catalog.update(root.folder, intervals)
+    assert catalog.find('*/b') == []
+    assert catalog._db.execute('SELECT COUNT(*) FROM paths').fetchone()[0] == 2
+
+
+def test_remove_newest_first(root, catalog):
+    root.take(a='1')
+    root.take(b='new')
+    root.take()
+    catalog.update(root.folder, intervals)
+
+    # Version of b spans the two newest snapshots, which are removed one after another
+    shutil.rmtree(os.path.join(root.folder, 'daily.0'))
+    assert catalog.update(root.folder, intervals) == (2, 0, 1)
+    assert catalog.find('*/b') == [('host/b', ['daily.1'])]
+
+    shutil.rmtree(os.path.join(root.folder, 'daily.1'))
+    assert catalog.update(root.folder, intervals) == (1, 0, 1)
+    assert catalog.find('*/b') == []
+    assert catalog.versions('host/b') == []
+    assert catalog._db.execute('SELECT COUNT(*) FROM paths').fetchone()[0] == 1
+
+
+def test_rebuild_if_older_snapshot_appears(root, catalog):
+    root.take(a='1')
+    root.take(a='22')
+    catalog.update(root.folder, intervals)
+
+    # Older snapshot, e.g. copied back from another disk
+    shutil.copytree(os.path.join(root.folder, 'daily.1'), os.path.join(root.folder, 'daily.2'))
+    os.utime(os.path.join(root.folder, 'daily.2'), (1000, 1000))
+    assert catalog.update(root.folder, intervals) == (0, 3, 0)
+    assert catalog.snapshots == ['daily.2', 'daily.1', 'daily.0']
+
+
+def test_commands(tmpdir, root, capsys):
+    config = tmpdir.join('rsnapshot.conf')
+    config.write('snapshot_root\t{root}/\nretain\tdaily\t3\n'.format(root=root.folder))
+    state = str(tmpdir.join('state'))
+    root.take(a='1')
+    root.take(a='22')
+
+    assert main(['find', '-c', str(config), '-s', state, '*']) == 1
+    assert 'is empty' in capsys.readouterr().out
+
+    assert main(['find', '-c', str(config), '-s', state, '--update', '*']) == 0
+    lines = capsys.readouterr().out.splitlines()
+    assert lines[:2] == ['-- Cataloging daily.1', '-- Cataloging daily.0']
+    assert lines[-1] == 'host/a  daily.0 daily.1'
+
+    assert main(['versions', '-c', str(config), '-s', state, '/a']) == 0
+    lines = capsys.readouterr().out.splitlines()
+    assert lines[0] == '-- host/a'
+    assert lines[1].endswith(' 1 daily.1')
+    assert lines[2].endswith(' 2 daily.0')
+
+    assert main(['versions', '-c', str(config), '-s', state, '/b']) == 1
+
+
+def test_backup_updates_catalog(tmpdir, capsys):
+    source = tmpdir.mkdir('source')
+    source.join('file.txt').write('content')
+    config = tmpdir.join('rsnapshot.conf')
+    config.write('\n'.join([
+        'snapshot_root\t{root}/snapshots/'.format(root=tmpdir),
+        'cmd_rsync\t{rsync}'.format(rsync=os.path.abspath('tests/fake-rsync')),
+        'retain\tdaily\t3',
+        'backup\t{source}/\tlocalhost/'.format(source=source),
+    ]) + '\n')
+    state = str(tmpdir.join('state'))
+
+    assert main(['-c', str(config), '-n', '-s', state, '--catalog']) == 0
+    assert '-- Catalog: 1 snapshot(s) scanned, 0 relabeled, 0 removed' in capsys.readouterr().out
+
+    with Catalog(Catalog.file_for_root(state, str(tmpdir.join('snapshots')))) as catalog:
+        assert catalog.find('*/file.txt') == [(os.path.join('localhost', str(source).lstrip('/'), 'file.txt'),
+                                               ['daily.0'])]
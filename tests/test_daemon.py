@@ -0,0 +1,170 @@
+from multilevelbackup.daemon import BackupDaemon, DaemonTarget, MountWatcher
+from multilevelbackup import DefaultSnapshotManager
+
+import asyncio
+import os
+import pytest
+import threading
+
+
+#
+# Test helper
+#
+
+
+class FakeWatcher(object):
+    instance = None
+
+    def __init__(self, callback):
+        self.callback = callback
+        self.started = False
+        FakeWatcher.instance = self
+
+    def start(self, loop):
+        self.started = True
+
+    def stop(self, loop):
+        self.started = False
+
+
+def run_daemon(daemon, scenario):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    async def drive():
+        serving = asyncio.ensure_future(daemon.serve())
+        await asyncio.sleep(0.05)
+        await scenario()
+        daemon.stop()
+        await serving
+
+    try:
+        loop.run_until_complete(drive())
+    finally:
+        loop.close()
+
+
+@pytest.fixture(scope='function')
+def target(tmpdir):
+    root = str(tmpdir.join('drive', 'snapshots'))
+    return DaemonTarget('rsnapshot.conf', DefaultSnapshotManager(root), executor=None)
+
+
+def backup(runs):
+    def run(target):
+        runs.append(target.snapshot_root)
+        os.makedirs(target.manager.first_snapshot('daily'))
+        target.manager.step_performed('sync')
+        return True
+    return run
+
+
+#
+# Actual tests
+#
+
+
+def test_backup_on_mount(target):
+    runs = []
+    daemon = BackupDaemon([target], backup(runs), interval=60, settle=0, watcher_factory=FakeWatcher)
+
+    async def scenario():
+        assert runs == []
+        # Drive plugged in
+        os.makedirs(target.snapshot_root)
+        FakeWatcher.instance.callback()
+        await asyncio.sleep(0.1)
+        assert runs == [target.snapshot_root]
+
+        # Nothing due anymore
+        FakeWatcher.instance.callback()
+        await asyncio.sleep(0.1)
+        assert len(runs) == 1
+
+    run_daemon(daemon, scenario)
+    assert not FakeWatcher.instance.started
+
+
+def test_backup_on_timer(target):
+    runs = []
+    os.makedirs(target.snapshot_root)
+    daemon = BackupDaemon([target], backup(runs), interval=0.05, settle=0, watcher_factory=FakeWatcher)
+
+    async def scenario():
+        await asyncio.sleep(0.2)
+
+    # Initial check already starts the backup, timer checks do not repeat it
+    run_daemon(daemon, scenario)
+    assert runs == [target.snapshot_root]
+
+
+def test_failed_backup_keeps_daemon_running(target, capsys):
+    calls = []
+
+    def failing(target):
+        calls.append(target)
+        raise RuntimeError('rsync failed')
+
+    os.makedirs(target.snapshot_root)
+    daemon = BackupDaemon([target], failing, interval=0.05, settle=0, watcher_factory=FakeWatcher)
+
+    async def scenario():
+        await asyncio.sleep(0.2)
+
+    run_daemon(daemon, scenario)
+    assert len(calls) > 1
+    assert 'RuntimeError: rsync failed' in capsys.readouterr()[1]
+
+
+def test_hung_mount_keeps_daemon_running(tmpdir, target):
+    hung = DaemonTarget('hung.conf', DefaultSnapshotManager(str(tmpdir.join('hung'))), executor=None)
+    released = threading.Event()
+    probes = []
+
+    def is_available():
+        # Scanning a hung network mount blocks
+        probes.append(hung)
+        return released.wait(5.0) and False
+
+    hung.is_available = is_available
+    runs = []
+    os.makedirs(target.snapshot_root)
+    daemon = BackupDaemon([hung, target], backup(runs), interval=0.05, settle=0, watcher_factory=FakeWatcher)
+
+    async def scenario():
+        try:
+            await asyncio.sleep(0.2)
+            assert runs == [target.snapshot_root]
+            # Timer checks do not pile up behind the hung one
+            assert probes == [hung]
+        finally:
+            released.set()
+
+    run_daemon(daemon, scenario)
+
+
+def test_refresh_after_change_by_other_process(target):
+    os.makedirs(target.manager.first_snapshot('daily'))
+    os.utime(target.manager.first_snapshot('daily'), (0, 0))
+    assert target.is_due()
+
+    # Another process performed the backup
+    os.rename(target.manager.first_snapshot('daily'), target.manager.snapshot_path('daily', 1))
+    os.makedirs(target.manager.first_snapshot('daily'))
+    assert target.is_due()
+    target.refresh()
+    assert not target.is_due()
+
+
+def test_mount_watcher():
+    events = []
+    loop = asyncio.new_event_loop()
+    try:
+        watcher = MountWatcher(lambda: events.append(True))
+        watcher.start(loop)
+        watcher._on_event()
+        watcher.stop(loop)
+        watcher.stop(loop)
+    finally:
+        loop.close()
+    assert events == [True]
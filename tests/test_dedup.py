@@ -0,0 +1,111 @@
+from multilevelbackup.dedup import Deduplicator, DedupStage
+from multilevelbackup.metrics import collect_metrics
+from multilevelbackup.report import RunReport
+from multilevelbackup import DefaultSnapshotManager
+
+import os
+import pytest
+
+
+#
+# Test helper
+#
+
+
+def write(file_name, content, mtime=1000000000):
+    os.makedirs(os.path.dirname(file_name), exist_ok=True)
+    with open(file_name, 'w') as data:
+        data.write(content)
+    os.utime(file_name, (mtime, mtime))
+
+
+def inode(file_name):
+    return os.stat(file_name).st_ino
+
+
+@pytest.fixture(scope='function')
+def snapshot_root(tmpdir):
+    root = tmpdir.mkdir('root')
+    previous = str(root.join('daily.0'))
+    new = str(root.join('.sync'))
+    write(os.path.join(previous, 'old', 'big'), 'x' * 5000)
+    write(os.path.join(previous, 'old', 'other'), 'y' * 5000)
+    write(os.path.join(previous, 'same'), 'same content')
+    os.makedirs(new)
+    os.link(os.path.join(previous, 'same'), os.path.join(new, 'same'))
+
+    # Moved folder
+    write(os.path.join(new, 'moved', 'big'), 'x' * 5000)
+    write(os.path.join(new, 'moved', 'other'), 'y' * 5000)
+    # Same attributes, but different content
+    write(os.path.join(new, 'moved', 'fake'), 'z' * 5000)
+    # Same content, but different modification time
+    write(os.path.join(new, 'moved', 'touched'), 'x' * 5000, mtime=1000000001)
+    return root
+
+
+#
+# Actual tests
+#
+
+
+def test_deduplicate_moved_files(snapshot_root):
+    result = Deduplicator(min_size=100).deduplicate(str(snapshot_root.join('.sync')),
+                                                    str(snapshot_root.join('daily.0')))
+
+    assert result.candidates == 4
+    assert result.files == 2
+    assert result.reclaimed_bytes == 10000
+    assert result.complete
+
+    assert inode(str(snapshot_root.join('.sync', 'moved', 'big'))) == \
+        inode(str(snapshot_root.join('daily.0', 'old', 'big')))
+    assert inode(str(snapshot_root.join('.sync', 'moved', 'other'))) == \
+        inode(str(snapshot_root.join('daily.0', 'old', 'other')))
+    assert os.stat(str(snapshot_root.join('.sync', 'moved', 'fake'))).st_nlink == 1
+    assert os.stat(str(snapshot_root.join('.sync', 'moved', 'touched'))).st_nlink == 1
+    assert snapshot_root.join('.sync', 'moved', 'fake').read() == 'z' * 5000
+    assert sorted(os.listdir(str(snapshot_root.join('.sync', 'moved')))) == ['big', 'fake', 'other', 'touched']
+
+
+def test_min_size_and_candidate_limit(snapshot_root):
+    assert Deduplicator(min_size=10000).deduplicate(str(snapshot_root.join('.sync')),
+                                                    str(snapshot_root.join('daily.0'))).candidates == 0
+
+    result = Deduplicator(min_size=100, max_candidates=1).deduplicate(str(snapshot_root.join('.sync')),
+                                                                      str(snapshot_root.join('daily.0')))
+    assert result.candidates == 1
+    assert result.files <= 1
+
+
+def test_time_limit(snapshot_root):
+    now = [0.0]
+
+    def clock():
+        now[0] += 1.0
+        return now[0]
+
+    result = Deduplicator(min_size=100, time_limit=2.5, clock=clock).deduplicate(
+        str(snapshot_root.join('.sync')), str(snapshot_root.join('daily.0')))
+    assert not result.complete
+    assert result.files == 0
+
+
+def test_without_previous_snapshot(tmpdir):
+    write(str(tmpdir.join('.sync', 'file')), 'x' * 5000)
+    result = Deduplicator(min_size=100).deduplicate(str(tmpdir.join('.sync')), str(tmpdir.join('daily.0')))
+    assert result == (0, 0, 0, True)
+
+
+def test_dedup_stage(snapshot_root, capsys):
+    manager = DefaultSnapshotManager(str(snapshot_root))
+    step = DedupStage(Deduplicator(min_size=100))(manager)
+
+    assert step.name == 'dedup'
+    assert step.counters == {'files': 2, 'reclaimed_bytes': 10000}
+    assert '10000 bytes reclaimed' in capsys.readouterr()[0]
+
+    report = RunReport()
+    report.add_step(step)
+    counters = [metric for metric in collect_metrics(manager, report) if metric.name.endswith('step_counter')][0]
+    assert (counters.samples[1][0]['counter'], counters.samples[1][1]) == ('reclaimed_bytes', 10000)
@@ -0,0 +1,106 @@
+from multilevelbackup.diff import DiffEntry, DiffSummary, diff_trees, ADDED, REMOVED, MODIFIED
+from multilevelbackup.cli import main
+
+import os
+import pytest
+
+
+#
+# Test helper
+#
+
+
+def write(file_name, content):
+    os.makedirs(os.path.dirname(file_name), exist_ok=True)
+    with open(file_name, 'w') as data:
+        data.write(content)
+
+
+@pytest.fixture(scope='function')
+def snapshot_root(tmpdir):
+    root = str(tmpdir.mkdir('root'))
+    old = os.path.join(root, 'daily.1')
+    new = os.path.join(root, 'daily.0')
+
+    for name in ('same', 'sub/same', 'changed', 'removed', 'gone/a', 'gone/b/c', 'kind'):
+        write(os.path.join(old, 'host', name), name)
+    for name in ('same', 'sub/same'):
+        os.makedirs(os.path.dirname(os.path.join(new, 'host', name)), exist_ok=True)
+        os.link(os.path.join(old, 'host', name), os.path.join(new, 'host', name))
+    # Same content, but not hardlinked, is modified without reading content
+    write(os.path.join(new, 'host', 'changed'), 'changed!')
+    write(os.path.join(new, 'host', 'added'), 'added')
+    write(os.path.join(new, 'host', 'new/x'), 'xx')
+    write(os.path.join(new, 'host', 'kind/inner'), 'inner')
+    os.symlink('same', os.path.join(old, 'host', 'link'))
+    os.symlink('same', os.path.join(new, 'host', 'link'))
+    os.symlink('same', os.path.join(old, 'host', 'relinked'))
+    os.symlink('sub/same', os.path.join(new, 'host', 'relinked'))
+    return root
+
+
+#
+# Actual tests
+#
+
+
+def test_diff_trees(snapshot_root):
+    changes = list(diff_trees(os.path.join(snapshot_root, 'daily.1'), os.path.join(snapshot_root, 'daily.0')))
+
+    assert changes == [
+        DiffEntry(ADDED, 'host/added', 5),
+        DiffEntry(MODIFIED, 'host/changed', 8),
+        DiffEntry(REMOVED, 'host/gone/', 0),
+        DiffEntry(REMOVED, 'host/gone/a', 6),
+        DiffEntry(REMOVED, 'host/gone/b/', 0),
+        DiffEntry(REMOVED, 'host/gone/b/c', 8),
+        DiffEntry(REMOVED, 'host/kind', 4),
+        DiffEntry(ADDED, 'host/kind/', 0),
+        DiffEntry(ADDED, 'host/kind/inner', 5),
+        DiffEntry(ADDED, 'host/new/', 0),
+        DiffEntry(ADDED, 'host/new/x', 2),
+        DiffEntry(MODIFIED, 'host/relinked', 8),
+        DiffEntry(REMOVED, 'host/removed', 7),
+    ]
+
+
+def test_diff_is_generator(snapshot_root, mocker):
+    entries = mocker.spy(os, 'scandir')
+    changes = diff_trees(os.path.join(snapshot_root, 'daily.1'), os.path.join(snapshot_root, 'daily.0'))
+    assert entries.call_count == 0
+    assert next(changes) == DiffEntry(ADDED, 'host/added', 5)
+    assert entries.call_count == 4
+
+
+def test_diff_identical_trees(snapshot_root):
+    folder = os.path.join(snapshot_root, 'daily.0')
+    assert list(diff_trees(folder, folder)) == []
+
+
+def test_diff_missing_tree(snapshot_root):
+    with pytest.raises(ValueError):
+        diff_trees(os.path.join(snapshot_root, 'daily.5'), os.path.join(snapshot_root, 'daily.0'))
+
+
+def test_summary(snapshot_root):
+    summary = DiffSummary.of(diff_trees(os.path.join(snapshot_root, 'daily.1'),
+                                        os.path.join(snapshot_root, 'daily.0')))
+    assert summary.counts == {ADDED: 5, REMOVED: 6, MODIFIED: 2}
+    assert summary.bytes == {ADDED: 12, REMOVED: 25, MODIFIED: 16}
+    assert summary.format().splitlines()[0].split() == ['added:', '5', 'entries', '12', 'bytes']
+
+
+def test_diff_command(snapshot_root, tmpdir, capsys):
+    conf_file = tmpdir.join('rsnapshot.conf')
+    conf_file.write('snapshot_root\t{root}/\nretain\tdaily\t3\n'.format(root=snapshot_root))
+
+    assert main(['diff', '-c', str(conf_file), 'daily.1', 'daily.0']) == 0
+    output = capsys.readouterr()[0].splitlines()
+    assert output[0] == '+ host/added'
+    assert output[-1] == '- host/removed'
+
+    assert main(['diff', '--summary', os.path.join(snapshot_root, 'daily.1'),
+                 os.path.join(snapshot_root, 'daily.0')]) == 0
+    output = capsys.readouterr()[0].splitlines()
+    assert len(output) == 3
+    assert output[2].split()[:2] == ['modified:', '2']
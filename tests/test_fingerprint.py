@@ -0,0 +1,104 @@
+from multilevelbackup.config import BackupPoint
+from multilevelbackup.fingerprint import FINGERPRINT_FILE, ChangeDetector, clone_tree, tree_fingerprint
+from multilevelbackup.native import NativeBackupExecutor
+from multilevelbackup.process import run_command
+
+import os
+import pytest
+
+
+#
+# Test helper
+#
+
+
+fake_rsync = os.path.abspath('tests/fake-rsync')
+
+
+@pytest.fixture(scope='function')
+def source(tmpdir):
+    source = tmpdir.mkdir('source')
+    source.join('file.txt').write('content')
+    source.mkdir('sub').join('other.txt').write('other')
+    return source
+
+
+@pytest.fixture(scope='function')
+def executor(tmpdir, source):
+    config = tmpdir.join('rsnapshot.conf')
+    config.write('\n'.join([
+        'snapshot_root\t{root}/snapshots/'.format(root=tmpdir),
+        'cmd_rsync\t{rsync}'.format(rsync=fake_rsync),
+        'retain\tdaily\t3',
+        'backup\t{source}/\tlocalhost/'.format(source=source),
+    ]) + '\n')
+    return NativeBackupExecutor(str(config), change_detector=ChangeDetector())
+
+
+def fingerprint(folder):
+    return tree_fingerprint(str(folder)).hexdigest()
+
+
+#
+# Actual tests
+#
+
+
+def test_tree_fingerprint(source):
+    before = fingerprint(source)
+    assert fingerprint(source) == before
+
+    # Same size and restored modification time, only the change time differs
+    info = os.stat(str(source.join('sub', 'other.txt')))
+    source.join('sub', 'other.txt').write('OTHER')
+    os.utime(str(source.join('sub', 'other.txt')), ns=(info.st_atime_ns, info.st_mtime_ns))
+    changed = fingerprint(source)
+    assert changed != before
+
+    source.join('sub', 'new.txt').write('')
+    assert fingerprint(source) != changed
+
+
+def test_remote_sources_not_fingerprinted(source):
+    detector = ChangeDetector()
+
+    assert detector.fingerprint([BackupPoint(str(source), 'localhost/', None)], []) is not None
+    assert detector.fingerprint([BackupPoint(str(source), 'localhost/', None),
+                                 BackupPoint('root@example.com:/etc/', 'localhost/', None)], []) is None
+    assert detector.fingerprint([BackupPoint(str(source.join('missing')), 'localhost/', None)], []) is None
+
+
+def test_clone_tree(tmpdir, source):
+    os.symlink('file.txt', str(source.join('link')))
+    os.utime(str(source.join('sub')), (1000000000, 1000000000))
+
+    assert clone_tree(str(source), str(tmpdir.join('clone'))) == 3
+    assert os.stat(str(tmpdir.join('clone', 'sub', 'other.txt'))).st_ino == \
+        os.stat(str(source.join('sub', 'other.txt'))).st_ino
+    assert os.readlink(str(tmpdir.join('clone', 'link'))) == 'file.txt'
+    assert os.stat(str(tmpdir.join('clone', 'sub'))).st_mtime == 1000000000
+
+
+def test_skip_unchanged(tmpdir, source, executor, mocker):
+    run = mocker.patch('multilevelbackup.native.run_command', side_effect=run_command)
+    executor.perform_sync()
+    executor.perform_level('daily')
+    assert run.call_count == 1
+    assert list(ChangeDetector.recorded(str(tmpdir.join('snapshots', 'daily.0')))) == ['localhost/']
+
+    report = executor.perform_sync()
+    executor.perform_level('daily')
+    assert run.call_count == 1
+    assert report.counters['unchanged_destinations'] == 1
+
+    relative = os.path.join('localhost', str(source).lstrip('/'), 'file.txt')
+    assert os.stat(str(tmpdir.join('snapshots', 'daily.0', relative))).st_ino == \
+        os.stat(str(tmpdir.join('snapshots', 'daily.1', relative))).st_ino
+    assert tmpdir.join('snapshots', 'daily.0', FINGERPRINT_FILE).exists()
+
+    source.join('file.txt').write('changed content')
+    report = executor.perform_sync()
+    executor.perform_level('daily')
+    assert run.call_count == 2
+    assert report.counters['unchanged_destinations'] == 0
+    assert tmpdir.join('snapshots', 'daily.0', relative).read() == 'changed content'
@@ -0,0 +1,314 @@
+from multilevelbackup.config import directives_from_config
+from multilevelbackup.governor import GovernorPolicy, ResourceGovernor
+from multilevelbackup.levels import LevelChain
+from multilevelbackup.native import NativeBackupExecutor
+from multilevelbackup.process import run_command_async, run_sync
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+import errno
+import os
+import pytest
+import sys
+
+
+#
+# Test helper
+#
+
+
+class FakeProcess(object):
+    def __init__(self, pid):
+        self.pid = pid
+        self.returncode = None
+
+
+class FakeSnapshots(object):
+    def __init__(self, mtimes):
+        self.mtimes = mtimes
+
+    def mtime(self, interval, index):
+        return self.mtimes.get((interval, index))
+
+
+@pytest.fixture(scope='function')
+def proc_root(tmpdir):
+    proc = tmpdir.mkdir('proc')
+    proc.mkdir('self').join('cgroup').write('0::/user.slice/backup.service\n')
+    proc.mkdir('pressure').join('io').write('some avg10=1.00 avg60=0.50 avg300=0.10 total=1234\n'
+                                            'full avg10=0.50 avg60=0.20 avg300=0.05 total=567\n')
+    proc.join('loadavg').write('0.10 0.20 0.30 1/100 4242\n')
+    # Process 100 with child 101 and grandchild 102
+    proc.mkdir('100').mkdir('task').mkdir('100').join('children').write('101 ')
+    proc.mkdir('101').mkdir('task').mkdir('101').join('children').write('102 ')
+    return proc
+
+
+@pytest.fixture(scope='function')
+def cgroup_root(tmpdir):
+    root = tmpdir.mkdir('cgroup')
+    root.mkdir('user.slice').mkdir('backup.service').join('cgroup.subtree_control').write('')
+    return root
+
+
+def set_pressure(proc_root, avg10):
+    proc_root.join('pressure', 'io').write('some avg10={avg10} avg60=0.00 avg300=0.00 total=1\n'.format(avg10=avg10))
+
+
+def create_governor(tmpdir, proc_root, cgroup_root, policy, overdue=None):
+    return ResourceGovernor(policy, str(tmpdir), overdue=overdue, interval=3600.0, proc_root=str(proc_root),
+                            cgroup_root=str(cgroup_root), sys_root=str(tmpdir.join('sys')))
+
+
+#
+# Actual tests
+#
+
+
+def test_directives():
+    config = 'snapshot_root\t/snapshots/\n#mlb\tgovernor_bwlimit\t10M\n#mlb\t\tgovernor_nice\t10  \n' \
+             '#retain\tdaily\t7\n'
+
+    assert directives_from_config(config) == {'governor_bwlimit': '10M', 'governor_nice': '10'}
+    assert directives_from_config('snapshot_root\t/snapshots/\n') == {}
+
+
+def test_policy_from_directives():
+    assert GovernorPolicy.from_directives({'other': '1'}) is None
+
+    policy = GovernorPolicy.from_directives({'governor_bwlimit': '10M', 'governor_io_class': 'idle',
+                                             'governor_cpu_max': '0.5', 'governor_catch_up': '0'})
+    assert policy.bwlimit == 10 * 1024 * 1024
+    assert policy.io_class == 'idle'
+    assert policy.cpu_max == 0.5
+    assert policy.catch_up == 0
+    assert policy.nice == 0
+    assert policy.io_max is None
+
+
+@pytest.mark.parametrize('directives', [
+    {'governor_speed': '1'},
+    {'governor_io_class': 'realtime'},
+    {'governor_bwlimit': 'fast'},
+])
+def test_policy_invalid(directives):
+    with pytest.raises(ValueError):
+        GovernorPolicy.from_directives(directives)
+
+
+def test_limits(tmpdir, proc_root, cgroup_root, mocker):
+    mocker.patch('multilevelbackup.governor.shutil.which', side_effect=lambda name: '/usr/bin/' + name)
+    governor = create_governor(tmpdir, proc_root, cgroup_root, GovernorPolicy(io_class='idle', nice=10,
+                                                                              bwlimit=2048 * 1024))
+
+    assert governor.command_prefix() == ['ionice', '-c', '3', 'nice', '-n', '10']
+    assert governor.rsync_args() == ['--bwlimit=2048']
+
+
+def test_catch_up(tmpdir, proc_root, cgroup_root, capsys):
+    governor = create_governor(tmpdir, proc_root, cgroup_root, GovernorPolicy(nice=10, bwlimit=1024 * 1024),
+                               overdue=lambda: True)
+    governor.start()
+    try:
+        assert not governor.active
+        assert governor.command_prefix() == []
+        assert governor.rsync_args() == []
+    finally:
+        governor.stop()
+    assert 'catching up' in capsys.readouterr().out
+
+
+def test_cgroup(tmpdir, proc_root, cgroup_root):
+    governor = create_governor(tmpdir, proc_root, cgroup_root, GovernorPolicy(io_max=4000, cpu_max=0.5))
+    device = os.stat(str(tmpdir)).st_dev
+
+    governor.start()
+    try:
+        cgroup = governor.cgroup
+        assert os.path.dirname(cgroup) == str(cgroup_root.join('user.slice', 'backup.service'))
+        assert cgroup_root.join('user.slice', 'backup.service', 'cgroup.subtree_control').read() == '+io +cpu'
+        with open(os.path.join(cgroup, 'cpu.max')) as cpu_max:
+            assert cpu_max.read() == '50000 100000'
+        with open(os.path.join(cgroup, 'io.max')) as io_max:
+            assert io_max.read() == '{major}:{minor} rbps=4000 wbps=4000'.format(major=os.major(device),
+                                                                                 minor=os.minor(device))
+
+        governor.attach(FakeProcess(100))
+        with open(os.path.join(cgroup, 'cgroup.procs')) as procs:
+            assert procs.read() == '100'
+
+        # Files of the fake cgroup have to be gone for its removal
+        for name in os.listdir(cgroup):
+            os.unlink(os.path.join(cgroup, name))
+    finally:
+        governor.stop()
+    assert governor.cgroup is None
+    assert not os.path.exists(cgroup)
+
+
+def test_cgroup_unavailable(tmpdir, proc_root, capsys):
+    governor = create_governor(tmpdir, proc_root, tmpdir.join('missing'), GovernorPolicy(cpu_max=1.0))
+    governor.start()
+    governor.stop()
+
+    assert governor.cgroup is None
+    assert 'cgroup limits not available' in capsys.readouterr().out
+
+
+def test_cgroup_controllers_unavailable(tmpdir, proc_root, cgroup_root, mocker, capsys):
+    write = ResourceGovernor._write
+
+    def busy(file_name, value):
+        # Enabling controllers fails while the cgroup contains processes
+        if file_name.endswith('cgroup.subtree_control'):
+            raise OSError(errno.EBUSY, os.strerror(errno.EBUSY))
+        write(file_name, value)
+
+    mocker.patch.object(ResourceGovernor, '_write', side_effect=busy)
+    parent = cgroup_root.join('user.slice', 'backup.service')
+    governor = create_governor(tmpdir, proc_root, cgroup_root, GovernorPolicy(cpu_max=1.0))
+    governor.start()
+    governor.stop()
+
+    assert governor.cgroup is None
+    assert parent.listdir() == [parent.join('cgroup.subtree_control')]
+    assert 'Warning: cannot enable cpu controller' in capsys.readouterr().out
+
+    # Controllers enabled before are used
+    parent.join('cgroup.subtree_control').write('cpu io')
+    governor.start()
+    try:
+        assert governor.cgroup is not None
+        with open(os.path.join(governor.cgroup, 'cpu.max')) as cpu_max:
+            assert cpu_max.read() == '100000 100000'
+        os.unlink(os.path.join(governor.cgroup, 'cpu.max'))
+    finally:
+        governor.stop()
+
+
+def test_adjust_pressure(tmpdir, proc_root, cgroup_root, mocker):
+    mocker.patch('multilevelbackup.governor.shutil.which', return_value=None)
+    setpriority = mocker.patch('multilevelbackup.governor.os.setpriority')
+    governor = create_governor(tmpdir, proc_root, cgroup_root, GovernorPolicy(nice=5, pressure_high=20.0,
+                                                                              pressure_low=5.0))
+    governor.renice = True
+    governor.attach(FakeProcess(100))
+
+    assert governor.pressure() == 1.0
+    assert not governor.adjust()
+    assert setpriority.call_count == 0
+
+    set_pressure(proc_root, 35.5)
+    assert governor.adjust()
+    assert sorted(call[0][1:] for call in setpriority.call_args_list) == [(100, 19), (101, 19), (102, 19)]
+
+    # Between both thresholds, nothing changes
+    setpriority.reset_mock()
+    set_pressure(proc_root, 10.0)
+    assert governor.adjust()
+    assert setpriority.call_count == 0
+
+    set_pressure(proc_root, 2.0)
+    assert not governor.adjust()
+    assert sorted(call[0][1:] for call in setpriority.call_args_list) == [(100, 5), (101, 5), (102, 5)]
+
+
+def test_adjust_async_process(tmpdir, proc_root, cgroup_root, mocker):
+    mocker.patch('multilevelbackup.governor.shutil.which', return_value=None)
+    setpriority = mocker.patch('multilevelbackup.governor.os.setpriority')
+    governor = create_governor(tmpdir, proc_root, cgroup_root, GovernorPolicy(pressure_high=20.0, pressure_low=5.0))
+    governor.renice = True
+    started = []
+
+    def on_start(process):
+        governor.attach(process)
+        started.append(process.pid)
+        set_pressure(proc_root, 35.5)
+        assert governor.adjust()
+
+    run_sync(run_command_async([sys.executable, '-c', 'pass'], echo=False, on_start=on_start))
+    assert [call[0][1:] for call in setpriority.call_args_list] == [(started[0], 19)]
+
+    # The exited process is not governed any more
+    setpriority.reset_mock()
+    set_pressure(proc_root, 2.0)
+    assert not governor.adjust()
+    assert setpriority.call_count == 0
+
+
+def test_adjust_unprivileged(tmpdir, proc_root, cgroup_root, mocker):
+    mocker.patch('multilevelbackup.governor.shutil.which', return_value='/usr/bin/ionice')
+    setpriority = mocker.patch('multilevelbackup.governor.os.setpriority')
+    call = mocker.patch('multilevelbackup.governor.subprocess.call', return_value=0)
+    governor = create_governor(tmpdir, proc_root, cgroup_root, GovernorPolicy(nice=5))
+    governor.renice = False
+    governor.attach(FakeProcess(100))
+
+    set_pressure(proc_root, 35.5)
+    assert governor.adjust()
+    set_pressure(proc_root, 2.0)
+    assert not governor.adjust()
+
+    # The niceness could not be lowered again, only the I/O class changes
+    assert setpriority.call_count == 0
+    assert [args[0][0][1:3] for args in call.call_args_list if args[0][0][-1] == '100'] == [['-c', '3'],
+                                                                                            ['-c', '2']]
+
+
+def test_adjust_restore_failure(tmpdir, proc_root, cgroup_root, mocker, capsys):
+    mocker.patch('multilevelbackup.governor.shutil.which', return_value=None)
+    mocker.patch('multilevelbackup.governor.os.setpriority', side_effect=PermissionError(1, 'Permission denied'))
+    governor = create_governor(tmpdir, proc_root, cgroup_root, GovernorPolicy(nice=5))
+    governor.renice = True
+    governor.attach(FakeProcess(100))
+
+    set_pressure(proc_root, 35.5)
+    governor.adjust()
+    set_pressure(proc_root, 2.0)
+    governor.adjust()
+
+    assert 'cannot change priority of sync process 100: [Errno 1] Permission denied' in capsys.readouterr().out
+
+
+def test_adjust_load(tmpdir, proc_root, cgroup_root, mocker):
+    mocker.patch('multilevelbackup.governor.os.cpu_count', return_value=2)
+    governor = create_governor(tmpdir, proc_root, cgroup_root, GovernorPolicy(load_high=1.5))
+    proc_root.join('pressure', 'io').remove()
+
+    assert governor.pressure() is None
+    assert not governor.adjust()
+
+    proc_root.join('loadavg').write('4.00 2.00 1.00 1/100 4242\n')
+    assert governor.load() == 2.0
+    assert governor.adjust()
+
+
+def test_overdue_levels():
+    levels = LevelChain.from_intervals(OrderedDict([('daily', 7), ('weekly', 4)]))
+    now = datetime(2020, 6, 15, 12)
+
+    def snapshots(daily_age, weekly_age):
+        return FakeSnapshots({('daily', 0): (now - daily_age).timestamp(),
+                              ('daily', 6): (now - daily_age - timedelta(days=6)).timestamp(),
+                              ('weekly', 0): (now - weekly_age).timestamp()})
+
+    assert levels.overdue_levels(snapshots(timedelta(days=1), timedelta(days=8)), 2, now.timestamp()) == []
+    assert levels.overdue_levels(snapshots(timedelta(days=3), timedelta(days=8)), 2, now.timestamp()) == ['daily']
+    assert levels.overdue_levels(snapshots(timedelta(days=3), timedelta(days=20)), 2,
+                                 now.timestamp()) == ['daily', 'weekly']
+    # First backup is not catching up
+    assert levels.overdue_levels(FakeSnapshots({}), 2, now.timestamp()) == []
+
+
+def test_native_executor(tmpdir, proc_root, cgroup_root, mocker, capsys):
+    mocker.patch('multilevelbackup.governor.shutil.which', side_effect=lambda name: '/usr/bin/' + name)
+    config = tmpdir.join('rsnapshot.conf')
+    config.write('snapshot_root\t{root}/snapshots/\nretain\tdaily\t3\nbackup\t/etc/\tlocalhost/\n'.format(root=tmpdir))
+    governor = create_governor(tmpdir, proc_root, cgroup_root, GovernorPolicy(nice=10, bwlimit=1024 * 1024))
+
+    executor = NativeBackupExecutor(str(config), dry_run=True, governor=governor)
+    executor.perform_sync()
+
+    output = capsys.readouterr().out
+    assert 'nice -n 10 rsync ' in output
+    assert '--bwlimit=1024' in output
@@ -0,0 +1,73 @@
+from multilevelbackup.inventory import SnapshotInventory
+from multilevelbackup import DefaultSnapshotManager
+from datetime import date, datetime
+
+import os
+import pytest
+
+
+#
+# Test helper
+#
+
+
+@pytest.fixture(scope='function')
+def inventory(tmpdir):
+    return SnapshotInventory(str(tmpdir))
+
+
+def create_folder(folder, timestamp):
+    """Create folder with given timestamp."""
+    os.makedirs(folder)
+    os.system('touch -t {time:%Y%m%d%H%M.%S} {file}'.format(time=timestamp, file=folder))
+
+#
+# Actual tests
+#
+
+
+def test_missing_root(tmpdir):
+    inventory = SnapshotInventory(str(tmpdir.join('non_existing')))
+
+    assert inventory.entries == {}
+    assert not inventory.exists('daily', 0)
+    assert inventory.snapshot_date('daily', 0) is None
+
+
+def test_snapshots_indexed(tmpdir, inventory):
+    create_folder(str(tmpdir.join('daily.0')), datetime(year=2015, month=5, day=23, hour=5))
+    create_folder(str(tmpdir.join('daily.3')), datetime(year=2015, month=5, day=20))
+    create_folder(str(tmpdir.join('weekly.0')), datetime(year=2015, month=5, day=1))
+    create_folder(str(tmpdir.join('.sync')), datetime.now())
+    create_folder(str(tmpdir.join('unrelated')), datetime.now())
+    tmpdir.join('daily.1').write('not a folder')
+
+    assert sorted(inventory.entries) == [('daily', 0), ('daily', 3), ('weekly', 0)]
+    assert inventory.indices('daily') == [0, 3]
+    assert inventory.snapshot_date('daily', 0) == date(year=2015, month=5, day=23)
+    assert inventory.snapshot_date('weekly', 0) == date(year=2015, month=5, day=1)
+    assert inventory.snapshot_date('monthly', 0) is None
+
+
+def test_invalidate(tmpdir, inventory):
+    assert not inventory.exists('daily', 0)
+
+    create_folder(str(tmpdir.join('daily.0')), datetime.now())
+    assert not inventory.exists('daily', 0)
+
+    inventory.invalidate()
+    assert inventory.exists('daily', 0)
+
+
+def test_upcoming_tasks_single_scan(tmpdir, mocker):
+    create_folder(str(tmpdir.join('daily.0')), datetime(year=2015, month=5, day=23))
+    create_folder(str(tmpdir.join('daily.6')), datetime(year=2015, month=5, day=16))
+    scandir = mocker.spy(os, 'scandir')
+
+    manager = DefaultSnapshotManager(backup_root=str(tmpdir))
+    assert manager.upcoming_tasks == {'daily': True, 'weekly': True, 'monthly': False}
+    assert scandir.call_count == 1
+
+    manager.step_performed('daily')
+    manager.upcoming_tasks
+    assert scandir.call_count == 2
@@ -0,0 +1,113 @@
+from multilevelbackup.ledger import SnapshotLedger
+from multilevelbackup.inventory import SnapshotInventory
+from multilevelbackup import DefaultSnapshotManager
+from datetime import date, datetime, timedelta
+
+import json
+import os
+import time
+import pytest
+
+
+#
+# Test helper
+#
+
+
+intervals = {'daily': 7, 'weekly': 4}
+
+
+@pytest.fixture(scope='function')
+def snapshot_root(tmpdir):
+    return str(tmpdir.mkdir('root'))
+
+
+@pytest.fixture(scope='function')
+def ledger_file(tmpdir):
+    return str(tmpdir.join('state', 'ledger.json'))
+
+
+def create_folder(folder, timestamp):
+    """Create folder with given timestamp."""
+    os.makedirs(folder)
+    os.system('touch -t {time:%Y%m%d%H%M.%S} {file}'.format(time=timestamp, file=folder))
+
+#
+# Actual tests
+#
+
+
+def test_missing_ledger(ledger_file, snapshot_root):
+    ledger = SnapshotLedger(ledger_file)
+
+    assert not ledger.is_consistent(snapshot_root, intervals)
+    assert ledger.snapshot_date('daily', 0) is None
+    assert ledger.last_performed('sync') is None
+
+
+def test_reconcile_and_save(ledger_file, snapshot_root):
+    create_folder(os.path.join(snapshot_root, 'daily.0'), datetime(year=2015, month=5, day=23))
+    ledger = SnapshotLedger(ledger_file)
+    ledger.reconcile(SnapshotInventory(snapshot_root), intervals)
+    ledger.record_step('sync')
+    ledger.save()
+
+    loaded = SnapshotLedger(ledger_file)
+    assert loaded.is_consistent(snapshot_root, intervals)
+    assert loaded.snapshot_date('daily', 0) == date(year=2015, month=5, day=23)
+    assert loaded.last_performed('sync').date() == date.today()
+    assert len(os.listdir(os.path.dirname(ledger_file))) == 1
+
+
+def test_read_only(ledger_file, snapshot_root):
+    ledger = SnapshotLedger(ledger_file, read_only=True)
+    ledger.reconcile(SnapshotInventory(snapshot_root), intervals)
+    ledger.save()
+
+    assert not os.path.exists(ledger_file)
+
+
+def test_inconsistent(ledger_file, snapshot_root):
+    ledger = SnapshotLedger(ledger_file, max_age=timedelta(days=1))
+    ledger.reconcile(SnapshotInventory(snapshot_root), intervals, now=time.time() - 3600)
+
+    assert ledger.is_consistent(snapshot_root, intervals)
+    assert not ledger.is_consistent(snapshot_root + '/other', intervals)
+    assert not ledger.is_consistent(snapshot_root, {'daily': 7, 'weekly': 2})
+    assert not ledger.is_consistent(snapshot_root, intervals, now=time.time() + 2 * 86400)
+
+
+def test_corrupt_ledger(ledger_file, snapshot_root):
+    os.makedirs(os.path.dirname(ledger_file))
+    with open(ledger_file, 'w') as ledger:
+        ledger.write('{no json')
+
+    assert not SnapshotLedger(ledger_file).is_consistent(snapshot_root, intervals)
+
+
+def test_manager_noop_without_root_access(ledger_file, snapshot_root, mocker):
+    create_folder(os.path.join(snapshot_root, 'daily.0'), datetime.now())
+    ledger = SnapshotLedger(ledger_file)
+    manager = DefaultSnapshotManager(backup_root=snapshot_root, ledger=ledger)
+    assert manager.upcoming_tasks == {'daily': False, 'weekly': False, 'monthly': False}
+
+    scandir = mocker.spy(os, 'scandir')
+    manager = DefaultSnapshotManager(backup_root=snapshot_root, ledger=SnapshotLedger(ledger_file))
+    assert manager.upcoming_tasks == {'daily': False, 'weekly': False, 'monthly': False}
+    assert scandir.call_count == 0
+
+
+def test_manager_reconciles_when_due(ledger_file, snapshot_root):
+    create_folder(os.path.join(snapshot_root, 'daily.0'), datetime.now() - timedelta(days=1))
+    manager = DefaultSnapshotManager(backup_root=snapshot_root, ledger=SnapshotLedger(ledger_file))
+    assert manager.upcoming_tasks['daily']
+
+    os.rename(os.path.join(snapshot_root, 'daily.0'), os.path.join(snapshot_root, 'daily.1'))
+    create_folder(os.path.join(snapshot_root, 'daily.0'), datetime.now())
+    manager.step_performed('daily')
+
+    with open(ledger_file) as ledger:
+        data = json.load(ledger)
+    assert sorted(data['snapshots']['daily']) == ['0', '1']
+    assert 'daily' in data['steps']
+    assert not manager.upcoming_tasks['daily']
@@ -0,0 +1,120 @@
+from multilevelbackup.lock import RunLock
+from multilevelbackup.cli import main
+
+import os
+import threading
+import time
+import pytest
+
+
+#
+# Test helper
+#
+
+
+@pytest.fixture(scope='function')
+def lock_folder(tmpdir):
+    return str(tmpdir.join('state'))
+
+
+def start(target):
+    thread = threading.Thread(target=target)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def wait_until(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+#
+# Actual tests
+#
+
+
+def test_acquire_and_release(lock_folder):
+    lock = RunLock(lock_folder, '/backup/snapshots')
+    assert lock.acquire()
+    with open(lock.run_file) as run_file:
+        assert run_file.read() == '{pid}\n'.format(pid=os.getpid())
+    lock.release()
+    lock.release()
+
+    with RunLock(lock_folder, '/backup/snapshots/') as acquired:
+        assert acquired
+
+
+def test_different_roots_do_not_block(lock_folder):
+    first = RunLock(lock_folder, '/backup/one')
+    second = RunLock(lock_folder, '/backup/two')
+    assert first.acquire()
+    assert second.acquire()
+    first.release()
+    second.release()
+
+
+def test_requests_are_coalesced(lock_folder, capsys):
+    running = RunLock(lock_folder, '/backup/snapshots')
+    assert running.acquire()
+
+    # Second request queues up behind the running backup
+    queued = RunLock(lock_folder, '/backup/snapshots')
+    events = []
+    thread = start(lambda: events.append(queued.acquire()))
+    wait_until(lambda: 'waiting' in capsys.readouterr()[0])
+    assert events == []
+
+    # Further requests are merged into the queued one
+    assert not RunLock(lock_folder, '/backup/snapshots').acquire()
+    assert not RunLock(lock_folder, '/backup/snapshots').acquire()
+
+    running.release()
+    thread.join(5)
+    assert events == [True]
+
+    # Queued run is running now, so the next request queues up again
+    next_request = RunLock(lock_folder, '/backup/snapshots')
+    thread = start(lambda: events.append(next_request.acquire()))
+    time.sleep(0.1)
+    assert events == [True]
+    queued.release()
+    thread.join(5)
+    assert events == [True, True]
+    next_request.release()
+
+
+def test_wait_for_queued_run(lock_folder, capsys):
+    running = RunLock(lock_folder, '/backup/snapshots')
+    queued = RunLock(lock_folder, '/backup/snapshots')
+    merged = RunLock(lock_folder, '/backup/snapshots')
+    order = []
+
+    assert running.acquire()
+    start(lambda: queued.acquire() and order.append('queued'))
+    wait_until(lambda: 'waiting' in capsys.readouterr()[0])
+    assert not merged.acquire()
+    waiting = start(lambda: merged.wait() or order.append('merged'))
+
+    running.release()
+    wait_until(lambda: order == ['queued'])
+    time.sleep(0.1)
+    assert order == ['queued']
+    queued.release()
+    waiting.join(5)
+    assert order == ['queued', 'merged']
+
+
+def test_backup_request_merged(lock_folder, capsys):
+    running = RunLock(lock_folder, '/rsnapshot/minimal/config/root/')
+    queued = RunLock(lock_folder, '/rsnapshot/minimal/config/root/')
+    assert running.acquire()
+    start(queued.acquire)
+    wait_until(lambda: 'waiting' in capsys.readouterr()[0])
+
+    assert main(['-c', 'tests/rsnapshot-minimal.conf', '-s', lock_folder]) == 0
+    assert 'another one is queued, request merged' in capsys.readouterr()[0]
+    running.release()
@@ -0,0 +1,144 @@
+from multilevelbackup.manifest import Manifest, ManifestStage, write_manifest, MANIFEST_FILE
+from multilevelbackup import manifest as manifest_module
+from multilevelbackup import DefaultSnapshotManager, perform_backup
+from multilevelbackup.native import NativeBackupExecutor
+
+import hashlib
+import os
+import pytest
+
+
+#
+# Test helper
+#
+
+
+def write(file_name, content):
+    os.makedirs(os.path.dirname(file_name), exist_ok=True)
+    with open(file_name, 'w') as data:
+        data.write(content)
+
+
+def digest(content):
+    return hashlib.blake2b(content.encode(), digest_size=32).digest()
+
+
+@pytest.fixture(scope='function')
+def snapshot(tmpdir):
+    folder = str(tmpdir.mkdir('daily.0'))
+    # Walk order of folder 'a' differs from plain sorting of paths ('a.b' < 'a/x')
+    for name in ('host/a.b', 'host/a/x', 'host/a/y/z', 'other/file', 'top'):
+        write(os.path.join(folder, name), name)
+    os.symlink('top', os.path.join(folder, 'link'))
+    return folder
+
+
+#
+# Actual tests
+#
+
+
+def test_write_and_read(snapshot):
+    count, hashed = write_manifest(snapshot)
+    assert (count, hashed) == (5, 5)
+
+    with Manifest(os.path.join(snapshot, MANIFEST_FILE)) as manifest:
+        assert len(manifest) == 5
+        assert [entry.path for entry in manifest] == ['host/a/x', 'host/a/y/z', 'host/a.b', 'other/file', 'top']
+        entry = manifest[1]
+        assert entry.size == len('host/a/y/z')
+        assert entry.digest == digest('host/a/y/z')
+        assert entry.inode == os.stat(os.path.join(snapshot, 'host/a/y/z')).st_ino
+
+        for path in ('host/a/x', 'host/a/y/z', 'host/a.b', 'other/file', 'top'):
+            assert manifest.find(path).path == path
+        assert manifest.find('host/a') is None
+        assert manifest.find('link') is None
+        assert manifest.find('zzz') is None
+        with pytest.raises(IndexError):
+            manifest[5]
+
+
+def test_manifest_is_not_part_of_itself(snapshot):
+    write_manifest(snapshot)
+    write_manifest(snapshot)
+    with Manifest(os.path.join(snapshot, MANIFEST_FILE)) as manifest:
+        assert manifest.find(MANIFEST_FILE) is None
+    assert sorted(os.listdir(snapshot)) == [MANIFEST_FILE, 'host', 'link', 'other', 'top']
+
+
+def test_invalid_manifest(tmpdir):
+    manifest_file = tmpdir.join('manifest')
+    manifest_file.write('MLBX' + 'x' * 20)
+    with pytest.raises(ValueError):
+        Manifest(str(manifest_file))
+    manifest_file.write('MLB')
+    with pytest.raises(ValueError):
+        Manifest(str(manifest_file))
+
+
+def test_hashes_reused_for_hardlinks(snapshot, tmpdir, mocker):
+    write_manifest(snapshot)
+
+    # New snapshot linking unchanged files to the previous one
+    new = str(tmpdir.join('.sync'))
+    for path in ('host/a/x', 'host/a/y/z', 'other/file'):
+        os.makedirs(os.path.dirname(os.path.join(new, path)), exist_ok=True)
+        os.link(os.path.join(snapshot, path), os.path.join(new, path))
+    write(os.path.join(new, 'host/a.b'), 'changed')
+    write(os.path.join(new, 'added'), 'added')
+
+    hash_file = mocker.spy(manifest_module, 'hash_file')
+    assert write_manifest(new, os.path.join(snapshot, MANIFEST_FILE)) == (5, 2)
+    assert sorted(os.path.basename(call[0][0]) for call in hash_file.call_args_list) == [b'a.b', b'added']
+
+    with Manifest(os.path.join(new, MANIFEST_FILE)) as manifest:
+        assert manifest.find('host/a.b').digest == digest('changed')
+        assert manifest.find('host/a/x').digest == digest('host/a/x')
+
+
+def test_manifest_stage(tmpdir):
+    root = tmpdir.mkdir('root')
+    write(str(root.join('daily.0', 'file')), 'old')
+    write_manifest(str(root.join('daily.0')))
+    os.makedirs(str(root.join('.sync')))
+    os.link(str(root.join('daily.0', 'file')), str(root.join('.sync', 'file')))
+    write(str(root.join('.sync', 'new')), 'new')
+
+    manager = DefaultSnapshotManager(str(root))
+    stage = ManifestStage()
+    report = stage(manager)
+    assert report.name == 'manifest'
+
+    with Manifest(str(root.join('.sync', MANIFEST_FILE))) as manifest:
+        assert [entry.path for entry in manifest] == ['file', 'new']
+        assert manifest.find('new').digest == digest('new')
+
+
+def test_manifest_with_native_backups(tmpdir, mocker):
+    source = tmpdir.mkdir('source')
+    source.join('unchanged.txt').write('unchanged')
+    source.join('changing.txt').write('first')
+    conf_file = tmpdir.join('rsnapshot.conf')
+    conf_file.write('snapshot_root\t{root}/snapshots/\ncmd_rsync\t{rsync}\nretain\tdaily\t3\n'
+                    'backup\t{source}/\tlocalhost/\n'.format(root=tmpdir, rsync=os.path.abspath('tests/fake-rsync'),
+                                                             source=source))
+    hash_file = mocker.spy(manifest_module, 'hash_file')
+
+    def backup():
+        manager = DefaultSnapshotManager.create_from_rsnapshot_conf(str(conf_file))
+        perform_backup(manager, NativeBackupExecutor(str(conf_file)), post_sync=[ManifestStage()])
+
+    backup()
+    assert hash_file.call_count == 2
+    os.utime(str(tmpdir.join('snapshots', 'daily.0')), (0, 0))
+    source.join('changing.txt').write('second')
+    backup()
+    assert hash_file.call_count == 3
+
+    with Manifest(str(tmpdir.join('snapshots', 'daily.0', MANIFEST_FILE))) as manifest:
+        assert len(manifest) == 2
+        assert manifest[0].path.endswith('changing.txt')
+        assert manifest[0].digest == digest('second')
+    with Manifest(str(tmpdir.join('snapshots', 'daily.1', MANIFEST_FILE))) as manifest:
+        assert manifest[0].digest == digest('first')
@@ -0,0 +1,116 @@
+from multilevelbackup.metrics import MetricsExporter, collect_metrics, format_prometheus
+from multilevelbackup.ledger import SnapshotLedger
+from multilevelbackup.report import RunReport, StepReport, TransferStats
+from multilevelbackup import DefaultSnapshotManager, perform_backup
+from datetime import datetime, timedelta
+
+import json
+import os
+import pytest
+
+
+#
+# Test helper
+#
+
+
+def create_folder(folder, timestamp):
+    """Create folder with given timestamp."""
+    os.makedirs(folder)
+    os.system('touch -t {time:%Y%m%d%H%M.%S} {file}'.format(time=timestamp, file=folder))
+
+
+@pytest.fixture(scope='function')
+def manager(tmpdir):
+    root = tmpdir.mkdir('root')
+    manager = DefaultSnapshotManager(backup_root=str(root))
+    create_folder(manager.snapshot_path('daily', 0), datetime.now() - timedelta(hours=30))
+    create_folder(manager.snapshot_path('daily', 1), datetime.now() - timedelta(hours=54))
+    create_folder(manager.snapshot_path('weekly', 0), datetime.now() - timedelta(days=8))
+    root.mkdir('_delete.20151105T200000.daily.6')
+    return manager
+
+
+class FailingExecutor(object):
+    def perform_sync(self):
+        raise RuntimeError('sync failed')
+
+
+class RecordingExecutor(object):
+    def perform_sync(self):
+        return StepReport('sync', 12.0, TransferStats(files_transferred=5, transferred_size=4096))
+
+    def perform_levels(self, levels):
+        return StepReport('+'.join(levels), 0.25)
+
+
+def samples(metrics):
+    """:return Metric values by name and sorted label values."""
+    return dict(((metric.name,) + tuple(labels.values()), value)
+                for metric in metrics for labels, value in metric.samples)
+
+#
+# Actual tests
+#
+
+
+def test_collect(manager):
+    report = RunReport()
+    report.add_step(StepReport('sync', 12.0, TransferStats(files_transferred=5, transferred_size=4096)))
+    values = samples(collect_metrics(manager, report))
+    root = manager.backup_root
+
+    assert values[('multilevel_backup_snapshots', 'daily', root)] == 2
+    assert values[('multilevel_backup_snapshots', 'monthly', root)] == 0
+    assert 29 * 3600 < values[('multilevel_backup_newest_snapshot_age_seconds', 'daily', root)] < 31 * 3600
+    assert values[('multilevel_backup_expired_snapshots_pending', root)] == 1
+    assert values[('multilevel_backup_step_duration_seconds', root, 'sync')] == 12.0
+    assert values[('multilevel_backup_transferred_bytes', root)] == 4096
+    assert values[('multilevel_backup_last_run_performed', root)] == 1
+    assert values[('multilevel_backup_last_run_failed', root)] == 0
+
+
+def test_prometheus_format(manager):
+    text = format_prometheus(collect_metrics(manager, RunReport()))
+
+    assert '# TYPE multilevel_backup_snapshots gauge' in text
+    assert 'multilevel_backup_snapshots{{level="daily",root="{root}"}} 2.0'.format(root=manager.backup_root) in text
+    # Nothing performed, so no step metrics
+    assert 'step_duration' not in text
+
+
+def test_export_on_backup(manager, tmpdir):
+    exporter = MetricsExporter(str(tmpdir.join('metrics')))
+    perform_backup(manager, RecordingExecutor(), metrics=exporter)
+
+    files = os.listdir(str(tmpdir.join('metrics')))
+    assert len(files) == 1 and files[0].endswith('.prom')
+    text = tmpdir.join('metrics', files[0]).read()
+    assert 'multilevel_backup_transferred_files{{root="{root}"}} 5.0'.format(root=manager.backup_root) in text
+
+
+def test_export_on_failure(manager, tmpdir):
+    exporter = MetricsExporter(str(tmpdir.join('metrics')), 'json')
+
+    with pytest.raises(RuntimeError):
+        perform_backup(manager, FailingExecutor(), metrics=exporter)
+
+    data = json.loads(tmpdir.join('metrics', os.listdir(str(tmpdir.join('metrics')))[0]).read())
+    assert data['multilevel_backup_last_run_failed'][0]['value'] == 1
+
+
+def test_export_from_ledger_without_root_access(tmpdir, mocker):
+    root = tmpdir.mkdir('root')
+    create_folder(str(root.join('daily.0')), datetime.now())
+    ledger_file = str(tmpdir.join('state', 'ledger.json'))
+    exporter = MetricsExporter(str(tmpdir.join('metrics')))
+    perform_backup(DefaultSnapshotManager(str(root), ledger=SnapshotLedger(ledger_file)), RecordingExecutor(),
+                   metrics=exporter)
+
+    scandir = mocker.spy(os, 'scandir')
+    manager = DefaultSnapshotManager(str(root), ledger=SnapshotLedger(ledger_file))
+    perform_backup(manager, RecordingExecutor(), metrics=exporter)
+
+    assert scandir.call_count == 0
+    text = tmpdir.join('metrics', os.listdir(str(tmpdir.join('metrics')))[0]).read()
+    assert 'multilevel_backup_snapshots{{level="daily",root="{root}"}} 1.0'.format(root=root) in text
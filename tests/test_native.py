@@ -0,0 +1,155 @@
+from multilevelbackup.native import NativeBackupExecutor, NativeSettings, PARTIAL_FOLDER
+from multilevelbackup.config import BackupPoint
+from multilevelbackup.sync import CHECKPOINT_FILE, IncompleteSyncError, SyncCheckpoint, SyncError
+
+import os
+import pytest
+import subprocess
+
+
+#
+# Test helper
+#
+
+
+fake_rsync = os.path.abspath('tests/fake-rsync')
+
+
+@pytest.fixture(scope='function')
+def source(tmpdir):
+    source = tmpdir.mkdir('source')
+    source.join('unchanged.txt').write('unchanged')
+    source.mkdir('sub').join('changing.txt').write('first')
+    return source
+
+
+@pytest.fixture(scope='function')
+def conf_file(tmpdir, source):
+    config = tmpdir.join('rsnapshot.conf')
+    config.write('\n'.join([
+        'snapshot_root\t{root}/snapshots/'.format(root=tmpdir),
+        'cmd_rsync\t{rsync}'.format(rsync=fake_rsync),
+        'retain\tdaily\t3',
+        'retain\tweekly\t2',
+        'exclude\t*.tmp',
+        'backup\t{source}/\tlocalhost/'.format(source=source),
+        'backup\troot@example.com:/etc/\texample/\texclude=/etc/ssl,one_fs=1',
+    ]) + '\n')
+    return str(config)
+
+
+def snapshot_inode(tmpdir, snapshot, source, name):
+    return os.stat(str(tmpdir.join('snapshots', snapshot, 'localhost', str(source).lstrip('/'), name))).st_ino
+
+#
+# Actual tests
+#
+
+
+def test_settings(conf_file):
+    settings = NativeSettings.from_file(conf_file)
+
+    assert settings.rsync == fake_rsync
+    assert settings.short_args == ['-a']
+    assert '--relative' in settings.long_args
+    assert settings.filters == [('exclude', '*.tmp')]
+    assert list(settings.intervals) == ['daily', 'weekly']
+
+
+def test_rsync_command_first_sync(conf_file, source):
+    executor = NativeBackupExecutor(conf_file)
+    command = executor.rsync_command(executor.settings.backup_points[0])
+
+    assert command[0] == fake_rsync
+    assert '--exclude=*.tmp' in command
+    assert '--inplace' in command
+    assert '--whole-file' in command
+    assert '--stats' in command and '--info=progress2' in command
+    assert not any(arg.startswith('--link-dest') for arg in command)
+    assert command[-2:] == ['{source}/'.format(source=source), os.path.join(executor.sync_folder, 'localhost/')]
+
+
+def test_rsync_command_remote(conf_file, tmpdir):
+    tmpdir.mkdir('snapshots').mkdir('daily.0').mkdir('example')
+    executor = NativeBackupExecutor(conf_file)
+    command = executor.rsync_command(executor.settings.backup_points[1])
+
+    assert '--exclude=/etc/ssl' in command
+    assert '--one-file-system' in command
+    assert '--whole-file' not in command
+    assert '--inplace' not in command
+    assert '--partial-dir=' + PARTIAL_FOLDER in command
+    assert '--link-dest=' + str(tmpdir.join('snapshots', 'daily.0', 'example')) in command
+
+
+def test_backup_cycle(conf_file, tmpdir, source):
+    executor = NativeBackupExecutor(conf_file)
+    executor.settings.backup_points = [executor.settings.backup_points[0]]
+
+    executor.perform_sync()
+    executor.perform_level('daily')
+    assert sorted(os.listdir(str(tmpdir.join('snapshots')))) == ['daily.0']
+
+    source.join('sub', 'changing.txt').write('second, changed')
+    executor.perform_sync()
+    executor.perform_level('daily')
+    assert sorted(os.listdir(str(tmpdir.join('snapshots')))) == ['daily.0', 'daily.1']
+
+    assert snapshot_inode(tmpdir, 'daily.0', source, 'unchanged.txt') == \
+        snapshot_inode(tmpdir, 'daily.1', source, 'unchanged.txt')
+    assert snapshot_inode(tmpdir, 'daily.0', source, 'sub/changing.txt') != \
+        snapshot_inode(tmpdir, 'daily.1', source, 'sub/changing.txt')
+
+
+def test_rotation(conf_file, tmpdir):
+    snapshots = tmpdir.mkdir('snapshots')
+    for name in ['.sync', 'daily.0', 'daily.1', 'daily.2', 'weekly.0', 'weekly.1']:
+        snapshots.mkdir(name).join('name').write(name)
+    SyncCheckpoint(str(snapshots)).finish()
+
+    executor = NativeBackupExecutor(conf_file)
+    executor.perform_level('weekly')
+    executor.perform_level('daily')
+
+    contents = dict((name, snapshots.join(name, 'name').read()) for name in os.listdir(str(snapshots))
+                    if not name.startswith('_delete.'))
+    assert contents == {'daily.0': '.sync', 'daily.1': 'daily.0', 'daily.2': 'daily.1',
+                        'weekly.0': 'daily.2', 'weekly.1': 'weekly.0'}
+
+    trash = [name for name in os.listdir(str(snapshots)) if name.startswith('_delete.')]
+    assert [snapshots.join(name, 'name').read() for name in trash] == ['weekly.1']
+
+
+def test_dry_run(conf_file, tmpdir, capsys):
+    executor = NativeBackupExecutor(conf_file, dry_run=True)
+    executor.perform_sync()
+    executor.perform_level('daily')
+
+    assert not tmpdir.join('snapshots').exists()
+    output = capsys.readouterr().out
+    assert fake_rsync in output
+    assert 'mv ' in output
+
+
+def test_resume_interrupted_sync(conf_file, tmpdir, source, mocker):
+    other = tmpdir.mkdir('other')
+    executor = NativeBackupExecutor(conf_file)
+    executor.settings.backup_points = [executor.settings.backup_points[0],
+                                       BackupPoint('{other}/'.format(other=other), 'other/', None)]
+
+    run = mocker.patch('multilevelbackup.native.run_command',
+                       side_effect=[0, subprocess.CalledProcessError(12, 'rsync')])
+    with pytest.raises(SyncError):
+        executor.perform_sync()
+    with pytest.raises(IncompleteSyncError):
+        executor.perform_level('daily')
+    assert not tmpdir.join('snapshots', 'daily.0').exists()
+
+    run.reset_mock(side_effect=True)
+    run.return_value = 0
+    executor.perform_sync()
+    assert [call[0][0][-1] for call in run.call_args_list] == [os.path.join(executor.sync_folder, 'other/')]
+
+    executor.perform_level('daily')
+    assert sorted(os.listdir(str(tmpdir.join('snapshots')))) == ['daily.0']
+    assert not tmpdir.join('snapshots', CHECKPOINT_FILE).exists()
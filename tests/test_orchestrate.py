@@ -0,0 +1,97 @@
+from multilevelbackup.orchestrate import BackupScheduler, JobResult, configs_from_paths, device_of_config, \
+    format_summary
+from concurrent.futures import ThreadPoolExecutor
+
+import threading
+import time
+import pytest
+
+
+#
+# Test helper
+#
+
+
+devices = {'a1.conf': 'a', 'a2.conf': 'a', 'a3.conf': 'a', 'b1.conf': 'b', 'b2.conf': 'b', 'c1.conf': 'c'}
+
+
+class ConcurrencyMonitor(object):
+    """Job recording the maximum number of concurrently running jobs overall and per device."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.running = {}
+        self.max_device = {}
+        self.max_total = 0
+
+    def __call__(self, config_file, fail_on=None):
+        device = devices[config_file]
+        with self._lock:
+            self.running[device] = self.running.get(device, 0) + 1
+            self.max_device[device] = max(self.max_device.get(device, 0), self.running[device])
+            self.max_total = max(self.max_total, sum(self.running.values()))
+
+        time.sleep(0.02)
+
+        with self._lock:
+            self.running[device] -= 1
+
+        if config_file == fail_on:
+            raise RuntimeError('broken')
+        return not config_file.endswith('2.conf')
+
+
+def create_scheduler(max_jobs, jobs_per_device):
+    return BackupScheduler(max_jobs=max_jobs, jobs_per_device=jobs_per_device, pool_factory=ThreadPoolExecutor,
+                           device_key=devices.get)
+
+#
+# Actual tests
+#
+
+
+@pytest.mark.parametrize('max_jobs, jobs_per_device', [(1, 1), (2, 1), (4, 1), (4, 2), (6, 3)])
+def test_concurrency_limits(max_jobs, jobs_per_device):
+    monitor = ConcurrencyMonitor()
+    results = create_scheduler(max_jobs, jobs_per_device).run(sorted(devices), monitor)
+
+    assert [result.config_file for result in results] == sorted(devices)
+    assert monitor.max_total <= max_jobs
+    assert max(monitor.max_device.values()) <= jobs_per_device
+
+
+def test_devices_used_in_parallel():
+    monitor = ConcurrencyMonitor()
+    create_scheduler(3, 1).run(sorted(devices), monitor)
+
+    assert monitor.max_total == 3
+
+
+def test_outcomes():
+    results = create_scheduler(2, 1).run(sorted(devices), ConcurrencyMonitor(), 'b1.conf')
+    outcomes = dict((result.config_file, result.outcome) for result in results)
+
+    assert outcomes['a1.conf'] == JobResult.performed
+    assert outcomes['a2.conf'] == JobResult.skipped
+    assert outcomes['b1.conf'] == JobResult.failed
+    assert 'broken' in results[3].error
+
+    summary = format_summary(results)
+    assert '3 performed, 2 skipped, 1 failed' in summary
+    assert 'RuntimeError: broken' in summary
+
+
+def test_configs_from_paths(tmpdir):
+    tmpdir.join('b.conf').write('')
+    tmpdir.join('a.conf').write('')
+    tmpdir.join('ignored.txt').write('')
+
+    assert configs_from_paths([str(tmpdir), 'other.conf']) == [str(tmpdir.join('a.conf')),
+                                                               str(tmpdir.join('b.conf')), 'other.conf']
+
+
+def test_device_of_config(tmpdir):
+    config = tmpdir.join('rsnapshot.conf')
+    config.write('snapshot_root\t{root}/not/yet/existing/\n'.format(root=tmpdir))
+
+    assert device_of_config(str(config)) == tmpdir.stat().dev
@@ -0,0 +1,24 @@
+from multilevelbackup.helpers import parse_size
+
+import pytest
+
+
+#
+# Actual tests
+#
+
+
+@pytest.mark.parametrize('text,size', [
+    ('100', 100),
+    ('4k', 4096),
+    ('50M', 50 * 1024 ** 2),
+    ('1.5G', 3 * 1024 ** 3 // 2),
+])
+def test_parse_size(text, size):
+    assert parse_size(text) == size
+
+
+@pytest.mark.parametrize('text', ['fast', '', '5T', '-1'])
+def test_invalid_size(text):
+    with pytest.raises(ValueError):
+        parse_size(text)
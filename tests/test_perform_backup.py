@@ -1,4 +1,5 @@
 from multilevelbackup import perform_backup
+from collections import OrderedDict
 
 tag_sync = 'sync'
 tag_daily = 'daily'
@@ -8,36 +9,21 @@ tag_monthly = 'monthly'
 
 class MonitoringBackupManager(object):
     def __init__(self, daily, weekly, monthly):
-        self.tasks = {'daily': daily, 'weekly': weekly, 'monthly': monthly}
+        self.tasks = OrderedDict([('daily', daily), ('weekly', weekly), ('monthly', monthly)])
         self._performed_tasks = []
 
-    @property
-    def is_daily_needed(self):
-        return self.tasks['daily']
-
-    @property
-    def is_weekly_needed(self):
-        return self.tasks['weekly']
-
-    @property
-    def is_monthly_needed(self):
-        return self.tasks['monthly']
-
     @property
     def upcoming_tasks(self):
         return self.tasks
 
+    def step_performed(self, step):
+        pass
+
     def perform_sync(self):
         self._performed_tasks.append(tag_sync)
 
-    def perform_daily(self):
-        self._performed_tasks.append(tag_daily)
-
-    def perform_weekly(self):
-        self._performed_tasks.append(tag_weekly)
-
-    def perform_monthly(self):
-        self._performed_tasks.append(tag_monthly)
+    def perform_levels(self, levels):
+        self._performed_tasks.extend(levels)
 
     @property
     def performed_tasks(self):
@@ -84,3 +70,33 @@ def test_monthly_without_weekly():
     perform_backup(manager=mocked_manager, executor=mocked_manager)
 
     assert [tag_sync, tag_monthly, tag_daily] == mocked_manager.performed_tasks
+
+
+def test_arbitrary_levels():
+    mocked_manager = MonitoringBackupManager(daily=True, weekly=True, monthly=True)
+    mocked_manager.tasks = OrderedDict([('hourly', True), ('daily', True), ('weekly', False), ('yearly', True)])
+    perform_backup(manager=mocked_manager, executor=mocked_manager)
+
+    assert [tag_sync, 'yearly', tag_daily, 'hourly'] == mocked_manager.performed_tasks
+
+
+def test_post_sync_stages():
+    mocked_manager = MonitoringBackupManager(daily=True, weekly=True, monthly=False)
+
+    class Stage(object):
+        name = 'stage'
+
+        def __call__(self, manager):
+            manager.performed_tasks.append(self.name)
+
+    report = perform_backup(manager=mocked_manager, executor=mocked_manager, post_sync=[Stage()])
+
+    assert [tag_sync, 'stage', tag_weekly, tag_daily] == mocked_manager.performed_tasks
+    assert ['sync', 'stage', 'weekly+daily'] == [step.name for step in report.steps]
+
+
+def test_post_sync_stages_skipped_without_backup():
+    mocked_manager = MonitoringBackupManager(daily=False, weekly=False, monthly=False)
+    perform_backup(manager=mocked_manager, executor=mocked_manager, post_sync=[None])
+
+    assert [] == mocked_manager.performed_tasks
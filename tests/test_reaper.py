@@ -0,0 +1,111 @@
+from multilevelbackup.reaper import Reaper, run_lowered
+from multilevelbackup.cli import main
+
+import os
+import pytest
+import sys
+
+
+#
+# Test helper
+#
+
+
+def create_tree(folder, depth=3, width=3, files=4):
+    """Create folder tree with hardlinked and read-only files."""
+    os.makedirs(folder)
+    for index in range(files):
+        file_name = os.path.join(folder, 'file{index}'.format(index=index))
+        with open(file_name, 'w') as data:
+            data.write(file_name)
+        os.link(file_name, file_name + '.link')
+        os.chmod(file_name, 0o400)
+    os.symlink('file0', os.path.join(folder, 'symlink'))
+
+    if depth > 0:
+        for index in range(width):
+            create_tree(os.path.join(folder, 'sub{index}'.format(index=index)), depth - 1, width, files)
+
+
+@pytest.fixture(scope='function')
+def snapshot_root(tmpdir):
+    root = tmpdir.mkdir('root')
+    create_tree(str(root.join('_delete.20151105T200000.daily.6')))
+    create_tree(str(root.join('_delete.20151106T200000.weekly.3')), depth=1)
+    create_tree(str(root.join('daily.0')), depth=0)
+    return root
+
+#
+# Actual tests
+#
+
+
+def test_pending(snapshot_root):
+    reaper = Reaper(str(snapshot_root))
+
+    assert [os.path.basename(folder) for folder in reaper.pending()] == ['_delete.20151105T200000.daily.6',
+                                                                         '_delete.20151106T200000.weekly.3']
+
+
+@pytest.mark.parametrize('workers', [1, 4])
+def test_reap(snapshot_root, workers):
+    reaper = Reaper(str(snapshot_root), workers=workers)
+    snapshots, files = reaper.reap()
+
+    assert snapshots == 2
+    assert files == 40 * 9 + 4 * 9
+    assert os.listdir(str(snapshot_root)) == ['daily.0']
+    assert reaper.pending() == []
+
+
+def test_reap_partially_deleted(snapshot_root):
+    trash = snapshot_root.join('_delete.20151105T200000.daily.6')
+    trash.join('sub0').remove()
+    trash.join('file1').remove()
+
+    Reaper(str(snapshot_root)).reap()
+    assert os.listdir(str(snapshot_root)) == ['daily.0']
+
+
+def test_reap_command(snapshot_root, tmpdir, capsys):
+    config = tmpdir.join('rsnapshot.conf')
+    config.write('snapshot_root\t{root}/\n'.format(root=snapshot_root))
+
+    assert main(['reap', '-c', str(config), '--reap-workers', '2']) == 0
+    assert os.listdir(str(snapshot_root)) == ['daily.0']
+    assert 'Deleted 2 expired snapshot(s)' in capsys.readouterr().out
+
+
+@pytest.mark.skipif(not sys.platform.startswith('linux'), reason='nice values are per thread on Linux only')
+def test_run_lowered_keeps_priority_of_caller():
+    before = os.nice(0)
+    assert run_lowered(lambda: os.nice(0), niceness=1) == min(before + 1, 19)
+    assert os.nice(0) == before
+
+    def fail():
+        raise RuntimeError('failed')
+
+    with pytest.raises(RuntimeError):
+        run_lowered(fail)
+
+
+@pytest.mark.skipif(not sys.platform.startswith('linux'), reason='nice values are per thread on Linux only')
+def test_backup_reaps_without_lowering_priority(tmpdir):
+    source = tmpdir.mkdir('source')
+    source.join('file.txt').write('content')
+    config = tmpdir.join('rsnapshot.conf')
+    config.write('\n'.join([
+        'snapshot_root\t{root}/snapshots/'.format(root=tmpdir),
+        'cmd_rsync\t{rsync}'.format(rsync=os.path.abspath('tests/fake-rsync')),
+        'retain\tdaily\t1',
+        'backup\t{source}/\tlocalhost/'.format(source=source),
+    ]) + '\n')
+    before = os.nice(0)
+
+    # The second backup expires the first snapshot, it is deleted by the pass after the rotation
+    for _ in range(2):
+        assert main(['-c', str(config), '-n', '-s', str(tmpdir.join('state')), '-g', 'daily=0d', '--reap',
+                     '--nice', '1']) == 0
+
+    assert sorted(os.listdir(str(tmpdir.join('snapshots')))) == ['daily.0']
+    assert os.nice(0) == before
@@ -0,0 +1,156 @@
+from multilevelbackup.report import RsyncOutputParser, TransferStats, ProgressEvent, ProgressPrinter, StepReport, \
+    is_output
+from multilevelbackup.process import run_command
+from multilevelbackup import perform_backup
+from collections import OrderedDict
+
+import subprocess
+import sys
+import pytest
+
+
+#
+# Test data
+#
+
+
+rsync_stats_output = """
+Number of files: 12,345 (reg: 11,000, dir: 1,345)
+Number of created files: 20 (reg: 20)
+Number of deleted files: 0
+Number of regular files transferred: 42
+Total file size: 9,876,543,210 bytes
+Total transferred file size: 1,234,567 bytes
+Literal data: 1,234,567 bytes
+Matched data: 0 bytes
+File list size: 0
+Total bytes sent: 1,300,000
+Total bytes received: 1,024
+
+sent 1,300,000 bytes  received 1,024 bytes  2,602,048.00 bytes/sec
+"""
+
+
+class SteppingExecutor(object):
+    def perform_sync(self):
+        return StepReport('sync', 2.5, TransferStats(files_transferred=3, transferred_size=100))
+
+    def perform_levels(self, levels):
+        return [StepReport(level, 0.5) for level in levels]
+
+
+class SilentExecutor(object):
+    def perform_sync(self):
+        pass
+
+    def perform_levels(self, levels):
+        pass
+
+
+class FixedManager(object):
+    def __init__(self, **tasks):
+        self.upcoming_tasks = OrderedDict(sorted(tasks.items()))
+
+    def step_performed(self, step):
+        pass
+
+#
+# Actual tests
+#
+
+
+def test_parse_stats():
+    parser = RsyncOutputParser()
+    for line in rsync_stats_output.splitlines():
+        parser.feed(line)
+
+    assert parser.stats == TransferStats(files=12345, files_transferred=42, total_size=9876543210,
+                                         transferred_size=1234567, bytes_sent=1300000, bytes_received=1024)
+
+
+def test_parse_progress():
+    events = []
+    parser = RsyncOutputParser(on_progress=events.append)
+    parser.feed('  1,234,567  45%   12.34MB/s    0:00:10 (xfr#12, to-chk=100/2000)')
+    parser.feed('sending incremental file list')
+
+    assert events == [ProgressEvent(bytes=1234567, percent=45, rate='12.34MB/s', eta='0:00:10')]
+
+
+def test_progress_printer(capsys):
+    now = [0.0]
+    printer = ProgressPrinter(interval=10.0, clock=lambda: now[0])
+    event = ProgressEvent(bytes=1234567, percent=45, rate='12.34MB/s', eta='0:00:10')
+
+    printer('one/', event)
+    printer('one/', event)
+    printer('two/', event)
+    now[0] = 10.0
+    printer('one/', event)
+
+    lines = capsys.readouterr().out.splitlines()
+    assert lines == ['-- Progress of one/: 1234567 bytes (45%) at 12.34MB/s, 0:00:10 remaining',
+                     '-- Progress of two/: 1234567 bytes (45%) at 12.34MB/s, 0:00:10 remaining',
+                     '-- Progress of one/: 1234567 bytes (45%) at 12.34MB/s, 0:00:10 remaining']
+
+
+def test_progress_not_echoed(capsys):
+    script = 'import sys; sys.stdout.write("receiving\\n      1,024  10%    1.00MB/s    0:00:09\\rdone\\n")'
+    events = []
+    run_command([sys.executable, '-c', script], handlers=[RsyncOutputParser(on_progress=events.append)],
+                echo=is_output)
+
+    assert capsys.readouterr().out == 'receiving\ndone\n'
+    assert events == [ProgressEvent(bytes=1024, percent=10, rate='1.00MB/s', eta='0:00:09')]
+
+
+def test_stats_merge():
+    stats = TransferStats(files=1, bytes_sent=10)
+    stats.merge(TransferStats(files=2, bytes_received=5))
+
+    assert stats == TransferStats(files=3, bytes_sent=10, bytes_received=5)
+
+
+def test_run_command_streams_lines(capsys):
+    lines = []
+
+    class Collector(object):
+        feed = lines.append
+
+    script = 'import sys; sys.stdout.write("one\\ntwo\\rthree\\n"); sys.stderr.write("error\\n")'
+    assert run_command([sys.executable, '-c', script], handlers=[Collector()]) == 0
+
+    assert sorted(lines) == ['error', 'one', 'three', 'two']
+    assert 'three' in capsys.readouterr().out
+
+
+def test_run_command_failure():
+    with pytest.raises(subprocess.CalledProcessError):
+        run_command([sys.executable, '-c', 'import sys; sys.exit(3)'], echo=False)
+
+    assert run_command([sys.executable, '-c', 'import sys; sys.exit(3)'], accepted=(0, 3), echo=False) == 3
+
+
+def test_report_of_backup():
+    report = perform_backup(FixedManager(daily=True, weekly=True), SteppingExecutor())
+
+    assert report.performed
+    assert [step.name for step in report.steps] == ['sync', 'weekly', 'daily']
+    assert report.duration == 3.5
+    assert report.stats.files_transferred == 3
+    assert report.step('sync').stats.transferred_size == 100
+    assert 'total' in report.format()
+
+
+def test_report_measured_by_default():
+    report = perform_backup(FixedManager(daily=True, weekly=False), SilentExecutor())
+
+    assert [step.name for step in report.steps] == ['sync', 'daily']
+    assert all(step.duration >= 0 for step in report.steps)
+
+
+def test_report_nothing_performed():
+    report = perform_backup(FixedManager(daily=False, weekly=False), SilentExecutor())
+
+    assert not report.performed
+    assert report.steps == []
@@ -0,0 +1,126 @@
+from multilevelbackup.cli import main
+from multilevelbackup.restore import copy_data, restore_tree
+
+import errno
+import os
+import pytest
+
+
+#
+# Test helper
+#
+
+
+@pytest.fixture(scope='function')
+def snapshot(tmpdir):
+    snapshot = tmpdir.mkdir('snapshots').mkdir('daily.0')
+    folder = snapshot.mkdir('host').mkdir('data')
+    folder.join('file.txt').write('content')
+    folder.mkdir('sub').join('big.bin').write_binary(os.urandom(3 * 1024 * 1024 + 17))
+    os.link(str(folder.join('file.txt')), str(folder.join('sub', 'link.txt')))
+    os.symlink('../file.txt', str(folder.join('sub', 'symlink')))
+
+    folder.join('private.txt').write('secret')
+    os.chmod(str(folder.join('private.txt')), 0o640)
+    os.utime(str(folder.join('private.txt')), (1000000000, 1000000000))
+    os.utime(str(folder.join('sub')), (1100000000, 1100000000))
+    return snapshot
+
+
+def restored(tmpdir, *names):
+    return str(tmpdir.join('restored', *names))
+
+
+#
+# Actual tests
+#
+
+
+def test_restore_tree(tmpdir, snapshot):
+    progress = restore_tree(str(snapshot.join('host', 'data')), restored(tmpdir), workers=2)
+
+    assert (progress.files, progress.skipped, progress.linked) == (3, 0, 1)
+    assert progress.bytes == progress.total_bytes == 3 * 1024 * 1024 + 17 + len('content') + len('secret')
+
+    assert open(restored(tmpdir, 'sub', 'big.bin'), 'rb').read() == snapshot.join('host', 'data', 'sub',
+                                                                                  'big.bin').read_binary()
+    assert os.stat(restored(tmpdir, 'file.txt')).st_ino == os.stat(restored(tmpdir, 'sub', 'link.txt')).st_ino
+    assert os.readlink(restored(tmpdir, 'sub', 'symlink')) == '../file.txt'
+
+    info = os.stat(restored(tmpdir, 'private.txt'))
+    assert info.st_mode & 0o777 == 0o640
+    assert info.st_mtime == 1000000000
+    assert os.stat(restored(tmpdir, 'sub')).st_mtime == 1100000000
+    assert not [name for name in os.listdir(restored(tmpdir)) if name.endswith('.restore-tmp')]
+
+
+def test_resume(tmpdir, snapshot, mocker):
+    restore_tree(str(snapshot.join('host', 'data')), restored(tmpdir))
+
+    # Interrupted copy: content written, but metadata not applied yet
+    with open(restored(tmpdir, 'private.txt'), 'w') as data:
+        data.write('secr')
+    os.unlink(restored(tmpdir, 'sub', 'big.bin'))
+
+    copy = mocker.patch('multilevelbackup.restore.copy_data', side_effect=copy_data)
+    progress = restore_tree(str(snapshot.join('host', 'data')), restored(tmpdir))
+
+    assert copy.call_count == 2
+    assert (progress.files, progress.skipped, progress.linked) == (3, 1, 0)
+    assert open(restored(tmpdir, 'private.txt')).read() == 'secret'
+    assert os.path.getsize(restored(tmpdir, 'sub', 'big.bin')) == 3 * 1024 * 1024 + 17
+    assert os.stat(restored(tmpdir, 'file.txt')).st_ino == os.stat(restored(tmpdir, 'sub', 'link.txt')).st_ino
+
+
+def test_failed_copy_leaves_no_temporary_file(tmpdir, snapshot, mocker):
+    def failing(source, target):
+        with open(target, 'w') as data:
+            data.write('partial')
+        raise OSError(errno.EIO, 'I/O error')
+
+    mocker.patch('multilevelbackup.restore.copy_data', side_effect=failing)
+    with pytest.raises(OSError):
+        restore_tree(str(snapshot.join('host', 'data', 'private.txt')), restored(tmpdir, 'private.txt'))
+
+    assert os.listdir(restored(tmpdir)) == []
+
+
+def test_restore_single_file(tmpdir, snapshot):
+    restore_tree(str(snapshot.join('host', 'data', 'private.txt')), restored(tmpdir, 'nested', 'private.txt'))
+
+    assert open(restored(tmpdir, 'nested', 'private.txt')).read() == 'secret'
+
+
+@pytest.mark.parametrize('failing', [['copy_file_range'], ['copy_file_range', 'sendfile']])
+def test_copy_fallback(tmpdir, monkeypatch, failing):
+    def unsupported(*args):
+        raise OSError(errno.EXDEV if args else errno.EINVAL, 'unsupported')
+
+    for name in failing:
+        monkeypatch.setattr(os, name, unsupported, raising=False)
+    source = tmpdir.join('source')
+    source.write_binary(os.urandom(100000))
+
+    copy_data(str(source), str(tmpdir.join('target')))
+    assert tmpdir.join('target').read_binary() == source.read_binary()
+
+
+def test_copy_error(tmpdir, monkeypatch):
+    def failing(*args):
+        raise OSError(errno.EIO, 'I/O error')
+
+    monkeypatch.setattr(os, 'copy_file_range', failing, raising=False)
+    monkeypatch.setattr(os, 'sendfile', failing)
+    tmpdir.join('source').write('content')
+
+    with pytest.raises(OSError):
+        copy_data(str(tmpdir.join('source')), str(tmpdir.join('target')))
+
+
+def test_command(tmpdir, snapshot, capsys):
+    config = tmpdir.join('rsnapshot.conf')
+    config.write('snapshot_root\t{root}/\nretain\tdaily\t3\n'.format(root=tmpdir.join('snapshots')))
+
+    assert main(['restore', '-c', str(config), 'daily.0', '/host/data', restored(tmpdir)]) == 0
+    assert capsys.readouterr().out.startswith('Restored 3 files with ')
+    assert main(['restore', '-c', str(config), 'daily.0', 'host/missing', restored(tmpdir)]) == 1
@@ -0,0 +1,137 @@
+from multilevelbackup.rotation import RotationPlan, RotationEngine, RotationError, JOURNAL_FILE
+from collections import OrderedDict
+
+import json
+import os
+import pytest
+
+
+#
+# Test helper
+#
+
+
+intervals = OrderedDict([('daily', 3), ('weekly', 2), ('monthly', 2)])
+
+
+@pytest.fixture(scope='function')
+def snapshot_root(tmpdir):
+    root = tmpdir.mkdir('root')
+    for name in ['.sync', 'daily.0', 'daily.1', 'daily.2', 'weekly.0', 'weekly.1', 'monthly.0']:
+        root.mkdir(name).join('name').write(name)
+    return root
+
+
+def contents(snapshot_root):
+    """:return Original name of every folder in snapshot root by its current name."""
+    return dict((name, snapshot_root.join(name, 'name').read()) for name in os.listdir(str(snapshot_root))
+                if name != JOURNAL_FILE)
+
+
+def simulate_interruption(snapshot_root, plan, performed, recorded=True):
+    """Simulate power loss after some renames, the last rename is not recorded in the journal if requested."""
+    journal = [json.dumps(plan.renames)] + ['.'] * (performed if recorded else max(performed - 1, 0))
+    snapshot_root.join(JOURNAL_FILE).write('\n'.join(journal) + '\n')
+    for source, target in plan.renames[:performed]:
+        os.rename(str(snapshot_root.join(source)), str(snapshot_root.join(target)))
+
+
+rotated = {'daily.0': '.sync', 'daily.1': 'daily.0', 'daily.2': 'daily.1', 'weekly.0': 'daily.2',
+           'weekly.1': 'weekly.0', 'monthly.0': 'weekly.1', 'monthly.1': 'monthly.0'}
+
+#
+# Actual tests
+#
+
+
+def test_plan_single_level():
+    plan = RotationPlan.create(intervals, ['daily'], {'.sync', 'daily.0', 'daily.2'}, stamp='now')
+
+    assert plan.renames == [('daily.2', '_delete.now.daily.2'), ('daily.0', 'daily.1'), ('.sync', 'daily.0')]
+    assert plan.expired == ['_delete.now.daily.2']
+
+
+def test_plan_all_levels():
+    existing = {'.sync', 'daily.0', 'daily.1', 'daily.2', 'weekly.0', 'weekly.1', 'monthly.0', 'monthly.1'}
+    plan = RotationPlan.create(intervals, ['monthly', 'weekly', 'daily'], existing, stamp='now')
+
+    assert plan.renames == [
+        ('monthly.1', '_delete.now.monthly.1'), ('monthly.0', 'monthly.1'), ('weekly.1', 'monthly.0'),
+        ('weekly.0', 'weekly.1'), ('daily.2', 'weekly.0'),
+        ('daily.1', 'daily.2'), ('daily.0', 'daily.1'), ('.sync', 'daily.0')
+    ]
+    assert plan.expired == ['_delete.now.monthly.1']
+
+
+def test_plan_missing_source():
+    plan = RotationPlan.create(intervals, ['weekly', 'daily'], {'daily.0', 'daily.1'})
+
+    assert len(plan) == 0
+
+
+def test_apply(snapshot_root):
+    engine = RotationEngine(str(snapshot_root))
+    plan = engine.plan(intervals, ['monthly', 'weekly', 'daily'])
+    engine.apply(plan)
+
+    assert contents(snapshot_root) == rotated
+    assert not snapshot_root.join(JOURNAL_FILE).exists()
+
+
+def test_apply_expired(snapshot_root):
+    engine = RotationEngine(str(snapshot_root))
+    plan = engine.plan(intervals, ['daily'])
+    engine.apply(plan)
+
+    assert len(plan.expired) == 1
+    assert snapshot_root.join(plan.expired[0], 'name').read() == 'daily.2'
+
+
+@pytest.mark.parametrize('interrupted_after', [0, 1, 4, 6, 8])
+def test_resume(snapshot_root, interrupted_after):
+    engine = RotationEngine(str(snapshot_root))
+    plan = engine.plan(intervals, ['monthly', 'weekly', 'daily'])
+
+    simulate_interruption(snapshot_root, plan, interrupted_after)
+
+    assert engine.recover()
+    assert contents(snapshot_root) == rotated
+    assert not engine.recover()
+
+
+@pytest.mark.parametrize('interrupted_after', [1, 4, 6])
+def test_resume_unrecorded_rename(snapshot_root, interrupted_after):
+    engine = RotationEngine(str(snapshot_root))
+    plan = engine.plan(intervals, ['monthly', 'weekly', 'daily'])
+    simulate_interruption(snapshot_root, plan, interrupted_after, recorded=False)
+
+    assert engine.recover()
+    assert contents(snapshot_root) == rotated
+
+
+@pytest.mark.parametrize('interrupted_after', [0, 1, 3, 6, 8])
+def test_rollback(snapshot_root, interrupted_after):
+    original = contents(snapshot_root)
+    engine = RotationEngine(str(snapshot_root))
+    plan = engine.plan(intervals, ['monthly', 'weekly', 'daily'])
+
+    simulate_interruption(snapshot_root, plan, interrupted_after, recorded=False)
+
+    assert engine.recover(rollback=True)
+    assert contents(snapshot_root) == original
+
+
+def test_apply_completes_interrupted_rotation(snapshot_root):
+    engine = RotationEngine(str(snapshot_root))
+    snapshot_root.join(JOURNAL_FILE).write(json.dumps([['daily.2', '_delete.old.daily.2']]) + '\n')
+    engine.apply(RotationPlan([]))
+
+    assert snapshot_root.join('_delete.old.daily.2').exists()
+    assert not snapshot_root.join(JOURNAL_FILE).exists()
+
+
+def test_conflict(snapshot_root):
+    engine = RotationEngine(str(snapshot_root))
+
+    with pytest.raises(RotationError):
+        engine.apply(RotationPlan([('daily.0', 'daily.1')]))
@@ -1,4 +1,5 @@
-from multilevelbackup.config import backup_root_from_config, intervals_from_config
+from multilevelbackup.config import backup_root_from_config, intervals_from_config, backup_points_from_config, \
+    value_from_config, BackupPoint
 
 import pytest
 
@@ -30,3 +31,25 @@ def test_no_intervals_given():
     with pytest.raises(ValueError) as excinfo:
         intervals_from_config('retain  daily  9')
     assert 'backup intervals' in str(excinfo.value)
+
+
+def test_backup_points():
+    assert backup_points_from_config('backup\t/home/\tlocalhost/') == [('/home/', 'localhost/', None)]
+    assert backup_points_from_config('backup\t\t/home/\t\tlocalhost/\t\texclude=/x') == [
+        ('/home/', 'localhost/', 'exclude=/x')]
+    assert backup_points_from_config('backup_script\t/bin/dump\tdump/') == []
+
+    minimal_config = open('tests/rsnapshot-minimal.conf').read()
+    assert backup_points_from_config(minimal_config) == [
+        BackupPoint('/home/', 'localhost/', None),
+        BackupPoint('/etc/', 'localhost/', None),
+        BackupPoint('root@example.com:/var/', 'example/', 'exclude=/var/cache')
+    ]
+
+
+def test_value():
+    assert value_from_config('lockfile\t/var/run/rsnapshot.pid\n', 'lockfile') == '/var/run/rsnapshot.pid'
+    assert value_from_config('#lockfile\t/var/run/rsnapshot.pid\n', 'lockfile') is None
+
+    minimal_config = open('tests/rsnapshot-minimal.conf').read()
+    assert value_from_config(minimal_config, 'config_version') == '1.2'
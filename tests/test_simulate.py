@@ -0,0 +1,106 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from multilevelbackup.backup import DefaultSnapshotManager, perform_backup
+from multilevelbackup.cli import main
+from multilevelbackup.simulate import DAY, MemorySnapshotStore, SimulatedExecutor, VirtualClock, parse_retain, \
+    simulate, simulate_pattern, uptime_pattern
+
+import multilevelbackup.simulate
+import pytest
+import random
+
+
+#
+# Test helper
+#
+
+
+intervals = OrderedDict([('daily', 3), ('weekly', 2), ('monthly', 2)])
+
+
+def summary(result):
+    levels = [(stats.samples, stats.snapshots, round(stats.age_total, 6), stats.age_max)
+              for stats in result.levels.values()]
+    return (result.days, result.syncs, result.samples, round(result.oldest_total, 6), result.oldest_min,
+            round(result.spacing_total, 6), result.spacing_max, levels)
+
+
+#
+# Actual tests
+#
+
+
+def test_executor_rotates_store():
+    clock = VirtualClock(1000000000.0)
+    store = MemorySnapshotStore()
+    manager = DefaultSnapshotManager('<simulated>', intervals, inventory=store, clock=clock)
+    executor = SimulatedExecutor(store, intervals, clock)
+
+    for day in range(11):
+        clock.now = 1000000000.0 + day * DAY
+        perform_backup(manager, executor)
+        # Second invocation on the same day does nothing
+        perform_backup(manager, executor)
+
+    assert executor.syncs == 11
+    assert store.indices('daily') == [0, 1, 2]
+    assert store.indices('weekly') == [0, 1]
+    assert store.mtime('daily', 0) == clock.now
+    assert store.mtime('weekly', 0) == 1000000000.0 + 7 * DAY
+    assert store.mtime('weekly', 1) == 1000000000.0
+    assert '.sync' not in store.names
+
+
+def test_simulate_always():
+    result = simulate(intervals, pattern='always', years=3)
+
+    assert result.days == result.up_days == result.backup_days == result.syncs
+    assert result.levels['daily'].mean_snapshots == 3
+    assert result.levels['daily'].age_max == pytest.approx(0.5, abs=0.05)
+    assert result.cycle is not None
+
+
+def test_cycle_matches_full_simulation():
+    # Random pattern which is always up, so it runs without the cycle fast-forward
+    full = simulate(intervals, pattern='random:1', years=5)
+    assert full.cycle is None
+    assert summary(simulate(intervals, pattern='always', years=5)) == summary(full)
+
+
+def test_hourly_levels():
+    result = simulate(OrderedDict([('hourly', 4), ('daily', 3)]), pattern='workdays', years=1, invocations=6)
+
+    assert result.cycle is None
+    assert result.syncs == 6 * result.up_days
+    assert result.levels['hourly'].mean_snapshots == 4
+
+
+def test_chunks_independent_of_workers(monkeypatch):
+    monkeypatch.setattr(multilevelbackup.simulate, 'CHUNK_YEARS', 1)
+
+    sequential = simulate_pattern(intervals, pattern='laptop', years=3, seed=7)
+    parallel = simulate_pattern(intervals, pattern='laptop', years=3, seed=7, workers=3,
+                                pool_factory=ThreadPoolExecutor)
+    assert summary(parallel) == summary(sequential)
+    assert sequential.days == summary(simulate(intervals, pattern='laptop', years=1))[0] * 3
+
+
+@pytest.mark.parametrize('name', ['sometimes', 'random:0', 'random:1.5'])
+def test_invalid_pattern(name):
+    with pytest.raises(ValueError):
+        uptime_pattern(name, random.Random())
+
+
+def test_parse_retain():
+    assert parse_retain('daily=7') == ('daily', 7)
+    with pytest.raises(ValueError):
+        parse_retain('daily=0')
+
+
+def test_command(capsys):
+    assert main(['simulate', '--years', '2', '-p', 'workdays', '-r', 'daily=3', '-r', 'weekly=2']) == 0
+
+    output = capsys.readouterr().out
+    assert output.startswith('-- Pattern workdays: 2 years, 71.')
+    assert 'weekly' in output
@@ -1,6 +1,7 @@
 from multilevelbackup import DefaultSnapshotManager
-from datetime import datetime
-from unittest.mock import PropertyMock
+from multilevelbackup.levels import parse_min_gap
+from datetime import datetime, timedelta
+from collections import OrderedDict
 
 import os
 import pytest
@@ -23,24 +24,13 @@ def create_folder(folder, timestamp):
 
 
 @pytest.fixture(scope='function')
-def mock_daily(mocker):
-    return mocker.patch('multilevelbackup.DefaultSnapshotManager.is_daily_needed', new_callable=PropertyMock)
+def mock_levels(mocker):
+    return mocker.patch('multilevelbackup.levels.LevelChain.is_level_due')
 
 
-@pytest.fixture(scope='function')
-def mock_weekly(mocker):
-    return mocker.patch('multilevelbackup.DefaultSnapshotManager.is_weekly_needed', new_callable=PropertyMock)
-
-
-@pytest.fixture(scope='function')
-def mock_monthly(mocker):
-    return mocker.patch('multilevelbackup.DefaultSnapshotManager.is_monthly_needed', new_callable=PropertyMock)
-
-
-def mock_return_values(mocked_properties):
-    """Set return values of given mocks to given value."""
-    for mock in mocked_properties:
-        mock.return_value = mocked_properties[mock]
+def mock_return_values(mock_levels, needed):
+    """Let level check return given values per level."""
+    mock_levels.side_effect = lambda name, snapshots, now=None: needed[name]
 
 #
 # Actual level indicator tests
@@ -48,83 +38,85 @@ def mock_return_values(mocked_properties):
 
 
 def test_indicator_empty_folder(snapshot_manager):
-    assert snapshot_manager.is_daily_needed
-    assert not snapshot_manager.is_weekly_needed
-    assert not snapshot_manager.is_monthly_needed
+    assert snapshot_manager.is_level_needed('daily')
+    assert not snapshot_manager.is_level_needed('weekly')
+    assert not snapshot_manager.is_level_needed('monthly')
 
 
 def test_indicator_daily_executed(snapshot_manager):
-    create_folder(snapshot_manager.daily_first, datetime.now())
+    create_folder(snapshot_manager.first_snapshot('daily'), datetime.now())
 
-    assert not snapshot_manager.is_daily_needed
+    assert not snapshot_manager.is_level_needed('daily')
 
 
 def test_indicator_daily_needed(snapshot_manager):
-    create_folder(snapshot_manager.daily_first, datetime.now() - snapshot_manager.daily_diff)
+    create_folder(snapshot_manager.first_snapshot('daily'), datetime.now() - snapshot_manager.min_gap('daily'))
 
-    assert snapshot_manager.is_daily_needed
+    assert snapshot_manager.is_level_needed('daily')
 
 
 def test_indicator_weekly_first(snapshot_manager):
     today = datetime.now()
-    create_folder(snapshot_manager.daily_first, today - snapshot_manager.daily_diff)
-    create_folder(snapshot_manager.daily_last, today - snapshot_manager.weekly_diff)
+    create_folder(snapshot_manager.first_snapshot('daily'), today - snapshot_manager.min_gap('daily'))
+    create_folder(snapshot_manager.last_snapshot('daily'), today - snapshot_manager.min_gap('weekly'))
 
-    assert snapshot_manager.is_weekly_needed
+    assert snapshot_manager.is_level_needed('weekly')
 
 
 def test_indicator_weekly_executed(snapshot_manager):
     today = datetime.now()
-    create_folder(snapshot_manager.daily_last, today)
-    create_folder(snapshot_manager.weekly_first, today - snapshot_manager.daily_diff)
+    create_folder(snapshot_manager.last_snapshot('daily'), today)
+    create_folder(snapshot_manager.first_snapshot('weekly'), today - snapshot_manager.min_gap('daily'))
 
-    assert not snapshot_manager.is_weekly_needed
+    assert not snapshot_manager.is_level_needed('weekly')
 
 
 def test_indicator_weekly_almost_needed(snapshot_manager):
     today = datetime.now()
-    create_folder(snapshot_manager.daily_last, today)
-    create_folder(snapshot_manager.weekly_first, today - snapshot_manager.weekly_diff + snapshot_manager.daily_diff)
+    create_folder(snapshot_manager.last_snapshot('daily'), today)
+    create_folder(snapshot_manager.first_snapshot('weekly'),
+                  today - snapshot_manager.min_gap('weekly') + snapshot_manager.min_gap('daily'))
 
-    assert not snapshot_manager.is_weekly_needed
+    assert not snapshot_manager.is_level_needed('weekly')
 
 
 def test_indicator_weekly_needed(snapshot_manager):
     today = datetime.now()
-    create_folder(snapshot_manager.daily_last, today)
-    create_folder(snapshot_manager.weekly_first, today - snapshot_manager.weekly_diff)
+    create_folder(snapshot_manager.last_snapshot('daily'), today)
+    create_folder(snapshot_manager.first_snapshot('weekly'), today - snapshot_manager.min_gap('weekly'))
 
-    assert snapshot_manager.is_weekly_needed
+    assert snapshot_manager.is_level_needed('weekly')
 
 
 def test_indicator_monthly_first(snapshot_manager):
-    create_folder(snapshot_manager.weekly_last, datetime.now())
+    create_folder(snapshot_manager.last_snapshot('weekly'), datetime.now())
 
-    assert snapshot_manager.is_monthly_needed
+    assert snapshot_manager.is_level_needed('monthly')
 
 
 def test_indicator_monthly_executed(snapshot_manager):
     today = datetime.now()
-    create_folder(snapshot_manager.weekly_last, today)
-    create_folder(snapshot_manager.monthly_first, today - snapshot_manager.daily_diff)
+    create_folder(snapshot_manager.last_snapshot('weekly'), today)
+    create_folder(snapshot_manager.first_snapshot('monthly'), today - snapshot_manager.min_gap('daily'))
 
-    assert not snapshot_manager.is_monthly_needed
+    assert not snapshot_manager.is_level_needed('monthly')
 
 
 def test_indicator_monthly_almost_needed(snapshot_manager):
     today = datetime.now()
-    create_folder(snapshot_manager.weekly_last, today)
-    create_folder(snapshot_manager.monthly_first, today - snapshot_manager.monthly_diff + snapshot_manager.daily_diff)
+    create_folder(snapshot_manager.last_snapshot('weekly'), today)
+    create_folder(snapshot_manager.first_snapshot('monthly'),
+                  today - snapshot_manager.min_gap('monthly') + snapshot_manager.min_gap('daily'))
 
-    assert not snapshot_manager.is_monthly_needed
+    assert not snapshot_manager.is_level_needed('monthly')
 
 
 def test_indicator_monthly_needed(snapshot_manager):
     today = datetime.now()
-    create_folder(snapshot_manager.weekly_last, today)
-    create_folder(snapshot_manager.monthly_first, today - snapshot_manager.monthly_diff)
+    create_folder(snapshot_manager.last_snapshot('weekly'), today)
+    create_folder(snapshot_manager.first_snapshot('monthly'), today - snapshot_manager.min_gap('monthly'))
 
-    assert snapshot_manager.is_monthly_needed
+    assert snapshot_manager.is_level_needed('monthly')
 
 
 #
@@ -132,43 +124,43 @@ def test_indicator_monthly_needed(snapshot_manager):
 #
 
 
-def test_upcoming_first_backup(mock_daily, mock_weekly, mock_monthly):
-    mock_return_values({mock_daily: True, mock_weekly: False, mock_monthly: False})
+def test_upcoming_first_backup(mock_levels):
+    mock_return_values(mock_levels, {'daily': True, 'weekly': False, 'monthly': False})
 
     tasks = DefaultSnapshotManager(backup_root='').upcoming_tasks
     assert tasks == {'daily': True, 'weekly': False, 'monthly': False}
 
 
-def test_upcoming_daily_weekly(mock_daily, mock_weekly, mock_monthly):
-    mock_return_values({mock_daily: True, mock_weekly: True, mock_monthly: False})
+def test_upcoming_daily_weekly(mock_levels):
+    mock_return_values(mock_levels, {'daily': True, 'weekly': True, 'monthly': False})
 
     tasks = DefaultSnapshotManager(backup_root='').upcoming_tasks
     assert tasks == {'daily': True, 'weekly': True, 'monthly': False}
 
 
-def test_upcoming_full_backup(mock_daily, mock_weekly, mock_monthly):
-    mock_return_values({mock_daily: True, mock_weekly: True, mock_monthly: True})
+def test_upcoming_full_backup(mock_levels):
+    mock_return_values(mock_levels, {'daily': True, 'weekly': True, 'monthly': True})
 
     tasks = DefaultSnapshotManager(backup_root='').upcoming_tasks
     assert tasks == {'daily': True, 'weekly': True, 'monthly': True}
 
 
-def test_upcoming_weekly_monthly_ignored(mock_daily, mock_weekly, mock_monthly):
-    mock_return_values({mock_daily: False, mock_weekly: True, mock_monthly: True})
+def test_upcoming_weekly_monthly_ignored(mock_levels):
+    mock_return_values(mock_levels, {'daily': False, 'weekly': True, 'monthly': True})
 
     tasks = DefaultSnapshotManager(backup_root='').upcoming_tasks
     assert tasks == {'daily': False, 'weekly': False, 'monthly': False}
 
 
-def test_upcoming_monthly_ignored(mock_daily, mock_weekly, mock_monthly):
-    mock_return_values({mock_daily: False, mock_weekly: False, mock_monthly: True})
+def test_upcoming_monthly_ignored(mock_levels):
+    mock_return_values(mock_levels, {'daily': False, 'weekly': False, 'monthly': True})
 
     tasks = DefaultSnapshotManager(backup_root='').upcoming_tasks
     assert tasks == {'daily': False, 'weekly': False, 'monthly': False}
 
 
-def test_upcoming_monthly_without_weekly_ignored(mock_daily, mock_weekly, mock_monthly):
-    mock_return_values({mock_daily: True, mock_weekly: False, mock_monthly: True})
+def test_upcoming_monthly_without_weekly_ignored(mock_levels):
+    mock_return_values(mock_levels, {'daily': True, 'weekly': False, 'monthly': True})
 
     tasks = DefaultSnapshotManager(backup_root='').upcoming_tasks
     assert tasks == {'daily': True, 'weekly': False, 'monthly': False}
@@ -177,14 +169,74 @@ def test_upcoming_monthly_without_weekly_ignored(mock_daily, mock_weekly, mock_m
 def test_create_from_config():
     manager = DefaultSnapshotManager.create_from_rsnapshot_conf('tests/rsnapshot-minimal.conf')
 
-    assert manager.daily_first == '/rsnapshot/minimal/config/root/daily.0'
-    assert manager.daily_last == '/rsnapshot/minimal/config/root/daily.5'
-    assert manager.weekly_first == '/rsnapshot/minimal/config/root/weekly.0'
-    assert manager.weekly_last == '/rsnapshot/minimal/config/root/weekly.6'
-    assert manager.monthly_first == '/rsnapshot/minimal/config/root/monthly.0'
+    assert manager.first_snapshot('daily') == '/rsnapshot/minimal/config/root/daily.0'
+    assert manager.last_snapshot('daily') == '/rsnapshot/minimal/config/root/daily.5'
+    assert manager.first_snapshot('weekly') == '/rsnapshot/minimal/config/root/weekly.0'
+    assert manager.last_snapshot('weekly') == '/rsnapshot/minimal/config/root/weekly.6'
+    assert manager.first_snapshot('monthly') == '/rsnapshot/minimal/config/root/monthly.0'
 
 
 def test_create_from_config_faulty():
     with pytest.raises(ValueError) as excinfo:
         manager = DefaultSnapshotManager.create_from_rsnapshot_conf('tests/rsnapshot-minimal-faulty.conf')
     assert 'interval' in str(excinfo.value)
+
+
+def test_create_from_config_min_gaps():
+    manager = DefaultSnapshotManager.create_from_rsnapshot_conf('tests/rsnapshot-minimal-faulty.conf',
+                                                                min_gaps={'day': timedelta(days=1),
+                                                                          'week': timedelta(days=5)})
+
+    assert list(manager.intervals) == ['day', 'week', 'monthly']
+    assert manager.min_gap('week') == timedelta(days=5)
+    assert manager.last_snapshot('day') == '/rsnapshot/minimal/config/root/day.5'
+
+
+#
+# Actual level chain tests
+#
+
+
+def test_chain_in_config_order(tmpdir):
+    intervals = OrderedDict([('hourly', 6), ('daily', 7), ('weekly', 4), ('monthly', 12), ('yearly', 5)])
+    manager = DefaultSnapshotManager(backup_root=str(tmpdir), intervals=intervals)
+    assert list(manager.upcoming_tasks.items()) == [('hourly', True), ('daily', False), ('weekly', False),
+                                                    ('monthly', False), ('yearly', False)]
+
+
+def test_chain_full_cascade(tmpdir):
+    intervals = OrderedDict([('hourly', 2), ('daily', 2), ('weekly', 2), ('monthly', 2), ('yearly', 2)])
+    manager = DefaultSnapshotManager(backup_root=str(tmpdir), intervals=intervals)
+    now = datetime.now()
+    create_folder(manager.first_snapshot('hourly'), now - timedelta(hours=1, minutes=5))
+    create_folder(manager.last_snapshot('hourly'), now - timedelta(hours=3))
+    create_folder(manager.last_snapshot('daily'), now - timedelta(days=2))
+    create_folder(manager.first_snapshot('weekly'), now - timedelta(days=9))
+    create_folder(manager.last_snapshot('weekly'), now - timedelta(days=14))
+    create_folder(manager.first_snapshot('monthly'), now - timedelta(days=60))
+    create_folder(manager.last_snapshot('monthly'), now - timedelta(days=90))
+
+    assert manager.upcoming_tasks == {'hourly': True, 'daily': True, 'weekly': True, 'monthly': True,
+                                      'yearly': True}
+
+
+def test_chain_sub_day_gap(tmpdir):
+    intervals = OrderedDict([('hourly', 6), ('daily', 7)])
+    manager = DefaultSnapshotManager(backup_root=str(tmpdir), intervals=intervals)
+    create_folder(manager.first_snapshot('hourly'), datetime.now() - timedelta(minutes=30))
+
+    assert not manager.is_level_needed('hourly')
+
+
+def test_chain_unknown_interval():
+    with pytest.raises(ValueError) as excinfo:
+        DefaultSnapshotManager(backup_root='', intervals=OrderedDict([('daily', 7), ('fortnightly', 3)]))
+    assert 'fortnightly' in str(excinfo.value)
+
+
+def test_parse_min_gap():
+    assert parse_min_gap('weekly=5d') == ('weekly', timedelta(days=5))
+    assert parse_min_gap('hourly=4h') == ('hourly', timedelta(hours=4))
+
+    with pytest.raises(ValueError):
+        parse_min_gap('weekly=5w')
@@ -0,0 +1,121 @@
+from multilevelbackup.native import NativeBackupExecutor
+from multilevelbackup.ssh import SshPool
+from multilevelbackup.sync import ssh_destination
+
+import os
+import pytest
+import shlex
+import subprocess
+
+
+#
+# Test helper
+#
+
+
+fake_rsync = os.path.abspath('tests/fake-rsync')
+fake_ssh = os.path.abspath('tests/fake-ssh')
+
+
+@pytest.fixture(scope='function')
+def ssh_log(tmpdir, monkeypatch):
+    log = tmpdir.join('ssh.log')
+    log.write('')
+    monkeypatch.setenv('FAKE_SSH_LOG', str(log))
+    return log
+
+
+@pytest.fixture(scope='function')
+def conf_file(tmpdir):
+    remote = tmpdir.mkdir('remote')
+    for name in ['a', 'b', 'c', 'd']:
+        remote.mkdir(name).join('file').write(name)
+
+    config = tmpdir.join('rsnapshot.conf')
+    config.write('\n'.join([
+        'snapshot_root\t{root}/snapshots/'.format(root=tmpdir),
+        'cmd_rsync\t{rsync}'.format(rsync=fake_rsync),
+        'cmd_ssh\t{ssh}'.format(ssh=fake_ssh),
+        'retain\tdaily\t3',
+        'backup\troot@alpha:{remote}/a/\tone/'.format(remote=remote),
+        'backup\troot@alpha:{remote}/b/\tone/'.format(remote=remote),
+        'backup\troot@alpha:{remote}/c/\ttwo/'.format(remote=remote),
+        'backup\tbeta:{remote}/d/\tthree/'.format(remote=remote),
+    ]) + '\n')
+    return str(config)
+
+
+#
+# Actual tests
+#
+
+
+@pytest.mark.parametrize('source, destination', [
+    ('/home/', None),
+    ('root@example.com:/var/', 'root@example.com'),
+    ('example.com:/var/', 'example.com'),
+    ('backup@nas::module/path', None),
+    ('rsync://nas/module/', None),
+])
+def test_ssh_destination(source, destination):
+    assert ssh_destination(source) == destination
+
+
+def test_pool(ssh_log):
+    pool = SshPool(fake_ssh, '-p 2222')
+    rsh = pool.rsh('root@example.com')
+    control_folder = pool.control_folder
+
+    assert shlex.split(rsh)[:3] == [fake_ssh, '-p', '2222']
+    assert 'ControlPath=' + os.path.join(control_folder, '%C') in rsh
+    # Masters of a killed run expire by themselves
+    assert 'ControlPersist=60' in shlex.split(rsh)
+
+    subprocess.check_call(shlex.split(rsh) + ['root@example.com', 'true'])
+    subprocess.check_call(shlex.split(rsh) + ['root@example.com', 'true'])
+    pool.close()
+    pool.close()
+
+    assert ssh_log.read().splitlines() == ['master root@example.com', 'reuse root@example.com',
+                                           'exit root@example.com']
+    assert not os.path.exists(control_folder)
+
+
+def test_pool_without_master(ssh_log):
+    pool = SshPool(fake_ssh)
+    pool.rsh('root@example.com')
+    pool.close()
+
+    assert ssh_log.read() == ''
+
+
+def test_merge_points(conf_file):
+    executor = NativeBackupExecutor(conf_file)
+    points = executor.settings.backup_points
+
+    assert executor._batches(points) == [points[0:2], [points[2]], [points[3]]]
+    command = executor.rsync_command(points[0], points[1:2])
+    assert command[-3:] == [points[0].source, points[1].source, os.path.join(executor.sync_folder, 'one/')]
+
+    # Sources would be mixed up without --relative
+    executor.settings.long_args.remove('--relative')
+    assert executor._batches(points) == [[points[0]], [points[1]], [points[2]], [points[3]]]
+
+
+def test_sync_multiplexed(conf_file, tmpdir, ssh_log):
+    executor = NativeBackupExecutor(conf_file)
+    executor.perform_sync()
+
+    assert ssh_log.read().splitlines() == ['master root@alpha', 'reuse root@alpha', 'master beta',
+                                           'exit beta', 'exit root@alpha']
+    remote = str(tmpdir.join('remote')).lstrip('/')
+    for destination, name in [('one', 'a'), ('one', 'b'), ('two', 'c'), ('three', 'd')]:
+        assert tmpdir.join('snapshots', '.sync', destination, remote, name, 'file').read() == name
+    assert executor.ssh_pool is None
+
+
+def test_sync_without_multiplexing(conf_file, ssh_log):
+    executor = NativeBackupExecutor(conf_file, multiplex_ssh=False)
+    executor.perform_sync()
+
+    assert ssh_log.read().splitlines() == ['connect root@alpha', 'connect root@alpha', 'connect beta']
@@ -0,0 +1,147 @@
+from multilevelbackup.config import BackupPoint
+from multilevelbackup.process import run_sync
+from multilevelbackup.sync import SyncCheckpoint, SyncError, source_host, source_group, group_destinations, \
+    sync_concurrently, sync_concurrently_async
+
+import asyncio
+import os
+import threading
+import time
+import pytest
+
+
+@pytest.mark.parametrize('source, host', [
+    ('/home/', None),
+    ('relative/folder/', None),
+    ('root@example.com:/var/', 'example.com'),
+    ('example.com:/var/', 'example.com'),
+    ('backup@nas::module/path', 'nas'),
+    ('rsync://user@nas/module/', 'nas'),
+    ('rsync://nas/module/', 'nas'),
+])
+def test_source_host(source, host):
+    assert source_host(source) == host
+
+
+def test_source_group(tmpdir):
+    assert source_group('root@example.com:/var/') == 'host:example.com'
+    assert source_group(str(tmpdir)) == 'device:{device}'.format(device=tmpdir.stat().dev)
+    assert source_group(str(tmpdir.join('missing'))).startswith('path:')
+
+
+def test_group_destinations(tmpdir):
+    points = [
+        BackupPoint(str(tmpdir), 'localhost/', None),
+        BackupPoint('a@one:/etc/', 'one/', None),
+        BackupPoint('a@one:/home/', 'one-home/', None),
+        BackupPoint('a@two:/etc/', 'two/', None),
+        BackupPoint('a@two:/home/', 'one/', None),
+    ]
+    groups = group_destinations(points)
+
+    assert list(groups.values()) == [['localhost/'], ['one/', 'one-home/'], ['two/']]
+
+
+def test_sync_concurrently():
+    lock = threading.Lock()
+    running = []
+    synced = []
+    max_running = [0]
+
+    def sync_destination(destination):
+        with lock:
+            running.append(destination)
+            max_running[0] = max(max_running[0], len(running))
+        time.sleep(0.02)
+        with lock:
+            running.remove(destination)
+            synced.append(destination)
+
+    groups = {'a': ['a1', 'a2'], 'b': ['b1'], 'c': ['c1']}
+    sync_concurrently(groups, sync_destination, workers=2)
+
+    assert sorted(synced) == ['a1', 'a2', 'b1', 'c1']
+    assert max_running[0] == 2
+    assert synced.index('a1') < synced.index('a2')
+
+
+def test_sync_failure_per_point():
+    synced = []
+
+    def sync_destination(destination):
+        if destination in ('a1', 'c1'):
+            raise RuntimeError('failed ' + destination)
+        synced.append(destination)
+
+    with pytest.raises(SyncError) as excinfo:
+        sync_concurrently({'a': ['a1', 'a2'], 'b': ['b1'], 'c': ['c1']}, sync_destination, workers=3)
+
+    assert sorted(synced) == ['a2', 'b1']
+    assert sorted(excinfo.value.failures) == ['a1', 'c1']
+    assert 'failed c1' in str(excinfo.value)
+
+
+def test_checkpoint(tmpdir):
+    tmpdir.mkdir('.sync')
+    checkpoint = SyncCheckpoint(str(tmpdir)).load()
+    assert not checkpoint.resumed
+
+    checkpoint.begin()
+    checkpoint.destination_done('one/')
+
+    loaded = SyncCheckpoint(str(tmpdir)).load()
+    assert loaded.resumed
+    assert loaded.pending(['one/', 'two/']) == ['two/']
+
+    loaded.begin()
+    loaded.destination_done('two/')
+    loaded.finish()
+    assert SyncCheckpoint(str(tmpdir)).load().complete
+
+    loaded.remove()
+    assert not SyncCheckpoint(str(tmpdir)).load().complete
+
+
+def test_checkpoint_stale(tmpdir):
+    tmpdir.mkdir('.sync')
+    now = [1000.0]
+    checkpoint = SyncCheckpoint(str(tmpdir), max_age=60.0, clock=lambda: now[0])
+    checkpoint.destination_done('one/')
+
+    now[0] += 30.0
+    assert SyncCheckpoint(str(tmpdir), max_age=60.0, clock=lambda: now[0]).load().resumed
+    now[0] += 60.0
+    assert not SyncCheckpoint(str(tmpdir), max_age=60.0, clock=lambda: now[0]).load().resumed
+
+
+def test_checkpoint_other_sync_folder(tmpdir):
+    tmpdir.mkdir('.sync')
+    SyncCheckpoint(str(tmpdir)).finish()
+
+    # Sync folder was taken over and a new one was created
+    os.rename(str(tmpdir.join('.sync')), str(tmpdir.join('daily.0')))
+    tmpdir.mkdir('.sync')
+    assert not SyncCheckpoint(str(tmpdir)).load().complete
+
+
+def test_sync_concurrently_async():
+    running = []
+    synced = []
+    max_running = [0]
+
+    async def sync_destination(destination):
+        running.append(destination)
+        max_running[0] = max(max_running[0], len(running))
+        await asyncio.sleep(0.02)
+        running.remove(destination)
+        if destination == 'c1':
+            raise RuntimeError('failed c1')
+        synced.append(destination)
+
+    with pytest.raises(SyncError) as excinfo:
+        run_sync(sync_concurrently_async({'a': ['a1', 'a2'], 'b': ['b1'], 'c': ['c1']}, sync_destination, workers=2))
+
+    assert sorted(synced) == ['a1', 'a2', 'b1']
+    assert max_running[0] == 2
+    assert synced.index('a1') < synced.index('a2')
+    assert list(excinfo.value.failures) == ['c1']
@@ -0,0 +1,153 @@
+from multilevelbackup.usage import SnapshotScan, ScanCache, UsageIndex, build_usage_index, format_usage
+from multilevelbackup.cli import main
+from collections import OrderedDict
+
+import os
+import pytest
+
+
+#
+# Test helper
+#
+
+
+intervals = OrderedDict([('daily', 3), ('weekly', 2)])
+
+
+def write(file_name, size):
+    os.makedirs(os.path.dirname(file_name), exist_ok=True)
+    with open(file_name, 'wb') as data:
+        data.write(b'x' * size)
+    return os.stat(file_name).st_blocks * 512
+
+
+def link(source, target):
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    os.link(source, target)
+
+
+@pytest.fixture(scope='function')
+def snapshot_root(tmpdir):
+    """Snapshot root with one file in all snapshots, one in two and one unique file per snapshot."""
+    root = str(tmpdir.mkdir('root'))
+    sizes = {}
+    sizes['all'] = write(os.path.join(root, 'weekly.0', 'host', 'all'), 20000)
+    sizes['weekly'] = write(os.path.join(root, 'weekly.0', 'host', 'old'), 10000)
+    sizes['two'] = write(os.path.join(root, 'daily.1', 'host', 'sub', 'two'), 30000)
+    sizes['daily.1'] = write(os.path.join(root, 'daily.1', 'host', 'changed'), 5000)
+    sizes['daily.0'] = write(os.path.join(root, 'daily.0', 'host', 'changed'), 6000)
+    for snapshot in ('daily.0', 'daily.1'):
+        link(os.path.join(root, 'weekly.0', 'host', 'all'), os.path.join(root, snapshot, 'host', 'all'))
+    link(os.path.join(root, 'daily.1', 'host', 'sub', 'two'), os.path.join(root, 'daily.0', 'host', 'sub', 'two'))
+    # Hardlink within a snapshot counts once
+    link(os.path.join(root, 'daily.0', 'host', 'changed'), os.path.join(root, 'daily.0', 'host', 'copy'))
+    return root, sizes
+
+
+#
+# Actual tests
+#
+
+
+def test_walk_merges_hardlinks(snapshot_root):
+    root, sizes = snapshot_root
+    scan = SnapshotScan.walk(os.path.join(root, 'daily.0'), workers=2)
+
+    assert len(scan) == 3
+    assert list(scan.inodes) == sorted(scan.inodes)
+    assert sorted(scan.paths) == [1, 1, 2]
+    assert sum(scan.sizes) == sizes['all'] + sizes['two'] + sizes['daily.0']
+
+
+def test_scan_round_trip(snapshot_root):
+    root, _ = snapshot_root
+    scan = SnapshotScan.walk(os.path.join(root, 'daily.1'))
+    loaded = SnapshotScan.from_bytes(scan.to_bytes())
+
+    for column in ('inodes', 'sizes', 'nlinks', 'paths'):
+        assert getattr(loaded, column) == getattr(scan, column)
+    assert loaded.scanned == scan.scanned
+
+    with pytest.raises(ValueError):
+        SnapshotScan.from_bytes(scan.to_bytes()[:-1])
+    with pytest.raises(ValueError):
+        SnapshotScan.from_bytes(b'XXXX' + scan.to_bytes()[4:])
+
+
+def test_unique_and_shared_bytes(snapshot_root):
+    root, sizes = snapshot_root
+    index = build_usage_index(root, intervals)
+
+    usage = dict((entry.name, entry) for entry in index.usage())
+    assert [entry.name for entry in index.usage()] == ['daily.0', 'daily.1', 'weekly.0']
+    assert usage['daily.0'].unique_bytes == sizes['daily.0']
+    assert usage['daily.0'].shared_bytes == sizes['all'] + sizes['two']
+    assert usage['daily.1'].unique_bytes == sizes['daily.1']
+    assert usage['daily.1'].shared_bytes == sizes['all'] + sizes['two']
+    assert usage['weekly.0'].unique_bytes == sizes['weekly']
+    assert usage['weekly.0'].shared_bytes == sizes['all']
+    assert index.total_bytes == sum(sizes.values())
+    assert len(index) == 5
+
+
+def test_lookup(snapshot_root):
+    root, sizes = snapshot_root
+    index = build_usage_index(root, intervals)
+
+    entry = index.lookup(os.stat(os.path.join(root, 'weekly.0', 'host', 'all')).st_ino)
+    assert entry.size == sizes['all']
+    assert entry.nlink == 3
+    assert (entry.first, entry.last, entry.snapshots) == ('daily.0', 'weekly.0', 3)
+
+    entry = index.lookup(os.stat(os.path.join(root, 'daily.1', 'host', 'sub', 'two')).st_ino)
+    assert (entry.first, entry.last, entry.snapshots) == ('daily.0', 'daily.1', 2)
+
+    assert index.lookup(max(index.inodes) + 1) is None
+
+
+def test_empty_index():
+    index = UsageIndex([], [])
+    assert index.usage() == []
+    assert index.total_bytes == 0
+    assert 'total' in format_usage(index)
+
+
+def test_cache_only_walks_new_snapshot(snapshot_root, tmpdir, mocker):
+    root, sizes = snapshot_root
+    cache = ScanCache(ScanCache.folder_for_root(str(tmpdir.join('state')), root))
+    first = build_usage_index(root, intervals, cache=cache)
+    assert len(os.listdir(cache.folder)) == 3
+
+    # Rotate and create new daily snapshot
+    os.rename(os.path.join(root, 'daily.1'), os.path.join(root, 'daily.2'))
+    os.rename(os.path.join(root, 'daily.0'), os.path.join(root, 'daily.1'))
+    sizes['new'] = write(os.path.join(root, 'daily.0', 'host', 'new'), 7000)
+
+    walk = mocker.spy(SnapshotScan, 'walk')
+    second = build_usage_index(root, intervals, cache=cache)
+    assert walk.call_count == 1
+    assert walk.call_args[0][0] == os.path.join(root, 'daily.0')
+
+    usage = dict((entry.name, entry) for entry in second.usage())
+    assert usage['daily.0'].unique_bytes == sizes['new']
+    assert usage['daily.1'] == first.usage()[0]._replace(name='daily.1')
+    assert usage['daily.2'] == first.usage()[1]._replace(name='daily.2')
+    assert len(os.listdir(cache.folder)) == 4
+
+    # Scans of removed snapshots are pruned
+    os.rename(os.path.join(root, 'daily.2'), os.path.join(root, '_delete.daily.2'))
+    build_usage_index(root, intervals, cache=cache)
+    assert walk.call_count == 1
+    assert len(os.listdir(cache.folder)) == 3
+
+
+def test_usage_command(snapshot_root, tmpdir, capsys):
+    root, sizes = snapshot_root
+    conf_file = tmpdir.join('rsnapshot.conf')
+    conf_file.write('snapshot_root\t{root}/\nretain\tdaily\t3\nretain\tweekly\t2\n'.format(root=root))
+
+    assert main(['usage', '-c', str(conf_file), '-s', str(tmpdir.join('state'))]) == 0
+    output = capsys.readouterr()[0]
+    assert 'Usage of {root}'.format(root=root) in output
+    assert 'weekly.0' in output
+    assert str(sum(sizes.values())) in output
@@ -0,0 +1,143 @@
+from multilevelbackup.manifest import write_manifest, MANIFEST_FILE
+from multilevelbackup.verify import RateLimiter, VerifyCheckpoint, Failure, verify_snapshot, MISSING, SIZE, CONTENT, \
+    ERROR
+from multilevelbackup import verify as verify_module
+from multilevelbackup.cli import main
+from concurrent.futures import ThreadPoolExecutor
+
+import os
+import pytest
+
+
+#
+# Test helper
+#
+
+
+def write(file_name, content):
+    os.makedirs(os.path.dirname(file_name), exist_ok=True)
+    with open(file_name, 'w') as data:
+        data.write(content)
+
+
+@pytest.fixture(scope='function')
+def snapshot(tmpdir):
+    folder = str(tmpdir.mkdir('root').mkdir('monthly.2'))
+    for index in range(20):
+        write(os.path.join(folder, 'host', 'file{index:02d}'.format(index=index)),
+              'content {index}'.format(index=index))
+    write_manifest(folder)
+    return folder
+
+
+@pytest.fixture(scope='function')
+def checkpoint(snapshot, tmpdir):
+    return VerifyCheckpoint(str(tmpdir.join('state')), os.path.join(snapshot, MANIFEST_FILE))
+
+
+#
+# Actual tests
+#
+
+
+def test_verify_intact(snapshot):
+    assert verify_snapshot(snapshot, workers=2, batch_size=3) == (20, [])
+
+
+def test_verify_detects_damage(snapshot):
+    write(os.path.join(snapshot, 'host', 'file03'), 'content X')
+    write(os.path.join(snapshot, 'host', 'file05'), 'longer content')
+    os.unlink(os.path.join(snapshot, 'host', 'file07'))
+
+    total, failures = verify_snapshot(snapshot, workers=2, batch_size=3)
+    assert total == 20
+    assert failures == [Failure('host/file03', CONTENT), Failure('host/file05', SIZE),
+                        Failure('host/file07', MISSING)]
+
+
+def test_verify_reports_unreadable_file(snapshot, mocker):
+    hash_file = verify_module.hash_file
+
+    def failing_hash_file(file_name):
+        if file_name.endswith('file04'):
+            raise PermissionError(13, 'Permission denied', file_name)
+        return hash_file(file_name)
+
+    mocker.patch.object(verify_module, 'hash_file', side_effect=failing_hash_file)
+    total, failures = verify_snapshot(snapshot, batch_size=3, pool_factory=ThreadPoolExecutor)
+    assert total == 20
+    assert failures == [Failure('host/file04', ERROR)]
+
+
+def test_verify_resumes_from_checkpoint(snapshot, checkpoint, mocker):
+    checkpoint.position = 15
+    checkpoint.failures = [Failure('host/file01', CONTENT)]
+    checkpoint.save()
+    check_files = mocker.spy(verify_module, '_check_files')
+
+    loaded = VerifyCheckpoint(os.path.dirname(checkpoint.checkpoint_file),
+                              os.path.join(snapshot, MANIFEST_FILE)).load()
+    assert loaded.position == 15
+    total, failures = verify_snapshot(snapshot, checkpoint=loaded, batch_size=2, pool_factory=ThreadPoolExecutor)
+    assert total == 20
+    assert failures == [Failure('host/file01', CONTENT)]
+    assert sum(len(call[0][1]) for call in check_files.call_args_list) == 5
+    assert not os.path.exists(checkpoint.checkpoint_file)
+
+
+def test_verify_saves_checkpoint_on_interruption(snapshot, checkpoint, mocker):
+    calls = []
+
+    def check_files(folder, entries):
+        calls.append(entries)
+        if len(calls) == 3:
+            raise KeyboardInterrupt()
+        return []
+
+    mocker.patch('multilevelbackup.verify._check_files', side_effect=check_files)
+    with pytest.raises(KeyboardInterrupt):
+        verify_snapshot(snapshot, workers=1, checkpoint=checkpoint, batch_size=4, pool_factory=ThreadPoolExecutor)
+
+    assert VerifyCheckpoint(os.path.dirname(checkpoint.checkpoint_file),
+                            os.path.join(snapshot, MANIFEST_FILE)).load().position == 8
+
+
+def test_checkpoint_of_new_manifest_is_ignored(snapshot, checkpoint):
+    checkpoint.position = 10
+    checkpoint.save()
+    write_manifest(snapshot)
+    assert VerifyCheckpoint(os.path.dirname(checkpoint.checkpoint_file),
+                            os.path.join(snapshot, MANIFEST_FILE)).load().position == 0
+
+
+def test_rate_limiter():
+    now = [100.0]
+    sleeps = []
+    limiter = RateLimiter(1000, clock=lambda: now[0], sleep=sleeps.append)
+
+    limiter.acquire(500)
+    assert sleeps == [0.5]
+    now[0] += 2.0
+    limiter.acquire(500)
+    assert sleeps == [0.5]
+    limiter.acquire(3000)
+    assert sleeps == [0.5, 2.0]
+
+    unlimited = RateLimiter(None, sleep=sleeps.append)
+    unlimited.acquire(10 ** 12)
+    assert len(sleeps) == 2
+
+
+def test_verify_command(snapshot, tmpdir, capsys):
+    conf_file = tmpdir.join('rsnapshot.conf')
+    conf_file.write('snapshot_root\t{root}/\nretain\tmonthly\t3\n'.format(root=os.path.dirname(snapshot)))
+    state = str(tmpdir.join('state'))
+
+    assert main(['verify', '-c', str(conf_file), '-s', state, '--rate', '10M', 'monthly.2']) == 0
+    assert 'monthly.2: 20 files verified, 0 failed' in capsys.readouterr()[0]
+
+    write(os.path.join(snapshot, 'host', 'file00'), 'content X')
+    assert main(['verify', '-c', str(conf_file), '-s', state, 'monthly.2', 'monthly.1']) == 1
+    output = capsys.readouterr()[0]
+    assert 'content  host/file00' in output
+    assert 'monthly.1: no manifest found' in output